@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Выгрузка накопленного буфера агента на сервер одним запросом.
+
+После долгого оффлайна агент отправляет по 100 событий за send interval,
+и бэклог за несколько дней уходит часами. Этот скрипт делает снапшот
+buffer.db, загружает его целиком в /api/events/backfill (сервер грузит
+через COPY и пропускает дубликаты) и помечает события отправленными.
+
+Запуск: python backfill.py [config_path]
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from config import Config
+from buffer import EventBuffer
+from sender import EventSender
+
+
+def main():
+    config_path = sys.argv[1] if len(sys.argv) > 1 else None
+    config = Config(config_path)
+    buffer = EventBuffer(config.buffer_path)
+    sender = EventSender.from_config(config)
+    
+    unsent = buffer.count_unsent()
+    if not unsent:
+        print("Buffer is empty, nothing to backfill")
+        return
+    
+    print(f"Backfilling {unsent} unsent events to {config.server_url}...")
+    
+    fd, snapshot_path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    try:
+        max_id = buffer.snapshot(snapshot_path)
+        result = sender.upload_backfill(snapshot_path)
+    finally:
+        os.unlink(snapshot_path)
+    
+    if result is None:
+        print("Backfill failed, events stay in the buffer")
+        sys.exit(1)
+    
+    buffer.mark_sent_upto(max_id)
+    print(f"Done: {result['inserted']} inserted, {result['duplicates']} duplicates, {result['invalid']} invalid")
+
+
+if __name__ == "__main__":
+    main()
@@ -74,3 +74,19 @@ class EventBuffer:
         with sqlite3.connect(self.db_path) as conn:
             cursor = conn.execute("SELECT COUNT(*) FROM events WHERE sent = 0")
             return cursor.fetchone()[0]
+    
+    def snapshot(self, dest_path: str) -> int:
+        """
+        Консистентная копия буфера (SQLite backup API) для бэкфилла.
+        Возвращает максимальный id событий в копии.
+        """
+        with sqlite3.connect(self.db_path) as conn, sqlite3.connect(dest_path) as dest:
+            conn.backup(dest)
+            cursor = dest.execute("SELECT COALESCE(MAX(id), 0) FROM events")
+            return cursor.fetchone()[0]
+    
+    def mark_sent_upto(self, max_id: int):
+        """Отметить отправленными все события с id <= max_id"""
+        with sqlite3.connect(self.db_path) as conn:
+            conn.execute("UPDATE events SET sent = 1 WHERE sent = 0 AND id <= ?", (max_id,))
+            conn.commit()
@@ -59,6 +59,8 @@ class Config:
             "collect_interval_sec": 60,
             "send_interval_sec": 300,
             "buffer_path": "/var/lib/activity-tracker/buffer.db",
+            "token_path": None,  # по умолчанию рядом с buffer_path
+            "registration_secret": None,
             "features": {
                 "screenshots": False,
                 "screenshots_interval_sec": 600,
@@ -89,6 +91,8 @@ class Config:
         self.collect_interval_sec = config["collect_interval_sec"]
         self.send_interval_sec = config["send_interval_sec"]
         self.buffer_path = config["buffer_path"]
+        self.token_path = config.get("token_path") or os.path.join(os.path.dirname(self.buffer_path), "agent_token")
+        self.registration_secret = config.get("registration_secret")
         self.features = config["features"]
     
     def save_generated_config(self):
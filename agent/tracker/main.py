@@ -7,6 +7,7 @@ Activity Tracker Agent
 import time
 import signal
 import sys
+import uuid
 from datetime import datetime
 from pathlib import Path
 
@@ -21,7 +22,7 @@ class TrackerAgent:
     def __init__(self, config_path: str = None):
         self.config = Config(config_path)
         self.buffer = EventBuffer(self.config.buffer_path)
-        self.sender = EventSender(self.config.server_url)
+        self.sender = EventSender.from_config(self.config)
         self.system_stats = SystemStats()
         self.collector = LinuxActivityCollector()
         self._running = False
@@ -47,6 +48,8 @@ class TrackerAgent:
         
         event = {
             "machine_id": self.config.machine_id,
+            # Уникальный id события: сервер отбрасывает повторы при ретраях
+            "client_event_id": str(uuid.uuid4()),
             "timestamp": datetime.utcnow().isoformat(),
             "key_count": activity["key_count"],
             "mouse_clicks": activity["mouse_clicks"],
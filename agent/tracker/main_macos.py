@@ -7,6 +7,7 @@ Activity Tracker Agent for macOS
 import time
 import signal
 import sys
+import uuid
 from datetime import datetime, timezone
 from pathlib import Path
 
@@ -23,7 +24,7 @@ class TrackerAgent:
     def __init__(self, config_path: str = None):
         self.config = Config(config_path)
         self.buffer = EventBuffer(self.config.buffer_path)
-        self.sender = EventSender(self.config.server_url)
+        self.sender = EventSender.from_config(self.config)
         self.system_stats = MacOSSystemStats()
         self.collector = MacOSActivityCollector()
         self._running = False
@@ -49,6 +50,8 @@ class TrackerAgent:
         
         event = {
             "machine_id": self.config.machine_id,
+            # Уникальный id события: сервер отбрасывает повторы при ретраях
+            "client_event_id": str(uuid.uuid4()),
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "key_count": activity["key_count"],
             "mouse_clicks": activity["mouse_clicks"],
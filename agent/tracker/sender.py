@@ -1,25 +1,120 @@
+import gzip
+import json
+import os
 import requests
-from typing import List, Dict
+from typing import List, Dict, Optional
 
 
 class EventSender:
     """Отправка событий на сервер"""
     
-    def __init__(self, server_url: str, timeout: int = 30):
+    def __init__(self, server_url: str, timeout: int = 30, compress: bool = True,
+                 machine_id: Optional[str] = None, user_label: Optional[str] = None,
+                 token_path: Optional[str] = None, registration_secret: Optional[str] = None):
         self.server_url = server_url.rstrip("/")
         self.timeout = timeout
+        self.compress = compress  # gzip тела запроса (сервер понимает Content-Encoding)
+        # Подписанный токен машины (POST /api/desktop/register)
+        self.machine_id = machine_id
+        self.user_label = user_label
+        self.token_path = token_path
+        self.registration_secret = registration_secret
+        self.agent_token = self._load_token()
+        self._tokens_disabled = False  # сервер не выдаёт токены (503)
+    
+    @classmethod
+    def from_config(cls, config) -> "EventSender":
+        return cls(
+            config.server_url,
+            machine_id=config.machine_id,
+            user_label=config.user_label,
+            token_path=config.token_path,
+            registration_secret=config.registration_secret,
+        )
+    
+    def _load_token(self) -> Optional[str]:
+        if self.token_path and os.path.exists(self.token_path):
+            with open(self.token_path) as f:
+                return f.read().strip() or None
+        return None
+    
+    def _save_token(self, token: str):
+        if not self.token_path:
+            return
+        os.makedirs(os.path.dirname(self.token_path) or ".", exist_ok=True)
+        fd = os.open(self.token_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+    
+    def register(self) -> bool:
+        """Получить токен машины (POST /api/desktop/register)"""
+        if not self.machine_id or self._tokens_disabled:
+            return False
+        try:
+            # Прежний токен (даже истёкший) подтверждает, что machine_id наш
+            headers = {"Authorization": f"Bearer {self.agent_token}"} if self.agent_token else {}
+            response = requests.post(
+                f"{self.server_url}/api/desktop/register",
+                headers=headers,
+                json={
+                    "machine_id": self.machine_id,
+                    "user_label": self.user_label,
+                    "registration_secret": self.registration_secret,
+                },
+                timeout=self.timeout
+            )
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to register agent: {e}")
+            return False
+        
+        if response.status_code == 503:
+            # Сервер без AGENT_TOKEN_KEYS — работаем без токена
+            self._tokens_disabled = True
+            return False
+        if response.status_code != 200:
+            print(f"Registration failed {response.status_code}: {response.text}")
+            return False
+        
+        self.agent_token = response.json()["agent_token"]
+        self._save_token(self.agent_token)
+        return True
+    
+    def _auth_headers(self) -> Dict[str, str]:
+        if not self.agent_token:
+            self.register()
+        return {"Authorization": f"Bearer {self.agent_token}"} if self.agent_token else {}
+    
+    def _post(self, path: str, **kwargs) -> requests.Response:
+        """POST с токеном; на 401 токен перевыпускается и запрос повторяется один раз"""
+        headers = kwargs.pop("headers", {})
+        response = requests.post(
+            f"{self.server_url}{path}", headers={**headers, **self._auth_headers()}, **kwargs
+        )
+        if response.status_code == 401 and self.register():
+            for f in (kwargs.get("files") or {}).values():
+                f[1].seek(0)
+            response = requests.post(
+                f"{self.server_url}{path}", headers={**headers, **self._auth_headers()}, **kwargs
+            )
+        return response
     
     def send_batch(self, events: List[Dict]) -> bool:
         """Отправить пачку событий"""
         if not events:
             return True
         
+        body = json.dumps({"events": events}).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if self.compress:
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        
         try:
-            response = requests.post(
-                f"{self.server_url}/api/events",
-                json={"events": events},
+            response = self._post(
+                "/api/events",
+                data=body,
                 timeout=self.timeout,
-                headers={"Content-Type": "application/json"}
+                headers=headers
             )
             
             if response.status_code == 200:
@@ -31,6 +126,26 @@ class EventSender:
             print(f"Failed to send events: {e}")
             return False
     
+    def upload_backfill(self, path: str, timeout: int = 600) -> Optional[Dict]:
+        """Загрузить снапшот buffer.db целиком (POST /api/events/backfill)"""
+        try:
+            with open(path, "rb") as f:
+                response = self._post(
+                    "/api/events/backfill",
+                    files={"file": ("buffer.db", f, "application/vnd.sqlite3")},
+                    data={"format": "sqlite"},
+                    timeout=timeout
+                )
+            
+            if response.status_code == 200:
+                return response.json()
+            else:
+                print(f"Server returned {response.status_code}: {response.text}")
+                return None
+        except requests.exceptions.RequestException as e:
+            print(f"Failed to upload backfill: {e}")
+            return None
+    
     def check_health(self) -> bool:
         """Проверить доступность сервера"""
         try:
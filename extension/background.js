@@ -358,6 +358,16 @@ async function getEmailFromUserAgent() {
 
 // ============ API CALLS ============
 
+// Подписанный токен из handshake: /telemetry и /screenshot проверяют его
+// на сервере локально, без запроса в Google
+function ingestAuthToken() {
+  return (config && config.agent_token) || authToken;
+}
+
+function dropAgentToken() {
+  if (config) config.agent_token = null;
+}
+
 async function doHandshake() {
   try {
     const response = await fetch(`${API_BASE}/api/extension/handshake`, {
@@ -409,12 +419,13 @@ async function sendTelemetry(events) {
       headers: { 'Content-Type': 'application/json' },
       body: JSON.stringify({
         email: userEmail,
-        auth_token: authToken,
+        auth_token: ingestAuthToken(),
         events: events
       })
     });
 
 if (response.status === 401) {
+  dropAgentToken();
   await refreshAuthToken();
   // Обновляем сохранённое состояние с новым токеном
   if (config) {
@@ -735,7 +746,7 @@ async function sendScreenshot(dataUrl, timestamp, sourceUrl, sourceWindow) {
     const formData = new FormData();
     formData.append('file', blob, 'screenshot.jpg');
     formData.append('email', userEmail);
-    formData.append('auth_token', authToken);
+    formData.append('auth_token', ingestAuthToken());
     formData.append('created_at_ts', timestamp.toString());
     
     // Добавляем URL и title
@@ -755,6 +766,7 @@ async function sendScreenshot(dataUrl, timestamp, sourceUrl, sourceWindow) {
     });
     
     if (uploadResponse.status === 401) {
+      dropAgentToken();
       await refreshAuthToken();
       if (config) {
         await chrome.storage.local.set({ 
@@ -0,0 +1,287 @@
+"""
+Подписанные токены агентов, проверяемые локально.
+
+Токен выдаётся машине (/api/desktop/register) или профилю расширения
+(/api/extension/handshake) и проверяется в процессе без сетевых вызовов:
+
+    v1.<kid>.<payload>.<signature>
+
+payload — base64url JSON {"sub", "typ", "iat", "exp", "jti"},
+signature — base64url HMAC-SHA256("v1.<kid>.<payload>") ключом kid.
+
+Ключи: AGENT_TOKEN_KEYS="k2:secret2,k1:secret1" — первым подписываются
+новые токены, остальные только принимаются (ротация). Без ключей выдача
+токенов выключена и агенты работают по-старому.
+
+Отзыв: таблица revoked_agent_tokens, которая периодически загружается
+в память (RevocationSet), так что проверка не ходит в БД.
+"""
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional
+
+from fastapi import Header, HTTPException
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from database import SessionLocal
+from models import RevokedAgentToken
+
+logger = logging.getLogger(__name__)
+
+TOKEN_VERSION = "v1"
+TOKEN_TYPE_MACHINE = "machine"
+TOKEN_TYPE_PROFILE = "profile"
+
+AGENT_TOKEN_KEYS = os.getenv("AGENT_TOKEN_KEYS", "")
+AGENT_TOKEN_TTL_SEC = int(os.getenv("AGENT_TOKEN_TTL_SEC", str(7 * 24 * 3600)))
+# Без токена /api/events и /api/desktop/* отвечают 401
+REQUIRE_AGENT_TOKEN = os.getenv("REQUIRE_AGENT_TOKEN", "false").lower() in ("1", "true", "yes")
+# Общий секрет для /api/desktop/register. Без него токен выдаётся только
+# новой машине или в обмен на прежний (пусть истёкший) токен этой машины
+AGENT_REGISTRATION_SECRET = os.getenv("AGENT_REGISTRATION_SECRET", "")
+AGENT_TOKEN_REVOCATION_REFRESH_SEC = float(os.getenv("AGENT_TOKEN_REVOCATION_REFRESH_SEC", "30"))
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def parse_keys(spec: str) -> Dict[str, bytes]:
+    """'kid:secret,kid2:secret2' -> {kid: secret}, порядок сохраняется"""
+    keys = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        kid, sep, secret = item.partition(":")
+        if not sep or not kid or not secret or "." in kid:
+            raise ValueError(f"Invalid AGENT_TOKEN_KEYS entry: {kid or item!r}")
+        keys[kid] = secret.encode()
+    return keys
+
+
+def looks_like_agent_token(token: Optional[str]) -> bool:
+    return bool(token) and token.startswith(TOKEN_VERSION + ".")
+
+
+class RevocationSet:
+    """jti отозванных, но ещё не истёкших токенов (копия таблицы в памяти)"""
+
+    def __init__(self, refresh_sec: float):
+        self.refresh_sec = refresh_sec
+        self._revoked: Dict[str, float] = {}  # jti -> exp (unix time)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.refresh_errors = 0
+
+    def __contains__(self, jti: str) -> bool:
+        return jti in self._revoked
+
+    def add(self, jti: str, exp: float):
+        with self._lock:
+            self._revoked[jti] = exp
+
+    def load(self):
+        """Перечитать таблицу и удалить из неё истёкшие записи"""
+        now = datetime.now(timezone.utc)
+        db = SessionLocal()
+        try:
+            db.execute(delete(RevokedAgentToken).where(RevokedAgentToken.expires_at < now))
+            rows = db.execute(select(RevokedAgentToken.jti, RevokedAgentToken.expires_at)).all()
+            db.commit()
+        finally:
+            db.close()
+
+        revoked = {row.jti: row.expires_at.timestamp() for row in rows}
+        with self._lock:
+            # Отозванные в этом процессе после начала загрузки тоже сохраняем
+            for jti, exp in self._revoked.items():
+                if exp > now.timestamp():
+                    revoked.setdefault(jti, exp)
+            self._revoked = revoked
+
+    def _run(self):
+        while not self._stopping.wait(self.refresh_sec):
+            try:
+                self.load()
+            except Exception as e:
+                self.refresh_errors += 1
+                logger.error(f"Agent token revocation refresh failed: {e}")
+
+    def start(self):
+        try:
+            self.load()
+        except Exception as e:
+            self.refresh_errors += 1
+            logger.error(f"Agent token revocation load failed: {e}")
+        self._thread = threading.Thread(target=self._run, name="agent-token-revocations", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+
+    def __len__(self):
+        return len(self._revoked)
+
+
+class AgentTokenSigner:
+    """Выпуск и проверка токенов набором ключей"""
+
+    def __init__(self, keys: Dict[str, bytes], ttl_sec: int, revocations: RevocationSet):
+        self.keys = keys
+        self.signing_kid = next(iter(keys), None)
+        self.ttl_sec = ttl_sec
+        self.revocations = revocations
+
+        self.issued = 0
+        self.verified = 0
+        self.rejected = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.signing_kid is not None
+
+    def _sign(self, kid: str, signing_input: str) -> str:
+        return _b64encode(hmac.new(self.keys[kid], signing_input.encode(), hashlib.sha256).digest())
+
+    def issue(self, subject: str, token_type: str) -> str:
+        if not self.enabled:
+            raise RuntimeError("AGENT_TOKEN_KEYS is not configured")
+        now = int(time.time())
+        claims = {
+            "sub": subject,
+            "typ": token_type,
+            "iat": now,
+            "exp": now + self.ttl_sec,
+            "jti": secrets.token_hex(16),
+        }
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        signing_input = f"{TOKEN_VERSION}.{self.signing_kid}.{payload}"
+        self.issued += 1
+        return f"{signing_input}.{self._sign(self.signing_kid, signing_input)}"
+
+    def decode(self, token: str, check_expiry: bool = True) -> dict:
+        """Claims токена или HTTPException(401)"""
+        try:
+            version, kid, payload, signature = token.split(".")
+        except ValueError:
+            raise self._reject("Malformed agent token")
+        if version != TOKEN_VERSION or kid not in self.keys:
+            raise self._reject("Unknown agent token key")
+
+        expected = self._sign(kid, f"{version}.{kid}.{payload}")
+        if not hmac.compare_digest(expected, signature):
+            raise self._reject("Invalid agent token signature")
+
+        try:
+            claims = json.loads(_b64decode(payload))
+        except ValueError:
+            raise self._reject("Malformed agent token")
+
+        if check_expiry and claims.get("exp", 0) < time.time():
+            raise self._reject("Agent token expired")
+        return claims
+
+    def verify(self, token: str, token_type: str, subject: Optional[str] = None) -> dict:
+        """Проверить токен: подпись, срок, отзыв, тип и (опционально) subject"""
+        claims = self.decode(token)
+        if claims.get("jti") in self.revocations:
+            raise self._reject("Agent token revoked")
+        if claims.get("typ") != token_type:
+            raise self._reject("Wrong agent token type")
+        if subject is not None and claims.get("sub") != subject:
+            self.rejected += 1
+            raise HTTPException(status_code=403, detail="Agent token does not match request identity")
+        self.verified += 1
+        return claims
+
+    def verify_renewal(self, token: str, subject: str) -> dict:
+        """Прежний токен машины для перевыпуска: срок не проверяется, отзыв — да"""
+        claims = self.decode(token, check_expiry=False)
+        if claims.get("jti") in self.revocations:
+            raise self._reject("Agent token revoked")
+        if claims.get("typ") != TOKEN_TYPE_MACHINE or claims.get("sub") != subject:
+            self.rejected += 1
+            raise HTTPException(status_code=403, detail="Agent token does not match request identity")
+        return claims
+
+    def _reject(self, detail: str) -> HTTPException:
+        self.rejected += 1
+        return HTTPException(status_code=401, detail=detail)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "signing_kid": self.signing_kid,
+            "keys": len(self.keys),
+            "required": REQUIRE_AGENT_TOKEN,
+            "issued": self.issued,
+            "verified": self.verified,
+            "rejected": self.rejected,
+            "revoked": len(self.revocations),
+            "revocation_refresh_errors": self.revocations.refresh_errors,
+        }
+
+
+revocations = RevocationSet(AGENT_TOKEN_REVOCATION_REFRESH_SEC)
+agent_tokens = AgentTokenSigner(parse_keys(AGENT_TOKEN_KEYS), AGENT_TOKEN_TTL_SEC, revocations)
+
+
+def revoke_token(db, token: str) -> dict:
+    """Отозвать токен (без commit). Истёкший токен тоже можно отозвать."""
+    claims = agent_tokens.decode(token, check_expiry=False)
+    expires_at = datetime.fromtimestamp(claims["exp"], timezone.utc)
+    db.execute(
+        pg_insert(RevokedAgentToken)
+        .values(jti=claims["jti"], subject=claims["sub"], expires_at=expires_at)
+        .on_conflict_do_nothing(index_elements=["jti"])
+    )
+    revocations.add(claims["jti"], claims["exp"])
+    return claims
+
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    if not authorization:
+        return None
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        raise HTTPException(status_code=401, detail="Expected 'Authorization: Bearer <agent token>'")
+    return token.strip()
+
+
+async def desktop_agent_claims(authorization: Optional[str] = Header(None)) -> Optional[dict]:
+    """
+    Dependency для роутов desktop агента.
+    None — запрос без токена (разрешено, пока REQUIRE_AGENT_TOKEN выключен).
+    """
+    token = bearer_token(authorization)
+    if token is None:
+        if REQUIRE_AGENT_TOKEN:
+            raise HTTPException(status_code=401, detail="Agent token required")
+        return None
+    return agent_tokens.verify(token, TOKEN_TYPE_MACHINE)
+
+
+def check_machine_ids(claims: Optional[dict], machine_ids: Iterable[str]):
+    """Токен машины разрешает писать только от её machine_id"""
+    if claims is None:
+        return
+    if any(machine_id != claims["sub"] for machine_id in machine_ids):
+        raise HTTPException(status_code=403, detail="Agent token does not match machine_id")
@@ -0,0 +1,62 @@
+"""
+Общая арифметика агрегатов для dashboard и /api/activity.
+
+На вход приходят уже сложенные в БД суммы rollups.py (fetch_fleet_rollups,
+суточные и часовые строки), а не сырые события: на машину не больше
+288 интервалов за день, поэтому здесь обычный Python. Округление —
+встроенный round(), как в прежнем проходе по событиям; ответы совпадают
+с ним, кроме средних CPU/RAM ровно на границе округления (x.x5), где
+другой порядок сложения float может дать соседнее значение
+(tests/test_aggregation.py).
+
+Замер обоих путей вместе с запросами к БД:
+python bench_aggregation.py --database-url postgresql://...
+"""
+
+from typing import Dict, Iterable, List
+
+from rollups import SUM_COLUMNS
+
+# Метрики активности: ключ в ответе dashboard -> колонка агрегата
+ACTIVITY_METRICS = (
+    ("keys", "key_count"),
+    ("clicks", "mouse_clicks"),
+    ("distance", "mouse_distance_px"),
+    ("scroll", "scroll_count"),
+)
+
+
+def average(total, count, default=0):
+    """Среднее с одним знаком после запятой; default, если делить не на что"""
+    return round(total / count, 1) if count > 0 else default
+
+
+def averages(totals: Iterable, counts: Iterable, default=0) -> List:
+    """Поэлементное average для списков сумм и количеств"""
+    return [average(total, count, default) for total, count in zip(totals, counts)]
+
+
+def format_active_time(minutes: int) -> str:
+    """Активное время как "Xh Ym\""""
+    return f"{minutes // 60}h {minutes % 60}m"
+
+
+def bin_buckets(buckets: Dict[int, dict], bins: int, clamp: bool = True) -> Dict[str, list]:
+    """
+    Суммы {номер интервала: {колонка: значение}} -> {колонка: список длины bins}.
+    Номер за пределами прижимается к последнему интервалу (clamp) или пропускается.
+    """
+    binned = {column: [0] * bins for column in SUM_COLUMNS}
+    for index, bucket in buckets.items():
+        if index >= bins:
+            if not clamp:
+                continue
+            index = bins - 1
+        for column in SUM_COLUMNS:
+            binned[column][index] += bucket[column]
+    return binned
+
+
+def per_minute(totals: Dict[str, int], active_minutes: int) -> Dict[str, float]:
+    """Метрики активности на активную минуту: {ключ метрики: среднее}"""
+    return {key: average(totals[key], active_minutes) for key, _ in ACTIVITY_METRICS}
@@ -0,0 +1,394 @@
+#!/usr/bin/env python3
+"""
+Холодный архив activity_events в Parquet.
+
+Закрытые сутки (UTC) старше ARCHIVE_AFTER_DAYS выгружаются по машинам
+в файлы Parquet (zstd, словарное кодирование строк, row group'ы по
+ARCHIVE_ROW_GROUP_ROWS строк в порядке timestamp — фильтр по времени
+читает только нужные группы). Файлы лежат в ARCHIVE_DIR или, если он
+не задан, в S3 бакете скриншотов под ARCHIVE_S3_PREFIX.
+
+Одна машина-сутки — одна транзакция:
+  1. строки (с clipboard history) читаются FOR UPDATE
+  2. файл записывается и читается обратно: sha256 и список id должны совпасть
+  3. строка манифеста activity_archives + DELETE перенесённых строк
+
+Повтор после сбоя перезаписывает тот же файл (имя — по первому id).
+Агрегаты rollups.py не трогаются, поэтому dashboard, summary и timeline
+работают как прежде; /events и топ приложений дочитывают архив сами.
+
+    python archive.py run [--days 90]
+"""
+
+import argparse
+import hashlib
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, List, Optional, Sequence
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+import storage
+from clipboard_store import decompress_content
+from database import engine
+from partitions import lock_maintenance
+
+logger = logging.getLogger(__name__)
+
+# 0 = не архивировать
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "0"))
+ARCHIVE_INTERVAL_SEC = float(os.getenv("ARCHIVE_INTERVAL_SEC", "3600"))
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")  # локальный каталог; иначе S3
+ARCHIVE_S3_PREFIX = os.getenv("ARCHIVE_S3_PREFIX", "archive/")
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zstd")
+# 720 поминутных событий = полсуток
+ARCHIVE_ROW_GROUP_ROWS = int(os.getenv("ARCHIVE_ROW_GROUP_ROWS", "720"))
+
+CLIPBOARD_TYPE = pa.list_(pa.struct([("action", pa.string()), ("text", pa.string())]))
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("timestamp", pa.timestamp("us", tz="UTC")),
+    ("key_count", pa.int32()),
+    ("mouse_clicks", pa.int32()),
+    ("mouse_distance_px", pa.int32()),
+    ("scroll_count", pa.int32()),
+    ("active_window", pa.string()),
+    ("active_app", pa.string()),
+    ("is_idle", pa.bool_()),
+    ("active_url", pa.string()),
+    ("active_domain", pa.string()),
+    ("tab_switches_count", pa.int32()),
+    ("duration_seconds", pa.int32()),
+    ("focus_time_sec", pa.int32()),
+    ("copy_count", pa.int32()),
+    ("paste_count", pa.int32()),
+    ("keys_packed", pa.binary()),
+    ("mouse_avg_speed", pa.float64()),
+    ("extension_version", pa.string()),
+    ("cpu_percent", pa.float64()),
+    ("ram_used_percent", pa.float64()),
+    ("disk_used_percent", pa.float64()),
+    ("agent_type", pa.string()),
+    ("client_event_id", pa.string()),
+    ("created_at", pa.timestamp("us", tz="UTC")),
+    ("clipboard", CLIPBOARD_TYPE),
+])
+
+# Строки словарей (string_dict.py) или старых колонок
+EXPORT_SQL = """
+    SELECT e.id, e.timestamp, e.key_count, e.mouse_clicks, e.mouse_distance_px, e.scroll_count,
+           coalesce(w.value, e.active_window) AS active_window,
+           coalesce(a.value, e.active_app) AS active_app,
+           e.is_idle, e.active_url,
+           coalesce(d.value, e.active_domain) AS active_domain,
+           e.tab_switches_count, e.duration_seconds, e.focus_time_sec, e.copy_count, e.paste_count,
+           e.keys_packed, e.mouse_avg_speed, e.extension_version,
+           e.cpu_percent, e.ram_used_percent, e.disk_used_percent,
+           e.agent_type, e.client_event_id, e.created_at
+    FROM activity_events e
+    LEFT JOIN app_names a ON a.id = e.app_id
+    LEFT JOIN domain_names d ON d.id = e.domain_id
+    LEFT JOIN window_titles w ON w.id = e.window_id
+    WHERE e.machine_id = :machine_id AND e.timestamp >= :start AND e.timestamp < :end
+    ORDER BY e.timestamp, e.id
+    FOR UPDATE OF e
+"""
+
+CLIPBOARD_SQL = """
+    SELECT c.activity_event_id, c.action, c.content, b.content_zlib
+    FROM clipboard_events c
+    LEFT JOIN clipboard_blobs b ON b.content_hash = c.blob_hash
+    WHERE c.event_timestamp >= :start AND c.event_timestamp < :end
+      AND c.activity_event_id = ANY(:ids)
+    ORDER BY c.id
+"""
+
+
+# ============ ФАЙЛЫ ============
+
+def storage_kind() -> str:
+    return "local" if ARCHIVE_DIR else "s3"
+
+
+def archive_location(machine_id, day: date, first_id: int) -> str:
+    return f"activity/{machine_id}/{day:%Y/%m}/{day.isoformat()}_{first_id}.parquet"
+
+
+def put_file(kind: str, location: str, data: bytes):
+    if kind == "local":
+        path = os.path.join(ARCHIVE_DIR, location)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    else:
+        storage.get_s3_client().put_object(
+            Bucket=storage.S3_BUCKET, Key=ARCHIVE_S3_PREFIX + location, Body=data,
+            ContentType="application/vnd.apache.parquet",
+        )
+
+
+def get_file(kind: str, location: str) -> bytes:
+    if kind == "local":
+        with open(os.path.join(ARCHIVE_DIR, location), "rb") as f:
+            return f.read()
+    obj = storage.get_s3_client().get_object(Bucket=storage.S3_BUCKET, Key=ARCHIVE_S3_PREFIX + location)
+    return obj["Body"].read()
+
+
+def delete_file(kind: str, location: str):
+    if kind == "local":
+        try:
+            os.remove(os.path.join(ARCHIVE_DIR, location))
+        except FileNotFoundError:
+            pass
+    else:
+        storage.get_s3_client().delete_object(Bucket=storage.S3_BUCKET, Key=ARCHIVE_S3_PREFIX + location)
+
+
+def delete_files(entries: Sequence) -> int:
+    """Удалить файлы строк манифеста (удалённой машины); возвращает число ошибок"""
+    errors = 0
+    for entry in entries:
+        try:
+            delete_file(entry.storage, entry.location)
+        except Exception as e:
+            errors += 1
+            logger.error(f"Archive: cannot delete {entry.storage}:{entry.location}: {e}")
+    return errors
+
+
+def encode_table(rows: List[dict]) -> bytes:
+    """Строки -> файл Parquet"""
+    table = pa.Table.from_pylist(rows, schema=ARCHIVE_SCHEMA)
+    out = pa.BufferOutputStream()
+    pq.write_table(
+        table, out,
+        compression=ARCHIVE_COMPRESSION,
+        row_group_size=ARCHIVE_ROW_GROUP_ROWS,
+        use_dictionary=True,
+        write_statistics=True,
+    )
+    return out.getvalue().to_pybytes()
+
+
+# ============ ЧТЕНИЕ ============
+
+def read_archives(entries: Sequence, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                  columns: Optional[List[str]] = None) -> pa.Table:
+    """
+    События из файлов манифеста (entries — строки activity_archives)
+    в интервале [start, end]; row group'ы вне интервала не читаются.
+    """
+    filters = []
+    if start is not None:
+        filters.append(("timestamp", ">=", pa.scalar(start, type=ARCHIVE_SCHEMA.field("timestamp").type)))
+    if end is not None:
+        filters.append(("timestamp", "<=", pa.scalar(end, type=ARCHIVE_SCHEMA.field("timestamp").type)))
+
+    tables = [
+        pq.read_table(io.BytesIO(get_file(entry.storage, entry.location)), columns=columns, filters=filters or None)
+        for entry in entries
+    ]
+    if not tables:
+        schema = pa.schema([ARCHIVE_SCHEMA.field(c) for c in columns]) if columns else ARCHIVE_SCHEMA
+        return schema.empty_table()
+    return pa.concat_tables(tables)
+
+
+def app_minutes(entries: Sequence, start: datetime, end: datetime) -> Dict[str, int]:
+    """Минуты по приложениям из архива (как get_top_apps по activity_events)"""
+    table = read_archives(entries, start, end, columns=["active_app"])
+    apps = pc.fill_null(table.column("active_app"), "")
+    counts = {}
+    for item in pc.value_counts(apps).to_pylist():
+        app = item["values"] or "Unknown"
+        counts[app] = counts.get(app, 0) + item["counts"]
+    return counts
+
+
+# ============ АРХИВАЦИЯ ============
+
+class ArchiveJob:
+    """Фоновый перенос закрытых суток в Parquet: машина-сутки за транзакцию"""
+
+    def __init__(self, after_days: int, interval_sec: float):
+        self.after_days = after_days
+        self.interval_sec = interval_sec
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.runs = 0
+        self.errors = 0
+        self.files = 0
+        self.events_archived = 0
+        self.bytes_written = 0
+        self.current: Optional[str] = None
+        self.last_cutoff: Optional[datetime] = None
+        self.last_run_at: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.after_days > 0
+
+    def archive_machine_day(self, conn, machine_id, day: date) -> int:
+        """Перенести события машины за сутки в архив; возвращает число строк"""
+        start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+        bounds = {"machine_id": machine_id, "start": start, "end": start + timedelta(days=1)}
+
+        rows = [dict(row._mapping) for row in conn.execute(text(EXPORT_SQL), bounds)]
+        if not rows:
+            return 0
+        ids = [row["id"] for row in rows]
+
+        clipboard: Dict[int, list] = {}
+        for clip in conn.execute(text(CLIPBOARD_SQL), {**bounds, "ids": ids}):
+            content = decompress_content(clip.content_zlib) if clip.content_zlib is not None else clip.content
+            clipboard.setdefault(clip.activity_event_id, []).append({"action": clip.action, "text": content})
+        for row in rows:
+            row["keys_packed"] = bytes(row["keys_packed"]) if row["keys_packed"] is not None else None
+            row["clipboard"] = clipboard.get(row["id"])
+
+        kind = storage_kind()
+        location = archive_location(machine_id, day, ids[0])
+        data = encode_table(rows)
+        digest = hashlib.sha256(data).hexdigest()
+        put_file(kind, location, data)
+
+        # Удаляем из Postgres только то, что прочиталось из архива
+        stored = get_file(kind, location)
+        if hashlib.sha256(stored).hexdigest() != digest:
+            raise RuntimeError(f"Archive {location}: checksum mismatch after write")
+        if pq.read_table(io.BytesIO(stored), columns=["id"]).column("id").to_pylist() != ids:
+            raise RuntimeError(f"Archive {location}: event ids mismatch after write")
+
+        conn.execute(text("""
+            INSERT INTO activity_archives
+                (machine_id, day, storage, location, row_count, min_timestamp, max_timestamp, size_bytes, sha256)
+            VALUES (:machine_id, :day, :storage, :location, :row_count, :min_ts, :max_ts, :size, :sha256)
+        """), {
+            "machine_id": machine_id, "day": day, "storage": kind, "location": location,
+            "row_count": len(rows), "min_ts": rows[0]["timestamp"], "max_ts": rows[-1]["timestamp"],
+            "size": len(data), "sha256": digest,
+        })
+        conn.execute(text("""
+            DELETE FROM clipboard_events
+            WHERE event_timestamp >= :start AND event_timestamp < :end AND activity_event_id = ANY(:ids)
+        """), {**bounds, "ids": ids})
+        conn.execute(text("""
+            DELETE FROM activity_events
+            WHERE machine_id = :machine_id AND timestamp >= :start AND timestamp < :end AND id = ANY(:ids)
+        """), {**bounds, "ids": ids})
+
+        self.files += 1
+        self.events_archived += len(rows)
+        self.bytes_written += len(data)
+        logger.info(f"Archive: {location} ({len(rows)} events, {len(data)} bytes)")
+        return len(rows)
+
+    def _oldest_day(self, cutoff: datetime) -> Optional[date]:
+        with engine.connect() as conn:
+            first = conn.execute(
+                text("SELECT min(timestamp) FROM activity_events WHERE timestamp < :cutoff"), {"cutoff": cutoff}
+            ).scalar()
+        return first.astimezone(timezone.utc).date() if first is not None else None
+
+    def run_once(self, now: Optional[datetime] = None) -> dict:
+        """Заархивировать все закрытые сутки раньше окна"""
+        if not self.enabled:
+            return self.stats()
+        now = now or datetime.now(timezone.utc)
+        cutoff = datetime.combine(now.date() - timedelta(days=self.after_days), datetime.min.time(), tzinfo=timezone.utc)
+        self.last_cutoff = cutoff
+
+        try:
+            while not self._stopping.is_set():
+                day = self._oldest_day(cutoff)
+                if day is None:
+                    break
+                start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+                with engine.connect() as conn:
+                    machine_ids = conn.execute(text("""
+                        SELECT DISTINCT machine_id FROM activity_events
+                        WHERE timestamp >= :start AND timestamp < :end
+                    """), {"start": start, "end": start + timedelta(days=1)}).scalars().all()
+                for machine_id in machine_ids:
+                    if self._stopping.is_set():
+                        break
+                    self.current = f"{machine_id}/{day.isoformat()}"
+                    with engine.begin() as conn:
+                        lock_maintenance(conn)
+                        self.archive_machine_day(conn, machine_id, day)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Archive failed at {self.current}: {e}")
+        finally:
+            self.current = None
+
+        self.runs += 1
+        self.last_run_at = time.time()
+        return self.stats()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval_sec):
+            self.run_once()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._run, name="event-archive", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "after_days": self.after_days or None,
+            "storage": storage_kind(),
+            "runs": self.runs,
+            "errors": self.errors,
+            "current": self.current,
+            "last_cutoff": self.last_cutoff.isoformat() if self.last_cutoff else None,
+            "files": self.files,
+            "events_archived": self.events_archived,
+            "bytes_written": self.bytes_written,
+            "last_run_at": self.last_run_at,
+        }
+
+
+archive_job = ArchiveJob(ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL_SEC)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Move closed days of activity_events into Parquet cold storage")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="run one archive pass")
+    run.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="keep this many recent days in Postgres")
+    args = parser.parse_args()
+
+    if args.days <= 0:
+        print("Archive is disabled (set ARCHIVE_AFTER_DAYS or --days)")
+        return 2
+    print(ArchiveJob(args.days, ARCHIVE_INTERVAL_SEC).run_once())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
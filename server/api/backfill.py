@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Загрузка бэклога агента (buffer.db) в activity_events через COPY.
+
+Принимает целиком SQLite буфер агента (agent/tracker/buffer.py) или
+выгрузку его таблицы events в NDJSON/CSV. Строки заливаются COPY во
+временную staging таблицу, а затем одним INSERT ... SELECT переносятся
+в activity_events, пропуская уже загруженные события
+(уникальный индекс uq_activity_events_dedupe). Clipboard history событий
+идёт вторым COPY и записывается в clipboard_blobs / clipboard_events
+тем же запросом, только для вставленных событий.
+
+Запуск напрямую в БД (DATABASE_URL):
+    python backfill.py /path/to/buffer.db
+    python backfill.py events.ndjson --format ndjson --machine-id vm-abc123-user1
+"""
+
+import argparse
+import csv
+import io
+import json
+import logging
+import sqlite3
+import sys
+from typing import Callable, Iterable, Iterator, Optional
+
+from pydantic import ValidationError
+
+from schemas import ActivityEventCreate
+from bulk_ingest import utc_timestamp
+from clipboard_store import compress_content, content_hash
+from rollups import upsert_ctes_sql
+from string_dict import DICTIONARIES
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк отправлять в одном COPY (между отчётами о прогрессе)
+COPY_CHUNK_ROWS = 5000
+
+SQLITE_MAGIC = b"SQLite format 3\x00"
+BACKFILL_FORMATS = ("sqlite", "ndjson", "csv")
+
+STAGING_COLUMNS = [
+    ("machine_id", "TEXT"),
+    ("timestamp", "TIMESTAMPTZ"),
+    ("key_count", "INTEGER"),
+    ("mouse_clicks", "INTEGER"),
+    ("mouse_distance_px", "INTEGER"),
+    ("scroll_count", "INTEGER"),
+    ("active_window", "TEXT"),
+    ("active_app", "TEXT"),
+    ("is_idle", "BOOLEAN"),
+    ("active_url", "TEXT"),
+    ("active_domain", "TEXT"),
+    ("tab_switches_count", "INTEGER"),
+    ("duration_seconds", "INTEGER"),
+    ("focus_time_sec", "INTEGER"),
+    ("copy_count", "INTEGER"),
+    ("paste_count", "INTEGER"),
+    ("keys_packed", "BYTEA"),
+    ("mouse_avg_speed", "DOUBLE PRECISION"),
+    ("cpu_percent", "DOUBLE PRECISION"),
+    ("ram_used_percent", "DOUBLE PRECISION"),
+    ("disk_used_percent", "DOUBLE PRECISION"),
+    ("agent_type", "TEXT"),
+    ("client_event_id", "TEXT"),
+]
+
+# Clipboard history: row_no — номер строки backfill_staging, к которой относится запись
+CLIPBOARD_STAGING_COLUMNS = [
+    ("row_no", "BIGINT"),
+    ("action", "TEXT"),
+    ("content_hash", "TEXT"),
+    ("content_zlib", "BYTEA"),
+    ("size_bytes", "INTEGER"),
+]
+
+# Колонки activity_events, которые переносятся из staging как есть
+# (строки приложений/доменов/окон заменяются id словарей, см. string_dict.py)
+EVENT_COLUMNS = [name for name, _ in STAGING_COLUMNS if name != "machine_id" and name not in DICTIONARIES]
+
+
+# ============ ЧТЕНИЕ ИСТОЧНИКОВ ============
+
+def detect_format(path: str) -> str:
+    """sqlite / ndjson / csv по сигнатуре и расширению файла"""
+    with open(path, "rb") as f:
+        if f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC:
+            return "sqlite"
+    if path.endswith(".csv"):
+        return "csv"
+    return "ndjson"
+
+
+def _event_from_buffer_row(row: dict, include_sent: bool) -> Optional[dict]:
+    """
+    Строка таблицы events буфера -> событие.
+    Поддерживает и голое событие (без обёртки id/data/sent).
+    """
+    if "data" not in row:
+        return row
+    if not include_sent and str(row.get("sent", "0")) not in ("0", "", "None"):
+        return None
+    data = row["data"]
+    return json.loads(data) if isinstance(data, str) else data
+
+
+def iter_buffer_events(path: str, fmt: Optional[str] = None, include_sent: bool = False) -> Iterator[dict]:
+    """Итератор событий из buffer.db или его NDJSON/CSV выгрузки"""
+    fmt = fmt or detect_format(path)
+
+    if fmt == "sqlite":
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            query = "SELECT data FROM events"
+            if not include_sent:
+                query += " WHERE sent = 0"
+            for (data,) in conn.execute(query + " ORDER BY id"):
+                yield json.loads(data)
+        finally:
+            conn.close()
+
+    elif fmt == "ndjson":
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                event = _event_from_buffer_row(json.loads(line), include_sent)
+                if event is not None:
+                    yield event
+
+    elif fmt == "csv":
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                event = _event_from_buffer_row(row, include_sent)
+                if event is not None:
+                    yield event
+
+    else:
+        raise ValueError(f"Unknown backfill format: {fmt}")
+
+
+# ============ ЗАГРУЗКА ============
+
+def _csv_value(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, list):
+        return json.dumps(value)
+    if isinstance(value, bytes):
+        return "\\x" + value.hex()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+def _staging_row(row_no: int, event: ActivityEventCreate) -> list:
+    data = event.model_dump()
+    data["timestamp"] = utc_timestamp(event.timestamp)
+    data["client_event_id"] = event.client_event_id or ""
+    data["keys_packed"] = event.keys_packed  # model_dump отдаёт Base64Bytes строкой base64
+    return [row_no] + [_csv_value(data.get(name)) for name, _ in STAGING_COLUMNS]
+
+
+def _clipboard_staging_rows(row_no: int, event: ActivityEventCreate) -> list:
+    return [
+        [row_no, clip.action, content_hash(clip.text),
+         _csv_value(compress_content(clip.text)), len(clip.text.encode("utf-8"))]
+        for clip in event.clipboard_history or ()
+    ]
+
+
+def load_events(
+    raw_conn,
+    events: Iterable[dict],
+    machine_id: Optional[str] = None,
+    progress: Optional[Callable[[dict], None]] = None,
+) -> dict:
+    """
+    Залить события через COPY в staging и перенести в activity_events.
+
+    raw_conn — DBAPI (psycopg2) соединение; commit делает вызывающий.
+    machine_id — переопределить machine_id всех событий.
+    progress(stats) вызывается после каждого COPY чанка.
+    """
+    stats = {"read": 0, "invalid": 0, "staged": 0, "inserted": 0, "duplicates": 0, "clipboard": 0}
+
+    with raw_conn.cursor() as cur:
+        columns_ddl = ", ".join(f"{name} {sql_type}" for name, sql_type in STAGING_COLUMNS)
+        cur.execute(f"CREATE TEMP TABLE backfill_staging (row_no BIGINT, {columns_ddl}) ON COMMIT DROP")
+        clipboard_ddl = ", ".join(f"{name} {sql_type}" for name, sql_type in CLIPBOARD_STAGING_COLUMNS)
+        cur.execute(f"CREATE TEMP TABLE backfill_clipboard_staging ({clipboard_ddl}) ON COMMIT DROP")
+
+        # Пустой client_event_id в CSV иначе прочитался бы как NULL
+        copy_sql = (f"COPY backfill_staging (row_no, {', '.join(n for n, _ in STAGING_COLUMNS)}) "
+                    f"FROM STDIN WITH (FORMAT csv, FORCE_NOT_NULL (client_event_id))")
+        clipboard_copy_sql = (f"COPY backfill_clipboard_staging ({', '.join(n for n, _ in CLIPBOARD_STAGING_COLUMNS)}) "
+                              f"FROM STDIN WITH (FORMAT csv)")
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        clipboard_buf = io.StringIO()
+        clipboard_writer = csv.writer(clipboard_buf)
+        chunk_rows = 0
+
+        def flush_chunk():
+            nonlocal buf, writer, clipboard_buf, clipboard_writer, chunk_rows
+            if not chunk_rows:
+                return
+            buf.seek(0)
+            cur.copy_expert(copy_sql, buf)
+            if clipboard_buf.tell():
+                clipboard_buf.seek(0)
+                cur.copy_expert(clipboard_copy_sql, clipboard_buf)
+            stats["staged"] += chunk_rows
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            clipboard_buf = io.StringIO()
+            clipboard_writer = csv.writer(clipboard_buf)
+            chunk_rows = 0
+            if progress:
+                progress(dict(stats))
+
+        for raw_event in events:
+            stats["read"] += 1
+            if machine_id:
+                raw_event = {**raw_event, "machine_id": machine_id}
+            try:
+                event = ActivityEventCreate.model_validate(raw_event)
+            except ValidationError as e:
+                stats["invalid"] += 1
+                logger.warning(f"Backfill: skipping invalid event #{stats['read']}: {e.errors()[:1]}")
+                continue
+
+            row_no = stats["staged"] + chunk_rows
+            writer.writerow(_staging_row(row_no, event))
+            clipboard_writer.writerows(_clipboard_staging_rows(row_no, event))
+            chunk_rows += 1
+            if chunk_rows >= COPY_CHUNK_ROWS:
+                flush_chunk()
+        flush_chunk()
+
+        # Машины, которых ещё нет
+        cur.execute("""
+            INSERT INTO machines (id, machine_id, user_label, machine_type, is_active)
+            SELECT gen_random_uuid(), s.machine_id, s.machine_id,
+                   CASE WHEN position('vm-' IN s.machine_id) > 0 THEN 'vps' ELSE 'local' END, TRUE
+            FROM (SELECT DISTINCT machine_id FROM backfill_staging) s
+            ON CONFLICT (machine_id) DO NOTHING
+        """)
+
+        # Новые строки словарей
+        for column, (model, _) in DICTIONARIES.items():
+            cur.execute(f"""
+                INSERT INTO {model.__tablename__} (value)
+                SELECT DISTINCT {column} FROM backfill_staging WHERE {column} IS NOT NULL ORDER BY 1
+                ON CONFLICT (value) DO NOTHING
+            """)
+
+        # Перенос с дедупликацией: внутри файла (DISTINCT ON, остаётся первая
+        # строка) и против уже загруженных строк (uq_activity_events_dedupe).
+        # Clipboard записи и агрегаты (rollups.py) получают только вставленные
+        # события: RETURNING сопоставляется со staging по ключу дедупликации.
+        columns = ", ".join(EVENT_COLUMNS + [id_column for _, id_column in DICTIONARIES.values()])
+        s_columns = ", ".join([f"s.{c}" for c in EVENT_COLUMNS] + [f"d_{c}.id" for c in DICTIONARIES])
+        dict_joins = "\n".join(
+            f"LEFT JOIN {model.__tablename__} d_{c} ON d_{c}.value = s.{c}"
+            for c, (model, _) in DICTIONARIES.items()
+        )
+        cur.execute(f"""
+            WITH source AS (
+                SELECT DISTINCT ON (m.id, s.timestamp, s.agent_type, s.client_event_id)
+                       m.id AS machine_uuid, s.*
+                FROM backfill_staging s
+                JOIN machines m ON m.machine_id = s.machine_id
+                ORDER BY m.id, s.timestamp, s.agent_type, s.client_event_id, s.row_no
+            ),
+            inserted AS (
+                INSERT INTO activity_events (machine_id, {columns})
+                SELECT s.machine_uuid, {s_columns}
+                FROM source s
+                {dict_joins}
+                ON CONFLICT (machine_id, timestamp, agent_type, client_event_id) DO NOTHING
+                RETURNING *
+            ),
+            inserted_blobs AS (
+                INSERT INTO clipboard_blobs (content_hash, content_zlib, size_bytes)
+                SELECT DISTINCT ON (content_hash) content_hash, content_zlib, size_bytes
+                FROM backfill_clipboard_staging
+                ORDER BY content_hash
+                ON CONFLICT (content_hash) DO NOTHING
+            ),
+            inserted_clipboard AS (
+                INSERT INTO clipboard_events (activity_event_id, event_timestamp, action, blob_hash)
+                SELECT i.id, i.timestamp, c.action, c.content_hash
+                FROM inserted i
+                JOIN source s ON s.machine_uuid = i.machine_id
+                             AND s.timestamp = i.timestamp
+                             AND s.agent_type IS NOT DISTINCT FROM i.agent_type
+                             AND s.client_event_id = i.client_event_id
+                JOIN backfill_clipboard_staging c ON c.row_no = s.row_no
+                RETURNING 1
+            ){upsert_ctes_sql("inserted")}
+            SELECT (SELECT count(*) FROM inserted), (SELECT count(*) FROM inserted_clipboard)
+        """)
+        stats["inserted"], stats["clipboard"] = cur.fetchone()
+        stats["duplicates"] = stats["staged"] - stats["inserted"]
+
+    if progress:
+        progress(dict(stats))
+    return stats
+
+
+def load_file(raw_conn, path: str, fmt: Optional[str] = None, machine_id: Optional[str] = None,
+              include_sent: bool = False, progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """Загрузить файл бэклога (см. iter_buffer_events) в activity_events"""
+    events = iter_buffer_events(path, fmt, include_sent=include_sent)
+    return load_events(raw_conn, events, machine_id=machine_id, progress=progress)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill agent buffer into activity_events via COPY")
+    parser.add_argument("path", help="buffer.db, NDJSON or CSV export of its events table")
+    parser.add_argument("--format", choices=BACKFILL_FORMATS, default=None)
+    parser.add_argument("--machine-id", default=None, help="override machine_id of all events")
+    parser.add_argument("--include-sent", action="store_true", help="also load events already marked as sent")
+    args = parser.parse_args()
+
+    from database import engine
+
+    def report(stats):
+        print(f"  read={stats['read']} staged={stats['staged']} invalid={stats['invalid']}", flush=True)
+
+    print(f"Backfilling {args.path}...")
+    raw_conn = engine.raw_connection()
+    try:
+        stats = load_file(raw_conn, args.path, args.format, args.machine_id, args.include_sent, progress=report)
+        raw_conn.commit()
+    except Exception:
+        raw_conn.rollback()
+        raise
+    finally:
+        raw_conn.close()
+
+    print(f"Done: {stats['inserted']} inserted, {stats['duplicates']} duplicates, {stats['invalid']} invalid, "
+          f"{stats['clipboard']} clipboard records")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
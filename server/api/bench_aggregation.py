@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""
+Замер dashboard на синтетическом парке: прежний путь против текущего,
+оба целиком, включая запросы к БД.
+
+  - прежний: события машины за период через ORM (db.query(ActivityEvent),
+    как до rollups.py) и проход Python по каждому событию
+    (legacy_interval_data / legacy_period_data)
+  - текущий: get_fleet_interval_data / get_fleet_period_data из
+    routers/dashboard.py — один запрос fetch_fleet_rollups по агрегатам
+    на весь парк и форматирование в aggregation.py
+
+Данные (activity_events + агрегаты через rollups.rebuild_day) пишутся во
+временную схему базы --database-url, которая удаляется после замера.
+Ответы обоих путей сравниваются (см. compare и tests/test_aggregation.py).
+
+    python bench_aggregation.py --database-url postgresql://... [--machines 100] [--days 30] [--interval 5]
+"""
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from types import SimpleNamespace
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import Session
+
+MINUTES_PER_DAY = 24 * 60
+
+
+# ============ ПРЕЖНИЙ ПУТЬ (проход по событиям) ============
+
+def has_activity(event) -> bool:
+    return ((event.key_count or 0) > 0 or (event.mouse_clicks or 0) > 0
+            or (event.scroll_count or 0) > 0 or (event.mouse_distance_px or 0) > 0)
+
+
+def legacy_interval_data(machine, events, interval_minutes: int):
+    """Дневные графики машины по событиям за сутки (UTC) — как get_interval_data до агрегатов"""
+    if not events:
+        return None
+    intervals_per_day = MINUTES_PER_DAY // interval_minutes
+    data = {i: {'keys': 0, 'clicks': 0, 'distance': 0, 'scroll': 0,
+                'cpu_sum': 0, 'ram_sum': 0, 'cpu_count': 0, 'ram_count': 0}
+            for i in range(intervals_per_day)}
+    total_keys = total_clicks = total_scroll = total_distance = active_minutes = 0
+
+    for event in events:
+        index = min((event.timestamp.hour * 60 + event.timestamp.minute) // interval_minutes, intervals_per_day - 1)
+        data[index]['keys'] += event.key_count or 0
+        data[index]['clicks'] += event.mouse_clicks or 0
+        data[index]['distance'] += event.mouse_distance_px or 0
+        data[index]['scroll'] += event.scroll_count or 0
+        total_keys += event.key_count or 0
+        total_clicks += event.mouse_clicks or 0
+        total_scroll += event.scroll_count or 0
+        total_distance += event.mouse_distance_px or 0
+        if has_activity(event):
+            active_minutes += 1
+            if event.cpu_percent is not None:
+                data[index]['cpu_sum'] += event.cpu_percent
+                data[index]['cpu_count'] += 1
+            if event.ram_used_percent is not None:
+                data[index]['ram_sum'] += event.ram_used_percent
+                data[index]['ram_count'] += 1
+
+    labels = [f"{i * interval_minutes // 60:02d}:{i * interval_minutes % 60:02d}" for i in range(intervals_per_day)]
+    cpu = [round(d['cpu_sum'] / d['cpu_count'], 1) if d['cpu_count'] > 0 else 0 for d in data.values()]
+    ram = [round(d['ram_sum'] / d['ram_count'], 1) if d['ram_count'] > 0 else 0 for d in data.values()]
+
+    def per_min(total):
+        return round(total / active_minutes, 1) if active_minutes > 0 else 0
+
+    return {
+        'machine_id': machine.machine_id,
+        'label': machine.user_label or machine.machine_id,
+        'total_keys': total_keys,
+        'total_clicks': total_clicks,
+        'total_scroll': total_scroll,
+        'total_distance': total_distance,
+        'active_minutes': active_minutes,
+        'active_time_formatted': f"{active_minutes // 60}h {active_minutes % 60}m",
+        'avg_keys_per_min': per_min(total_keys),
+        'avg_clicks_per_min': per_min(total_clicks),
+        'avg_scroll_per_min': per_min(total_scroll),
+        'avg_distance_per_min': per_min(total_distance),
+        'has_resources': any(c > 0 for c in cpu) or any(r > 0 for r in ram),
+        'chart': {
+            'labels': labels,
+            'keys': [d['keys'] for d in data.values()],
+            'clicks': [d['clicks'] for d in data.values()],
+            'distance': [d['distance'] for d in data.values()],
+            'scroll': [d['scroll'] for d in data.values()],
+            'cpu': cpu,
+            'ram': ram,
+        },
+    }
+
+
+def legacy_period_data(machine, events, start_date: date, end_date: date):
+    """Статистика машины по дням периода по событиям — как get_period_data до агрегатов"""
+    if not events:
+        return None
+    days = {}
+    current = start_date
+    while current <= end_date:
+        days[current.isoformat()] = {'keys': 0, 'clicks': 0, 'scroll': 0, 'distance': 0, 'active': 0,
+                                     'cpu_sum': 0, 'cpu_count': 0, 'ram_sum': 0, 'ram_count': 0}
+        current += timedelta(days=1)
+
+    for event in events:
+        d = days.get(event.timestamp.date().isoformat())
+        if d is None:
+            continue
+        d['keys'] += event.key_count or 0
+        d['clicks'] += event.mouse_clicks or 0
+        d['scroll'] += event.scroll_count or 0
+        d['distance'] += event.mouse_distance_px or 0
+        if has_activity(event):
+            d['active'] += 1
+            if event.cpu_percent is not None:
+                d['cpu_sum'] += event.cpu_percent
+                d['cpu_count'] += 1
+            if event.ram_used_percent is not None:
+                d['ram_sum'] += event.ram_used_percent
+                d['ram_count'] += 1
+
+    daily_stats = []
+    for day_key, d in days.items():
+        active = d['active']
+
+        def per_min(total):
+            return round(total / active, 1) if active > 0 else 0
+
+        daily_stats.append({
+            'date': day_key,
+            'total_keys': d['keys'],
+            'total_clicks': d['clicks'],
+            'total_scroll': d['scroll'],
+            'total_distance': d['distance'],
+            'active_time': f"{active // 60}h {active % 60}m",
+            'active_minutes': active,
+            'avg_keys': per_min(d['keys']),
+            'avg_clicks': per_min(d['clicks']),
+            'avg_scroll': per_min(d['scroll']),
+            'avg_distance': per_min(d['distance']),
+            'avg_cpu': round(d['cpu_sum'] / d['cpu_count'], 1) if d['cpu_count'] > 0 else 0,
+            'avg_ram': round(d['ram_sum'] / d['ram_count'], 1) if d['ram_count'] > 0 else 0,
+        })
+    return {'machine_id': machine.machine_id, 'label': machine.user_label or machine.machine_id,
+            'daily_stats': daily_stats}
+
+
+# ============ СИНТЕТИЧЕСКИЕ ДАННЫЕ ============
+
+def synthetic_events(rng: random.Random, day: date):
+    """Поминутные события машины за сутки (UTC): простои, активность, пропуски CPU/RAM"""
+    start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    for minute in range(MINUTES_PER_DAY):
+        if rng.random() < 0.1:
+            continue  # агент не работал
+        active = rng.random() < 0.6
+        yield SimpleNamespace(
+            timestamp=start + timedelta(minutes=minute),
+            key_count=rng.randint(0, 120) if active else 0,
+            mouse_clicks=rng.randint(0, 30) if active else 0,
+            mouse_distance_px=rng.randint(0, 5000) if active else 0,
+            scroll_count=rng.randint(0, 20) if active else 0,
+            is_idle=not active,
+            cpu_percent=round(rng.uniform(0, 100), 1) if rng.random() < 0.95 else None,
+            ram_used_percent=round(rng.uniform(20, 90), 1) if rng.random() < 0.95 else None,
+        )
+
+
+# ============ ЗАМЕР ============
+
+EVENT_COLUMNS = ("machine_id", "timestamp", "key_count", "mouse_clicks", "mouse_distance_px", "scroll_count",
+                 "is_idle", "cpu_percent", "ram_used_percent", "agent_type", "client_event_id")
+
+
+def _csv(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def seed(engine, machines, days, rng):
+    """activity_events через COPY, затем агрегаты rollups.rebuild_day"""
+    from database import Base
+    from partitions import create_period, ensure_default_partitions, period_floor
+    from rollups import rebuild_day
+    from models import Machine
+
+    with engine.begin() as conn:
+        Base.metadata.create_all(conn)
+        ensure_default_partitions(conn)
+        for month in sorted({period_floor(datetime.combine(d, datetime.min.time(), tzinfo=timezone.utc), "month")
+                             for d in days}):
+            create_period(conn, month, "month")
+        conn.execute(Machine.__table__.insert(), [
+            {"id": m.id, "machine_id": m.machine_id, "user_label": m.user_label, "is_active": True} for m in machines
+        ])
+
+    raw = engine.raw_connection()
+    try:
+        with raw.cursor() as cur:
+            for m in machines:
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                for day in days:
+                    for e in synthetic_events(rng, day):
+                        writer.writerow([_csv(v) for v in (
+                            str(m.id), e.timestamp, e.key_count, e.mouse_clicks, e.mouse_distance_px, e.scroll_count,
+                            e.is_idle, e.cpu_percent, e.ram_used_percent, "desktop", "",
+                        )])
+                buf.seek(0)
+                cur.copy_expert(
+                    f"COPY activity_events ({', '.join(EVENT_COLUMNS)}) FROM STDIN "
+                    f"WITH (FORMAT csv, FORCE_NOT_NULL (client_event_id))", buf)
+        raw.commit()
+    finally:
+        raw.close()
+
+    for day in days:
+        with engine.begin() as conn:
+            rebuild_day(conn, day)
+    with engine.begin() as conn:
+        conn.execute(text("ANALYZE"))
+
+
+def legacy_run(engine, machines, target_date, start_date, end_date, interval):
+    """Прежний путь: события каждой машины через ORM и проход по ним"""
+    from models import ActivityEvent
+
+    def events(db, m, first: date, last: date):
+        return db.query(ActivityEvent).filter(
+            ActivityEvent.machine_id == m.id,
+            ActivityEvent.timestamp >= datetime.combine(first, datetime.min.time()),
+            ActivityEvent.timestamp <= datetime.combine(last, datetime.max.time()),
+        ).all()
+
+    with Session(engine) as db:
+        t0 = time.perf_counter()
+        daily = [legacy_interval_data(m, events(db, m, target_date, target_date), interval) for m in machines]
+        daily_sec = time.perf_counter() - t0
+        db.expunge_all()
+
+        t0 = time.perf_counter()
+        period = [legacy_period_data(m, events(db, m, start_date, end_date), start_date, end_date) for m in machines]
+        period_sec = time.perf_counter() - t0
+    return [d for d in daily if d], [p for p in period if p], daily_sec, period_sec
+
+
+async def current_run(async_engine, machines, target_date, start_date, end_date, interval):
+    """Текущий путь: роутерные функции dashboard поверх агрегатов"""
+    from routers.dashboard import get_fleet_interval_data, get_fleet_period_data
+
+    async with AsyncSession(async_engine) as db:
+        t0 = time.perf_counter()
+        daily = await get_fleet_interval_data(db, machines, target_date, interval)
+        daily_sec = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        period = await get_fleet_period_data(db, machines, start_date, end_date)
+        period_sec = time.perf_counter() - t0
+    return daily, period, daily_sec, period_sec
+
+
+def compare(old_daily, new_daily, old_period, new_period):
+    """
+    Сравнение ответов: всё, кроме средних CPU/RAM, должно совпасть точно.
+    Средние на границе округления (x.x5) могут разойтись на 0.1 из-за
+    порядка сложения float — возвращается их число.
+    """
+    old_daily, new_daily, old_period, new_period = (
+        json.loads(json.dumps(v)) for v in (old_daily, new_daily, old_period, new_period))
+    averages = []
+    for old, new in zip(old_daily, new_daily):
+        for key in ("cpu", "ram"):
+            averages += zip(old["chart"].pop(key), new["chart"].pop(key))
+    for old, new in zip(old_period, new_period):
+        for old_day, new_day in zip(old["daily_stats"], new["daily_stats"]):
+            for key in ("avg_cpu", "avg_ram"):
+                averages.append((old_day.pop(key), new_day.pop(key)))
+    boundary = sum(1 for a, b in averages if a != b)
+    same = (old_daily == new_daily and old_period == new_period
+            and all(abs(a - b) < 0.1 + 1e-9 for a, b in averages))
+    return same, boundary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dashboard aggregation: per-event path vs rollups")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="scratch Postgres (a temporary schema is created and dropped)")
+    parser.add_argument("--machines", type=int, default=100)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--interval", type=int, default=5, help="daily chart interval, minutes")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error("--database-url (or BENCH_DATABASE_URL) is required: both paths are timed with their queries")
+
+    rng = random.Random(args.seed)
+    machines = [SimpleNamespace(id=uuid.UUID(int=i + 1), machine_id=f"vm-bench-{i:03d}", user_label=None)
+                for i in range(args.machines)]
+    start_date = date(2025, 1, 1)
+    end_date = start_date + timedelta(days=args.days - 1)
+    days = [start_date + timedelta(days=i) for i in range(args.days)]
+
+    schema = f"bench_{uuid.uuid4().hex[:12]}"
+    url = make_url(args.database_url)
+    admin = create_engine(url)
+    with admin.begin() as conn:
+        conn.execute(text(f"CREATE SCHEMA {schema}"))
+    engine = create_engine(url, connect_args={"options": f"-csearch_path={schema} -ctimezone=UTC"})
+    async_engine = create_async_engine(
+        url.set(drivername="postgresql+asyncpg"),
+        connect_args={"server_settings": {"search_path": schema, "timezone": "UTC"}},
+    )
+    try:
+        t0 = time.perf_counter()
+        seed(engine, machines, days, rng)
+        print(f"{args.machines} machines x {args.days} days seeded in {time.perf_counter() - t0:.1f}s")
+
+        old_daily, old_period, old_daily_sec, old_period_sec = legacy_run(
+            engine, machines, end_date, start_date, end_date, args.interval)
+        new_daily, new_period, new_daily_sec, new_period_sec = asyncio.run(current_run(
+            async_engine, machines, end_date, start_date, end_date, args.interval))
+
+        same, boundary = compare(old_daily, new_daily, old_period, new_period)
+        print(f"{'':<34}{'per-event':>12}{'rollups':>12}")
+        print(f"{f'daily page, {args.interval}-minute chart':<34}{old_daily_sec * 1000:10.1f}ms{new_daily_sec * 1000:10.1f}ms")
+        print(f"{f'period page, {args.days} days':<34}{old_period_sec * 1000:10.1f}ms{new_period_sec * 1000:10.1f}ms")
+        print(f"identical output: {same} (CPU/RAM averages off by 0.1 on a rounding boundary: {boundary})")
+        return 0 if same else 1
+    finally:
+        asyncio.run(async_engine.dispose())
+        engine.dispose()
+        with admin.begin() as conn:
+            conn.execute(text(f"DROP SCHEMA {schema} CASCADE"))
+        admin.dispose()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
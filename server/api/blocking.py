@@ -0,0 +1,27 @@
+"""
+Ограниченный пул потоков для блокирующих вызовов из async роутов.
+
+boto3, requests, fsync спула и COPY через psycopg2 не умеют asyncio.
+Выполнять их прямо в роуте нельзя — встанет весь event loop uvicorn,
+а стандартный executor loop'а не ограничен по смыслу нагрузки.
+Поэтому все такие вызовы идут через run_blocking с BLOCKING_POOL_SIZE потоками.
+"""
+
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+BLOCKING_POOL_SIZE = int(os.getenv("BLOCKING_POOL_SIZE", "16"))
+
+_executor = ThreadPoolExecutor(max_workers=BLOCKING_POOL_SIZE, thread_name_prefix="blocking")
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Выполнить fn(*args, **kwargs) в пуле, не блокируя event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+def shutdown():
+    _executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,223 @@
+"""
+Сжатые и бинарные тела запросов для ingest эндпоинтов.
+
+DecodedBodyRoute понимает:
+  - Content-Encoding: gzip / deflate / zstd
+  - Content-Type: application/msgpack (или application/x-msgpack)
+
+Тело распаковывается с ограничением размера (защита от zip-бомб), MessagePack
+декодируется в те же dict/list, что и JSON, поэтому валидация идёт теми же
+pydantic схемами (EventsBatch, TelemetryBatch) без изменений в роутах.
+
+Для потоковых роутов (NDJSON) есть iter_decoded_stream/iter_lines —
+распаковка кусками не больше STREAM_CHUNK_BYTES и разбиение на строки
+без буферизации всего тела (общий объём ограничен MAX_STREAM_BODY_MB).
+"""
+
+import io
+import os
+import zlib
+from typing import AsyncIterator, Iterator
+
+import msgpack
+import zstandard
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+# Максимальный размер тела после распаковки
+MAX_DECODED_BODY_MB = int(os.getenv("MAX_DECODED_BODY_MB", "32"))
+MAX_DECODED_BODY_BYTES = MAX_DECODED_BODY_MB * 1024 * 1024
+
+# Потоковые роуты: общий объём после распаковки и размер выдаваемого куска
+MAX_STREAM_BODY_MB = int(os.getenv("MAX_STREAM_BODY_MB", "1024"))
+MAX_STREAM_BODY_BYTES = MAX_STREAM_BODY_MB * 1024 * 1024
+STREAM_CHUNK_BYTES = 64 * 1024
+# zstd не умеет max_length: вход подаётся ломтями, а один блок RLE (4 байта)
+# разворачивается максимум в 128KB, поэтому ломоть 64 байта даёт не больше ~2MB
+ZSTD_INPUT_SLICE_BYTES = 64
+
+MSGPACK_CONTENT_TYPES = {"application/msgpack", "application/x-msgpack", "application/vnd.msgpack"}
+SUPPORTED_ENCODINGS = {"gzip", "x-gzip", "deflate", "zstd"}
+
+
+def _too_large(limit_mb: int = MAX_DECODED_BODY_MB):
+    return HTTPException(status_code=413, detail=f"Decoded body exceeds {limit_mb}MB")
+
+
+def decompress_body(data: bytes, encoding: str, limit: int = MAX_DECODED_BODY_BYTES) -> bytes:
+    """Распаковать тело, не выделяя больше limit байт"""
+    encoding = encoding.strip().lower()
+
+    if encoding in ("", "identity"):
+        if len(data) > limit:
+            raise _too_large()
+        return data
+
+    if encoding in ("gzip", "x-gzip", "deflate"):
+        wbits = 16 + zlib.MAX_WBITS if encoding != "deflate" else zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits=wbits)
+        try:
+            out = decompressor.decompress(data, limit + 1)
+        except zlib.error as e:
+            raise HTTPException(status_code=400, detail=f"Invalid {encoding} body: {e}")
+        if len(out) > limit or decompressor.unconsumed_tail:
+            raise _too_large()
+        return out
+
+    if encoding == "zstd":
+        try:
+            with zstandard.ZstdDecompressor().stream_reader(io.BytesIO(data)) as reader:
+                out = reader.read(limit + 1)
+        except zstandard.ZstdError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid zstd body: {e}")
+        if len(out) > limit:
+            raise _too_large()
+        return out
+
+    raise HTTPException(
+        status_code=415,
+        detail=f"Unsupported Content-Encoding: {encoding}. Allowed: {sorted(SUPPORTED_ENCODINGS)}"
+    )
+
+
+def decode_msgpack(data: bytes):
+    """MessagePack -> dict/list (Timestamp extension -> datetime)"""
+    try:
+        return msgpack.unpackb(data, raw=False, timestamp=3)
+    except (msgpack.UnpackException, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid msgpack body: {e}")
+
+
+def _zlib_pieces(decompressor, data: bytes) -> Iterator[bytes]:
+    """Распаковать data кусками не больше STREAM_CHUNK_BYTES"""
+    while data:
+        out = decompressor.decompress(data, STREAM_CHUNK_BYTES)
+        data = decompressor.unconsumed_tail
+        if out:
+            yield out
+
+
+def _zstd_pieces(decompressor, data: bytes) -> Iterator[bytes]:
+    """Распаковать data ломтями входа (см. ZSTD_INPUT_SLICE_BYTES)"""
+    for offset in range(0, len(data), ZSTD_INPUT_SLICE_BYTES):
+        out = decompressor.decompress(data[offset:offset + ZSTD_INPUT_SLICE_BYTES])
+        if out:
+            yield out
+
+
+async def iter_decoded_stream(request: Request, limit: int = MAX_STREAM_BODY_BYTES) -> AsyncIterator[bytes]:
+    """
+    Потоковая распаковка тела запроса по Content-Encoding.
+    В памяти одновременно не больше одного распакованного куска;
+    больше limit байт после распаковки — 413.
+    """
+    encoding = request.headers.get("content-encoding", "").strip().lower()
+
+    if encoding in ("", "identity"):
+        pieces = None
+    elif encoding in ("gzip", "x-gzip", "deflate"):
+        wbits = 16 + zlib.MAX_WBITS if encoding != "deflate" else zlib.MAX_WBITS
+        decompressor = zlib.decompressobj(wbits=wbits)
+        pieces = _zlib_pieces
+        error = zlib.error
+    elif encoding == "zstd":
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        pieces = _zstd_pieces
+        error = zstandard.ZstdError
+    else:
+        raise HTTPException(
+            status_code=415,
+            detail=f"Unsupported Content-Encoding: {encoding}. Allowed: {sorted(SUPPORTED_ENCODINGS)}"
+        )
+
+    total = 0
+
+    def counted(piece: bytes) -> bytes:
+        nonlocal total
+        total += len(piece)
+        if total > limit:
+            raise _too_large(limit // (1024 * 1024))
+        return piece
+
+    if pieces is None:
+        async for chunk in request.stream():
+            if chunk:
+                yield counted(chunk)
+        return
+
+    try:
+        async for chunk in request.stream():
+            for piece in pieces(decompressor, chunk):
+                yield counted(piece)
+        if encoding != "zstd":
+            tail = decompressor.flush()
+            if tail:
+                yield counted(tail)
+    except error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid {encoding} body: {e}")
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_line_bytes: int) -> AsyncIterator[bytes]:
+    """Разбить поток байт на строки (NDJSON), не держа в памяти больше одной строки"""
+    pending = bytearray()
+    async for chunk in chunks:
+        start = 0
+        while True:
+            end = chunk.find(b"\n", start)
+            # Длина проверяется до склейки: строка-бомба не попадает в pending
+            if len(pending) + ((end if end >= 0 else len(chunk)) - start) > max_line_bytes:
+                raise HTTPException(status_code=413, detail=f"NDJSON line exceeds {max_line_bytes} bytes")
+            if end < 0:
+                pending += chunk[start:]
+                break
+            pending += chunk[start:end]
+            yield bytes(pending)
+            pending.clear()
+            start = end + 1
+    if pending:
+        yield bytes(pending)
+
+
+def _media_type(content_type: str) -> str:
+    return content_type.split(";")[0].strip().lower()
+
+
+class DecodedBodyRoute(APIRoute):
+    """
+    APIRoute, распаковывающий тело до того, как FastAPI начнёт его парсить.
+    Обычные JSON запросы без Content-Encoding проходят без изменений.
+    """
+
+    def get_route_handler(self):
+        original_handler = super().get_route_handler()
+        if self.body_field is None:
+            # Роут без body параметров читает request.stream() сам
+            # (см. iter_decoded_stream), буферизовать тело нельзя
+            return original_handler
+
+        async def decoding_handler(request: Request):
+            encoding = request.headers.get("content-encoding", "")
+            is_msgpack = _media_type(request.headers.get("content-type", "")) in MSGPACK_CONTENT_TYPES
+
+            if encoding.strip().lower() in ("", "identity") and not is_msgpack:
+                return await original_handler(request)
+
+            body = decompress_body(await request.body(), encoding)
+
+            # Для FastAPI тело выглядит как уже распакованный JSON
+            dropped = {b"content-encoding", b"content-length"}
+            if is_msgpack:
+                dropped.add(b"content-type")
+            headers = [(name, value) for name, value in request.scope["headers"] if name not in dropped]
+            if is_msgpack:
+                headers.append((b"content-type", b"application/json"))
+            headers.append((b"content-length", str(len(body)).encode()))
+
+            decoded = Request({**request.scope, "headers": headers}, request.receive)
+            decoded._body = body
+            if is_msgpack:
+                decoded._json = decode_msgpack(body)
+
+            return await original_handler(decoded)
+
+        return decoding_handler
@@ -0,0 +1,284 @@
+"""
+Пакетная запись событий активности.
+
+Вместо SELECT/INSERT/flush на каждое событие вся пачка пишется
+фиксированным числом запросов:
+  1. один upsert машин (INSERT ... ON CONFLICT) для machine_id, которых нет в кэше
+  2. по одному upsert на словарь строк для значений, которых нет в кэше (см. string_dict.py)
+     и один multi-row INSERT activity_events ... ON CONFLICT DO NOTHING RETURNING id
+  3. блобы clipboard (SELECT существующих + INSERT новых, см. clipboard_store.py)
+     и один INSERT clipboard_events для всех дочерних записей
+  4. по одному upsert на таблицу агрегатов для вставленных событий (см. rollups.py)
+"""
+
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+from uuid import UUID
+
+from sqlalchemy import event, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from models import Machine, ActivityEvent, ClipboardEvent
+from machine_cache import machine_cache, MISSING
+from heartbeat import heartbeats
+from clipboard_store import store_blobs
+from string_dict import intern_rows
+from rollups import apply_rows as apply_rollups
+from schemas import ActivityEventCreate, ClipboardItem, ExtensionSessionEvent
+
+# Session.info: машины, созданные в текущей (ещё не закоммиченной) транзакции
+PENDING_MACHINES_KEY = "pending_machines"
+
+
+def guess_machine_type(machine_id: str) -> str:
+    """Тип машины по умолчанию для автосозданной записи"""
+    return "vps" if "vm-" in machine_id else "local"
+
+
+def resolve_machines(db: Session, machines: Dict[str, dict]) -> Dict[str, UUID]:
+    """
+    Найти или создать машины.
+
+    machines: {machine_id: {"machine_type": ..., "user_label": ...}}
+    Возвращает {machine_id: Machine.id}. Известные машины берутся из
+    machine_cache, остальные резолвятся одним upsert запросом.
+    """
+    resolved = {}
+    unknown = {}
+    pending = db.info.get(PENDING_MACHINES_KEY, {})
+    for machine_id, attrs in machines.items():
+        cached = pending.get(machine_id) or machine_cache.get(machine_id)
+        if cached is MISSING or cached is None:
+            unknown[machine_id] = attrs
+        else:
+            resolved[machine_id] = cached
+
+    if not unknown:
+        return resolved
+
+    values = [
+        {
+            "machine_id": machine_id,
+            "user_label": attrs.get("user_label") or machine_id,
+            "machine_type": attrs.get("machine_type") or guess_machine_type(machine_id),
+            "is_active": True,
+        }
+        # Стабильный порядок строк = стабильный порядок блокировок, без дедлоков
+        for machine_id, attrs in sorted(unknown.items())
+    ]
+
+    stmt = pg_insert(Machine).values(values)
+    # DO UPDATE (а не DO NOTHING), чтобы RETURNING вернул и уже существующие строки.
+    # Параллельные запросы с одним machine_id больше не ловят unique violation.
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Machine.machine_id],
+        set_={"machine_id": stmt.excluded.machine_id},
+    ).returning(Machine.machine_id, Machine.id)
+
+    created = {row.machine_id: row.id for row in db.execute(stmt)}
+    # В кэш попадут только после commit (см. _publish_pending_machines),
+    # чтобы UUID из кэша всегда указывал на существующую строку
+    db.info.setdefault(PENDING_MACHINES_KEY, {}).update(created)
+    resolved.update(created)
+
+    return resolved
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending_machines(session: Session):
+    for machine_id, machine_uuid in session.info.pop(PENDING_MACHINES_KEY, {}).items():
+        machine_cache.put(machine_id, machine_uuid)
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending_machines(session: Session):
+    session.info.pop(PENDING_MACHINES_KEY, None)
+
+
+def touch_machines(db: Session, machine_uuids: Iterable[UUID]):
+    """Отметить машины, приславшие данные (last_seen_at пишется пачкой, см. heartbeat.py)"""
+    heartbeats.touch(machine_uuids)
+
+
+def agent_event_row(event: ActivityEventCreate, machine_uuid: UUID) -> dict:
+    """Строка activity_events из события desktop агента"""
+    return {
+        "machine_id": machine_uuid,
+        "timestamp": utc_timestamp(event.timestamp),
+        "client_event_id": event.client_event_id or "",
+        "key_count": event.key_count,
+        "mouse_clicks": event.mouse_clicks,
+        "mouse_distance_px": event.mouse_distance_px,
+        "scroll_count": event.scroll_count,
+        "active_window": event.active_window,
+        "active_app": event.active_app,
+        "is_idle": event.is_idle,
+        "active_url": event.active_url,
+        "active_domain": event.active_domain,
+        "tab_switches_count": event.tab_switches_count,
+        "cpu_percent": event.cpu_percent,
+        "ram_used_percent": event.ram_used_percent,
+        "disk_used_percent": event.disk_used_percent,
+        "agent_type": event.agent_type,
+        "duration_seconds": event.duration_seconds,
+        "focus_time_sec": event.focus_time_sec,
+        "copy_count": event.copy_count,
+        "paste_count": event.paste_count,
+        "keys_packed": event.keys_packed,
+        "mouse_avg_speed": event.mouse_avg_speed,
+        "extension_version": None,
+    }
+
+
+def extension_event_row(item: ExtensionSessionEvent, machine_uuid: UUID) -> dict:
+    """Строка activity_events из сессии браузерного расширения"""
+    return {
+        "machine_id": machine_uuid,
+        "timestamp": utc_timestamp(item.start_ts),
+        "client_event_id": item.client_event_id or "",
+        "key_count": item.keypresses,
+        "mouse_clicks": item.clicks,
+        "mouse_distance_px": item.mouse_px,
+        "scroll_count": item.scroll_px,
+        "active_window": item.window_title or item.domain,
+        "active_app": "Google Chrome",
+        "is_idle": item.is_idle,
+        "active_url": item.url,
+        "active_domain": item.domain,
+        "tab_switches_count": None,
+        "cpu_percent": None,
+        "ram_used_percent": None,
+        "disk_used_percent": None,
+        "agent_type": "extension",
+        "duration_seconds": item.duration_sec,
+        "focus_time_sec": item.focus_time_sec,
+        "copy_count": item.copy_count,
+        "paste_count": item.paste_count,
+        "keys_packed": item.keys_packed,
+        "mouse_avg_speed": item.mouse_avg_speed,
+        "extension_version": item.extension_version,
+    }
+
+
+def utc_timestamp(ts: datetime) -> datetime:
+    """Агенты шлют naive UTC (datetime.utcnow()), приводим к aware"""
+    return ts.replace(tzinfo=timezone.utc) if ts.tzinfo is None else ts
+
+
+def dedupe_key(machine_uuid: UUID, timestamp: datetime, agent_type: Optional[str], client_event_id: str) -> tuple:
+    """Ключ уникального индекса uq_activity_events_dedupe"""
+    return (machine_uuid, timestamp, agent_type, client_event_id)
+
+
+def insert_events(
+    db: Session,
+    rows: List[dict],
+    clipboards: List[Optional[List[ClipboardItem]]],
+) -> Tuple[int, int, int]:
+    """
+    Вставить события и их clipboard history, пропуская дубликаты.
+
+    clipboards[i] относится к rows[i].
+    Возвращает (вставлено событий, дубликатов, вставлено clipboard записей).
+    """
+    if not rows:
+        return 0, 0, 0
+
+    # Одно и то же событие дважды в одной пачке (ретрай внутри буфера агента):
+    # в БД и в агрегаты попадает только первая копия
+    unique_rows = []
+    unique_clipboards = []
+    seen = set()
+    for row, clip_items in zip(rows, clipboards):
+        key = dedupe_key(row["machine_id"], row["timestamp"], row["agent_type"], row["client_event_id"])
+        if key in seen:
+            continue
+        seen.add(key)
+        unique_rows.append(row)
+        unique_clipboards.append(clip_items)
+    total = len(rows)
+    rows, clipboards = unique_rows, unique_clipboards
+
+    intern_rows(db, rows)
+
+    # executemany + RETURNING: SQLAlchemy 2.0 склеивает это в multi-row VALUES.
+    # Повторно присланные события (ретрай после потерянного ответа) молча
+    # пропускаются уникальным индексом и не попадают в RETURNING.
+    stmt = pg_insert(ActivityEvent).on_conflict_do_nothing(
+        index_elements=["machine_id", "timestamp", "agent_type", "client_event_id"],
+    ).returning(
+        ActivityEvent.id, ActivityEvent.machine_id, ActivityEvent.timestamp,
+        ActivityEvent.agent_type, ActivityEvent.client_event_id,
+    )
+    inserted = {
+        dedupe_key(r.machine_id, r.timestamp, r.agent_type, r.client_event_id): r.id
+        for r in db.execute(stmt, rows)
+    }
+    inserted_count = len(inserted)
+
+    clipboard_items = []
+    inserted_rows = []
+    for row, clip_items in zip(rows, clipboards):
+        # pop: каждый вставленный id достаётся ровно одной строке пачки
+        event_id = inserted.pop(dedupe_key(row["machine_id"], row["timestamp"], row["agent_type"], row["client_event_id"]), None)
+        if event_id is None:
+            continue
+        inserted_rows.append(row)
+        if not clip_items:
+            continue
+        clipboard_items.extend((event_id, row["timestamp"], clip) for clip in clip_items)
+
+    clipboard_rows = []
+    if clipboard_items:
+        blob_hashes = store_blobs(db, {clip.text for _, _, clip in clipboard_items})
+        clipboard_rows = [
+            {
+                "activity_event_id": event_id,
+                "event_timestamp": event_timestamp,
+                "action": clip.action,
+                "blob_hash": blob_hashes[clip.text],
+            }
+            for event_id, event_timestamp, clip in clipboard_items
+        ]
+        db.execute(insert(ClipboardEvent), clipboard_rows)
+
+    apply_rollups(db, inserted_rows)
+
+    return inserted_count, total - inserted_count, len(clipboard_rows)
+
+
+def ingest_agent_events(db: Session, events: Iterable[ActivityEventCreate]) -> dict:
+    """Записать пачку событий desktop агентов (без commit)"""
+    events = list(events)
+    machine_ids = resolve_machines(db, {
+        e.machine_id: {"machine_type": guess_machine_type(e.machine_id)}
+        for e in events
+    })
+
+    touch_machines(db, machine_ids.values())
+
+    rows = [agent_event_row(e, machine_ids[e.machine_id]) for e in events]
+    inserted, duplicates, clipboard_count = insert_events(db, rows, [e.clipboard_history for e in events])
+
+    return {"processed": len(rows), "inserted": inserted, "duplicates": duplicates, "saved_clipboard": clipboard_count}
+
+
+def ingest_extension_events(db: Session, machine_uuid: UUID, events: Iterable[ExtensionSessionEvent]) -> dict:
+    """Записать пачку сессий расширения для одной машины (без commit)"""
+    events = list(events)
+    rows = [extension_event_row(e, machine_uuid) for e in events]
+    saved, duplicates, clipboard_count = insert_events(db, rows, [e.clipboard_history for e in events])
+
+    return {"saved_events": saved, "duplicates": duplicates, "saved_clipboard": clipboard_count}
+
+
+def ingest_telemetry_events(db: Session, email: str, events: Iterable[ExtensionSessionEvent]) -> dict:
+    """Машина расширения (upsert по email) + её сессии (без commit)"""
+    machine_uuid = resolve_machines(db, {email: {
+        "machine_type": "browser_extension",
+        "user_label": f"Extension: {email}",
+    }})[email]
+    touch_machines(db, [machine_uuid])
+
+    return ingest_extension_events(db, machine_uuid, events)
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""
+Контентно-адресуемое хранение clipboard history.
+
+Один и тот же фрагмент копируется много раз, поэтому текст хранится
+один раз в clipboard_blobs (ключ — sha256 исходного текста, значение
+сжато zlib), а clipboard_events ссылаются на него через blob_hash.
+
+Пачка записывается так:
+  1. хэши, уже известные процессу (KnownHashes), пропускаются сразу
+  2. остальные проверяются одним SELECT по clipboard_blobs
+  3. отсутствующие вставляются одним INSERT ... ON CONFLICT DO NOTHING
+
+Старые строки с clipboard_events.content переносятся в блобы командой:
+    python clipboard_store.py migrate
+"""
+
+import hashlib
+import logging
+import os
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import event, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from models import ClipboardBlob
+
+logger = logging.getLogger(__name__)
+
+CLIPBOARD_ZLIB_LEVEL = int(os.getenv("CLIPBOARD_ZLIB_LEVEL", "6"))
+# Сколько хэшей уже сохранённых блобов помнить в процессе
+CLIPBOARD_KNOWN_HASHES = int(os.getenv("CLIPBOARD_KNOWN_HASHES", "50000"))
+
+MIGRATE_BATCH_ROWS = 5000
+
+# Session.info: блобы, вставленные в текущей (ещё не закоммиченной) транзакции
+PENDING_HASHES_KEY = "pending_clipboard_hashes"
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def compress_content(content: str) -> bytes:
+    return zlib.compress(content.encode("utf-8"), CLIPBOARD_ZLIB_LEVEL)
+
+
+def decompress_content(data: bytes) -> str:
+    return zlib.decompress(data).decode("utf-8")
+
+
+class KnownHashes:
+    """LRU множество хэшей, которые точно есть в clipboard_blobs"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def filter_unknown(self, hashes: Iterable[str]) -> List[str]:
+        unknown = []
+        with self._lock:
+            for h in hashes:
+                if h in self._items:
+                    self._items.move_to_end(h)
+                else:
+                    unknown.append(h)
+        return unknown
+
+    def add(self, hashes: Iterable[str]):
+        with self._lock:
+            for h in hashes:
+                self._items[h] = None
+                self._items.move_to_end(h)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+known_hashes = KnownHashes(CLIPBOARD_KNOWN_HASHES)
+
+
+def store_blobs(db: Session, contents: Iterable[str]) -> Dict[str, str]:
+    """
+    Сохранить тексты в clipboard_blobs (без commit).
+    Возвращает {текст: blob_hash}.
+    """
+    hashes = {content: content_hash(content) for content in contents}
+    if not hashes:
+        return {}
+
+    by_hash = {h: content for content, h in hashes.items()}
+    unknown = known_hashes.filter_unknown(by_hash)
+    if unknown:
+        existing = set(db.execute(
+            select(ClipboardBlob.content_hash).where(ClipboardBlob.content_hash.in_(unknown))
+        ).scalars())
+        missing = sorted(h for h in unknown if h not in existing)
+        if missing:
+            rows = [
+                {
+                    "content_hash": h,
+                    "content_zlib": compress_content(by_hash[h]),
+                    "size_bytes": len(by_hash[h].encode("utf-8")),
+                }
+                for h in missing
+            ]
+            # Параллельная транзакция могла вставить тот же блоб
+            db.execute(pg_insert(ClipboardBlob).on_conflict_do_nothing(index_elements=["content_hash"]), rows)
+        # Хэши, вставленные в этой транзакции, станут "известными" только после
+        # commit — иначе после rollback в кэше остался бы несуществующий блоб
+        db.info.setdefault(PENDING_HASHES_KEY, set()).update(missing)
+        known_hashes.add(existing)
+
+    return hashes
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending_hashes(session: Session):
+    known_hashes.add(session.info.pop(PENDING_HASHES_KEY, ()))
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending_hashes(session: Session):
+    session.info.pop(PENDING_HASHES_KEY, None)
+
+
+# ============ МИГРАЦИЯ СТАРЫХ СТРОК ============
+
+def migrate_legacy_content(conn, batch_rows: int = MIGRATE_BATCH_ROWS) -> Tuple[int, int]:
+    """
+    Перенести clipboard_events.content в clipboard_blobs пачками.
+    Каждая пачка — отдельная транзакция, прерванную миграцию можно продолжить.
+    Занятые другими транзакциями строки ждутся (без SKIP LOCKED), чтобы
+    пустая выборка означала конец миграции.
+    Возвращает (перенесено строк, создано блобов).
+    """
+    moved = 0
+    created = 0
+    while True:
+        with conn.begin():
+            rows = conn.execute(text("""
+                SELECT id, content FROM clipboard_events
+                WHERE blob_hash IS NULL AND content IS NOT NULL
+                ORDER BY id
+                LIMIT :limit
+                FOR UPDATE
+            """), {"limit": batch_rows}).all()
+            if not rows:
+                return moved, created
+
+            blobs = {}
+            updates = []
+            for row in rows:
+                h = content_hash(row.content)
+                blobs.setdefault(h, row.content)
+                updates.append({"row_id": row.id, "blob_hash": h})
+
+            result = conn.execute(
+                pg_insert(ClipboardBlob)
+                .on_conflict_do_nothing(index_elements=["content_hash"])
+                .returning(ClipboardBlob.content_hash),
+                [
+                    {"content_hash": h, "content_zlib": compress_content(c), "size_bytes": len(c.encode("utf-8"))}
+                    for h, c in sorted(blobs.items())
+                ],
+            )
+            created += len(result.all())
+            conn.execute(
+                text("UPDATE clipboard_events SET blob_hash = :blob_hash, content = NULL WHERE id = :row_id"),
+                updates,
+            )
+            moved += len(rows)
+        logger.info(f"Clipboard migration: {moved} rows moved, {created} blobs created")
+
+
+def main():
+    if sys.argv[1:] != ["migrate"]:
+        print(f"Usage: {sys.argv[0]} migrate")
+        return 2
+
+    from database import engine
+
+    with engine.connect() as conn:
+        moved, created = migrate_legacy_content(conn)
+    print(f"Done: {moved} clipboard rows moved into {created} new blobs")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,172 @@
+"""
+Проверка Google OAuth access token расширения через tokeninfo.
+
+Раньше каждый /handshake, /telemetry и /screenshot ходил в Google
+синхронным requests.get без переиспользования соединений. Теперь:
+  - результат кэшируется по sha256 токена, TTL не больше expires_in токена
+  - одновременные проверки одного токена сливаются в один запрос (single-flight)
+  - запросы идут через общий httpx.AsyncClient с пулом соединений
+
+GOOGLE_TOKENINFO_URL позволяет подменить Google локальной заглушкой
+(см. tokeninfo_stub.py).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import httpx
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_TOKENINFO_URL = os.getenv("GOOGLE_TOKENINFO_URL", "https://oauth2.googleapis.com/tokeninfo")
+GOOGLE_TOKENINFO_TIMEOUT_SEC = float(os.getenv("GOOGLE_TOKENINFO_TIMEOUT_SEC", "5"))
+# Верхняя граница TTL, даже если токен живёт дольше
+TOKEN_CACHE_TTL_SEC = float(os.getenv("TOKEN_CACHE_TTL_SEC", "600"))
+# Сколько помнить отвергнутый Google токен
+TOKEN_CACHE_NEGATIVE_TTL_SEC = float(os.getenv("TOKEN_CACHE_NEGATIVE_TTL_SEC", "30"))
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "10000"))
+
+
+def token_key(token: str) -> str:
+    """Ключ кэша: сам токен в памяти не храним"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class GoogleTokenVerifier:
+    """Кэширующая проверка access token через tokeninfo"""
+
+    def __init__(self, tokeninfo_url: str, max_size: int, ttl_sec: float, negative_ttl_sec: float):
+        self.tokeninfo_url = tokeninfo_url
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.negative_ttl_sec = negative_ttl_sec
+
+        # key -> (token_info или None для невалидного токена, expires_at)
+        self._cache: "OrderedDict[str, tuple]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+        self.upstream_errors = 0
+        self.upstream_latency_total_ms = 0.0
+        self.upstream_latency_max_ms = 0.0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=GOOGLE_TOKENINFO_TIMEOUT_SEC,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def verify(self, token: str) -> dict:
+        """token_info от Google или HTTPException(401)"""
+        key = token_key(token)
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            if cached[1] > time.monotonic():
+                self._cache.move_to_end(key)
+                self.hits += 1
+                if cached[0] is None:
+                    raise HTTPException(status_code=401, detail="Invalid token")
+                return cached[0]
+            del self._cache[key]
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            token_info = await self._fetch(key, token)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, не ругаемся на "never retrieved"
+            future.exception()
+            raise
+        else:
+            future.set_result(token_info)
+            return token_info
+        finally:
+            self._inflight.pop(key, None)
+
+    async def _fetch(self, key: str, token: str) -> dict:
+        started = time.monotonic()
+        self.upstream_calls += 1
+        try:
+            response = await self._get_client().get(self.tokeninfo_url, params={"access_token": token})
+        except httpx.HTTPError as e:
+            self.upstream_errors += 1
+            raise HTTPException(status_code=401, detail=f"Token validation failed: {str(e)}")
+        finally:
+            latency_ms = (time.monotonic() - started) * 1000
+            self.upstream_latency_total_ms += latency_ms
+            self.upstream_latency_max_ms = max(self.upstream_latency_max_ms, latency_ms)
+
+        if response.status_code >= 500:
+            # Сбой на стороне Google — не повод помнить токен невалидным
+            self.upstream_errors += 1
+            raise HTTPException(status_code=401, detail=f"Token validation failed: tokeninfo returned {response.status_code}")
+
+        if response.status_code != 200:
+            self._put(key, None, self.negative_ttl_sec)
+            raise HTTPException(status_code=401, detail="Invalid token")
+
+        token_info = response.json()
+        try:
+            expires_in = float(token_info.get("expires_in", self.ttl_sec))
+        except (TypeError, ValueError):
+            expires_in = self.ttl_sec
+        ttl = min(self.ttl_sec, expires_in)
+        if ttl > 0:
+            self._put(key, token_info, ttl)
+        return token_info
+
+    def _put(self, key: str, token_info: Optional[dict], ttl: float):
+        self._cache[key] = (token_info, time.monotonic() + ttl)
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._cache),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": round((self.hits + self.coalesced) / total, 3) if total else None,
+            "upstream_calls": self.upstream_calls,
+            "upstream_errors": self.upstream_errors,
+            "upstream_latency_avg_ms": round(self.upstream_latency_total_ms / self.upstream_calls, 1) if self.upstream_calls else None,
+            "upstream_latency_max_ms": round(self.upstream_latency_max_ms, 1),
+        }
+
+
+token_verifier = GoogleTokenVerifier(
+    GOOGLE_TOKENINFO_URL,
+    max_size=TOKEN_CACHE_SIZE,
+    ttl_sec=TOKEN_CACHE_TTL_SEC,
+    negative_ttl_sec=TOKEN_CACHE_NEGATIVE_TTL_SEC,
+)
@@ -0,0 +1,149 @@
+"""
+Коалесцированные обновления machines.last_seen_at.
+
+Раньше каждый ingest запрос делал UPDATE machines SET last_seen_at,
+превращая маленькую таблицу machines в горячую точку блокировок и
+источник мёртвых строк. Теперь роуты только отмечают машину в памяти,
+а фоновый поток раз в HEARTBEAT_FLUSH_SEC применяет все отметки одним
+UPDATE ... FROM (VALUES ...).
+
+Ещё не сброшенные значения учитываются при чтении (см. routers/machines.py),
+поэтому список активных машин остаётся точным.
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Optional
+from uuid import UUID
+
+from sqlalchemy import DateTime, column, update, values
+from sqlalchemy.dialects.postgresql import UUID as PG_UUID
+
+from database import SessionLocal
+from models import Machine
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_FLUSH_SEC = float(os.getenv("HEARTBEAT_FLUSH_SEC", "5"))
+
+
+class HeartbeatBuffer:
+    """machine UUID -> последний last_seen_at, ещё не записанный в БД"""
+
+    def __init__(self, flush_interval_sec: float):
+        self.flush_interval_sec = flush_interval_sec
+        self._pending: Dict[UUID, datetime] = {}
+        # Отметки, которые сейчас пишутся в БД: видны читателям до commit
+        self._inflight: Dict[UUID, datetime] = {}
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.flushes = 0
+        self.flushed_rows = 0
+        self.flush_errors = 0
+
+    def touch(self, machine_uuids: Iterable[UUID], seen_at: Optional[datetime] = None):
+        seen_at = seen_at or datetime.now(timezone.utc)
+        with self._lock:
+            for machine_uuid in machine_uuids:
+                current = self._pending.get(machine_uuid)
+                if current is None or current < seen_at:
+                    self._pending[machine_uuid] = seen_at
+
+    def pending(self) -> Dict[UUID, datetime]:
+        with self._lock:
+            merged = dict(self._inflight)
+            for machine_uuid, seen_at in self._pending.items():
+                if machine_uuid not in merged or merged[machine_uuid] < seen_at:
+                    merged[machine_uuid] = seen_at
+            return merged
+
+    def last_seen(self, machine_uuid: UUID, stored: Optional[datetime]) -> Optional[datetime]:
+        """last_seen_at из БД с учётом ещё не сброшенной отметки"""
+        with self._lock:
+            marks = [m for m in (self._pending.get(machine_uuid), self._inflight.get(machine_uuid)) if m]
+        pending = max(marks) if marks else None
+        if pending is None:
+            return stored
+        if stored is None:
+            return pending
+        return max(stored, pending)
+
+    def flush(self) -> int:
+        """Записать накопленные отметки одним UPDATE"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._inflight = batch
+        if not batch:
+            return 0
+
+        # Стабильный порядок строк = стабильный порядок блокировок
+        rows = sorted(batch.items(), key=lambda item: str(item[0]))
+        seen = values(
+            column("id", PG_UUID(as_uuid=True)),
+            column("seen_at", DateTime(timezone=True)),
+            name="seen",
+        ).data(rows)
+        stmt = (
+            update(Machine)
+            .where(Machine.id == seen.c.id)
+            .where((Machine.last_seen_at.is_(None)) | (Machine.last_seen_at < seen.c.seen_at))
+            .values(last_seen_at=seen.c.seen_at)
+            .execution_options(synchronize_session=False)
+        )
+
+        db = SessionLocal()
+        try:
+            db.execute(stmt)
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Вернуть отметки обратно, чтобы не потерять их до следующей попытки
+            for machine_uuid, seen_at in batch.items():
+                self.touch([machine_uuid], seen_at)
+            raise
+        finally:
+            db.close()
+            with self._lock:
+                self._inflight = {}
+
+        self.flushes += 1
+        self.flushed_rows += len(rows)
+        return len(rows)
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval_sec):
+            try:
+                self.flush()
+            except Exception as e:
+                self.flush_errors += 1
+                logger.error(f"Heartbeat flush failed: {e}")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="heartbeat-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Final heartbeat flush failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "flushes": self.flushes,
+            "flushed_rows": self.flushed_rows,
+            "flush_errors": self.flush_errors,
+        }
+
+
+heartbeats = HeartbeatBuffer(HEARTBEAT_FLUSH_SEC)
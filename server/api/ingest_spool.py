@@ -0,0 +1,281 @@
+"""
+Write-behind спул для ingest.
+
+Если задан INGEST_SPOOL_DIR, /api/events и /api/extension/telemetry не ждут
+commit в Postgres: провалидированная пачка дописывается в локальный
+append-only лог (fsync перед ответом) и агент сразу получает 200.
+Фоновый drainer перекладывает закрытые сегменты в activity_events
+с ограничением скорости, поэтому провал или медленная БД не превращаются
+в шторм ретраев от всех агентов.
+
+Формат сегмента: последовательность записей
+    [4 байта длина][4 байта crc32][JSON]
+Оборванная (недописанная) запись в хвосте сегмента игнорируется — её
+отправитель ответа не получил и пришлёт пачку повторно.
+"""
+
+import json
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Iterator, List, Optional
+
+from sqlalchemy.exc import OperationalError
+
+from database import SessionLocal
+from schemas import ActivityEventCreate, ExtensionSessionEvent
+from bulk_ingest import ingest_agent_events, ingest_telemetry_events
+
+logger = logging.getLogger(__name__)
+
+INGEST_SPOOL_DIR = os.getenv("INGEST_SPOOL_DIR", "")
+INGEST_SPOOL_MAX_MB = int(os.getenv("INGEST_SPOOL_MAX_MB", "512"))
+INGEST_SPOOL_SEGMENT_MB = int(os.getenv("INGEST_SPOOL_SEGMENT_MB", "4"))
+# Через сколько секунд незаполненный сегмент закрывается и уходит в drainer
+INGEST_SPOOL_SEAL_SEC = float(os.getenv("INGEST_SPOOL_SEAL_SEC", "2"))
+# Ограничение скорости загрузки в БД (событий в секунду)
+INGEST_SPOOL_DRAIN_RATE = int(os.getenv("INGEST_SPOOL_DRAIN_RATE", "2000"))
+# После стольких неудачных попыток (не считая недоступности БД) сегмент
+# переименовывается в *.failed
+INGEST_SPOOL_MAX_ATTEMPTS = int(os.getenv("INGEST_SPOOL_MAX_ATTEMPTS", "10"))
+
+RECORD_HEADER = struct.Struct(">II")
+SEGMENT_SUFFIX = ".seg"
+FAILED_SUFFIX = ".failed"
+
+
+class IngestSpool:
+    """Сегментированный append-only лог + фоновый drainer"""
+
+    def __init__(self, directory: str, max_bytes: int, segment_bytes: int,
+                 seal_sec: float, drain_rate: int):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.seal_sec = seal_sec
+        self.drain_rate = drain_rate
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self._active = None          # открытый файл текущего сегмента
+        self._active_path: Optional[Path] = None
+        self._active_opened_at = 0.0
+        self._next_seq = 0
+        self._total_bytes = 0
+
+        self.appended_records = 0
+        self.drained_records = 0
+        self.drained_events = 0
+        self.rejected_full = 0
+        self.drain_errors = 0
+
+    # ---------- lifecycle ----------
+
+    def start(self):
+        """Восстановление после рестарта и запуск drainer"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        # Всё, что осталось с прошлого запуска (включая незакрытый сегмент),
+        # считается закрытым и будет догружено drainer'ом
+        segments = self._sealed_segments()
+        self._total_bytes = sum(p.stat().st_size for p in segments)
+        if segments:
+            self._next_seq = int(segments[-1].stem) + 1
+            logger.info(f"Ingest spool: recovering {len(segments)} segments ({self._total_bytes} bytes)")
+
+        self._thread = threading.Thread(target=self._drain_loop, name="ingest-spool-drainer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+        with self._lock:
+            self._seal_active()
+
+    # ---------- write path ----------
+
+    def append(self, kind: str, payload: dict) -> bool:
+        """
+        Дописать пачку в спул (с fsync).
+        False — спул переполнен, вызывающий пишет в БД синхронно.
+        """
+        data = json.dumps({"kind": kind, "payload": payload}, separators=(",", ":")).encode()
+        record = RECORD_HEADER.pack(len(data), zlib.crc32(data)) + data
+
+        with self._lock:
+            if self._total_bytes + len(record) > self.max_bytes:
+                self.rejected_full += 1
+                return False
+
+            if self._active is None:
+                self._open_active()
+
+            self._active.write(record)
+            self._active.flush()
+            os.fsync(self._active.fileno())
+            self._total_bytes += len(record)
+            self.appended_records += 1
+
+            if self._active.tell() >= self.segment_bytes:
+                self._seal_active()
+                self._wakeup.set()
+
+        return True
+
+    def _open_active(self):
+        self._active_path = self.directory / f"{self._next_seq:020d}{SEGMENT_SUFFIX}"
+        self._next_seq += 1
+        self._active = open(self._active_path, "ab")
+        self._active_opened_at = time.monotonic()
+
+    def _seal_active(self):
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+            self._active_path = None
+
+    # ---------- drain path ----------
+
+    def _sealed_segments(self) -> List[Path]:
+        segments = sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+        return [p for p in segments if p != self._active_path]
+
+    def _drain_loop(self):
+        backoff = 1.0
+        failures = {}
+        while not self._stopping.is_set():
+            with self._lock:
+                if self._active is not None and time.monotonic() - self._active_opened_at >= self.seal_sec:
+                    self._seal_active()
+                segments = self._sealed_segments()
+
+            if not segments:
+                self._wakeup.wait(self.seal_sec)
+                self._wakeup.clear()
+                continue
+
+            for path in segments:
+                if self._stopping.is_set():
+                    break
+                try:
+                    started = time.monotonic()
+                    events = self._drain_segment(path)
+                    backoff = 1.0
+                except Exception as e:
+                    self.drain_errors += 1
+                    # Недоступность БД — не вина сегмента, такие ошибки не считаем
+                    if not isinstance(e, OperationalError):
+                        failures[path] = failures.get(path, 0) + 1
+                    if failures.get(path, 0) >= INGEST_SPOOL_MAX_ATTEMPTS:
+                        # Сегмент, который стабильно не грузится, откладываем в сторону,
+                        # чтобы он не блокировал очередь
+                        logger.error(f"Ingest spool: giving up on {path.name} after {failures[path]} attempts: {e}")
+                        self._quarantine(path)
+                        failures.pop(path)
+                        continue
+                    logger.error(f"Ingest spool: failed to drain {path.name}: {e}, retry in {backoff:.0f}s")
+                    self._stopping.wait(backoff)
+                    backoff = min(backoff * 2, 60)
+                    break
+
+                # Не грузим БД быстрее drain_rate событий в секунду
+                if self.drain_rate > 0:
+                    pause = events / self.drain_rate - (time.monotonic() - started)
+                    if pause > 0:
+                        self._stopping.wait(pause)
+
+    def _quarantine(self, path: Path):
+        size = path.stat().st_size
+        path.rename(path.with_suffix(FAILED_SUFFIX))
+        with self._lock:
+            self._total_bytes = max(0, self._total_bytes - size)
+
+    def _drain_segment(self, path: Path) -> int:
+        """Загрузить сегмент в БД одной транзакцией и удалить его"""
+        size = path.stat().st_size
+        events_count = 0
+        records = 0
+
+        db = SessionLocal()
+        try:
+            for record in read_segment(path):
+                payload = record["payload"]
+                if record["kind"] == "events":
+                    events = [ActivityEventCreate.model_validate(e) for e in payload["events"]]
+                    ingest_agent_events(db, events)
+                elif record["kind"] == "telemetry":
+                    events = [ExtensionSessionEvent.model_validate(e) for e in payload["events"]]
+                    ingest_telemetry_events(db, payload["email"], events)
+                else:
+                    logger.warning(f"Ingest spool: unknown record kind {record['kind']!r} in {path.name}")
+                    continue
+                events_count += len(events)
+                records += 1
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+        path.unlink()
+        with self._lock:
+            self._total_bytes = max(0, self._total_bytes - size)
+        self.drained_records += records
+        self.drained_events += events_count
+        return events_count
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending_segments = len(self._sealed_segments()) + (1 if self._active is not None else 0)
+            return {
+                "enabled": True,
+                "pending_bytes": self._total_bytes,
+                "pending_segments": pending_segments,
+                "max_bytes": self.max_bytes,
+                "appended_records": self.appended_records,
+                "drained_records": self.drained_records,
+                "drained_events": self.drained_events,
+                "rejected_full": self.rejected_full,
+                "drain_errors": self.drain_errors,
+            }
+
+
+def read_segment(path: Path) -> Iterator[dict]:
+    """Прочитать записи сегмента, остановившись на оборванном хвосте"""
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) != crc:
+                logger.warning(f"Ingest spool: torn record at offset {f.tell() - len(data) - RECORD_HEADER.size} in {path.name}, skipping tail")
+                return
+            yield json.loads(data)
+
+
+spool: Optional[IngestSpool] = None
+if INGEST_SPOOL_DIR:
+    spool = IngestSpool(
+        INGEST_SPOOL_DIR,
+        max_bytes=INGEST_SPOOL_MAX_MB * 1024 * 1024,
+        segment_bytes=INGEST_SPOOL_SEGMENT_MB * 1024 * 1024,
+        seal_sec=INGEST_SPOOL_SEAL_SEC,
+        drain_rate=INGEST_SPOOL_DRAIN_RATE,
+    )
+
+
+def spool_batch(kind: str, payload: dict) -> bool:
+    """Положить пачку в спул, если он включён и не переполнен"""
+    return spool is not None and spool.append(kind, payload)
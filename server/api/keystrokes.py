@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Компактное хранение нажатых клавиш (activity_events.keys_packed).
+
+Раньше список клавиш (KeyboardEvent.key) лежал в keys_array как JSONB:
+~6-8 байт на клавишу, 1000 клавиш расширения уходили в TOAST.
+Теперь это bytea, один байт на клавишу:
+
+  байт 0        — версия формата (KEYS_FORMAT_VERSION)
+  код 1..254    — индекс в KEY_TABLE (ASCII, кириллица, служебные клавиши)
+  код 255       — редкая клавиша: следующий байт длина, затем UTF-8
+
+KEY_TABLE только дополняется в конец, иначе старые строки прочитаются
+неверно. Клиенты могут сразу присылать keys_packed (base64), старый
+keys_array упаковывается при приёме (schemas.py).
+
+Старые строки с keys_array переносятся командой:
+    python keystrokes.py migrate
+"""
+
+import logging
+import sys
+from typing import List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+KEYS_FORMAT_VERSION = 1
+ESCAPE_CODE = 255
+MAX_ESCAPED_BYTES = 255
+
+MIGRATE_BATCH_ROWS = 5000
+
+NAMED_KEYS = (
+    "Enter", "Backspace", "Tab", "Shift", "Control", "Alt", "Meta", "CapsLock",
+    "Escape", "ArrowLeft", "ArrowRight", "ArrowUp", "ArrowDown", "Delete",
+    "Home", "End", "PageUp", "PageDown", "Insert", "AltGraph", "ContextMenu",
+    "NumLock", "ScrollLock", "Pause", "PrintScreen", "Dead", "Unidentified",
+    "Process", "Clear", "OS", "Fn",
+)
+
+# Код = индекс в таблице; 0 не используется
+KEY_TABLE: Tuple[Optional[str], ...] = (
+    (None,)
+    + tuple(chr(c) for c in range(0x20, 0x7F))                # печатные ASCII
+    + tuple(chr(c) for c in range(ord("а"), ord("я") + 1))    # строчная кириллица
+    + tuple(chr(c) for c in range(ord("А"), ord("Я") + 1))    # прописная кириллица
+    + ("ё", "Ё")
+    + NAMED_KEYS
+    + tuple(f"F{n}" for n in range(1, 13))
+)
+assert len(KEY_TABLE) <= ESCAPE_CODE
+
+KEY_CODES = {key: code for code, key in enumerate(KEY_TABLE) if key is not None}
+
+
+def encode_keys(keys: Optional[Sequence[str]]) -> Optional[bytes]:
+    """Список клавиш -> keys_packed; None для пустого списка"""
+    if not keys:
+        return None
+    out = bytearray([KEYS_FORMAT_VERSION])
+    for key in keys:
+        code = KEY_CODES.get(key)
+        if code is not None:
+            out.append(code)
+            continue
+        # Обрезка по границе символа: половина многобайтного символа не декодируется
+        raw = str(key).encode("utf-8")[:MAX_ESCAPED_BYTES].decode("utf-8", "ignore").encode("utf-8")
+        out.append(ESCAPE_CODE)
+        out.append(len(raw))
+        out += raw
+    return bytes(out)
+
+
+def decode_keys(data: Optional[bytes]) -> Optional[List[str]]:
+    """keys_packed -> список клавиш; ValueError для битых данных"""
+    if not data:
+        return None
+    data = bytes(data)
+    if data[0] != KEYS_FORMAT_VERSION:
+        raise ValueError(f"Unknown keys format version: {data[0]}")
+
+    keys = []
+    pos = 1
+    while pos < len(data):
+        code = data[pos]
+        pos += 1
+        if code == ESCAPE_CODE:
+            if pos >= len(data):
+                raise ValueError("Truncated escaped key")
+            length = data[pos]
+            raw = data[pos + 1:pos + 1 + length]
+            if len(raw) != length:
+                raise ValueError("Truncated escaped key")
+            keys.append(raw.decode("utf-8", errors="replace"))
+            pos += 1 + length
+        elif 0 < code < len(KEY_TABLE):
+            keys.append(KEY_TABLE[code])
+        else:
+            raise ValueError(f"Unknown key code: {code}")
+    return keys
+
+
+# ============ МИГРАЦИЯ СТАРЫХ СТРОК ============
+
+def migrate_legacy_keys(conn, batch_rows: int = MIGRATE_BATCH_ROWS, after_id: int = 0) -> Tuple[int, int, int]:
+    """
+    Перенести activity_events.keys_array в keys_packed пачками по id.
+    Каждая пачка — отдельная транзакция. Строки, занятые другим писателем,
+    ждутся (без SKIP LOCKED): last_id уходит вперёд, и пропущенная строка
+    осталась бы неупакованной. Прерванную миграцию можно
+    продолжить с последнего id из лога (after_id), не просматривая
+    уже перенесённое начало таблицы.
+    Возвращает (строк, байт JSONB до, байт bytea после).
+    """
+    moved = 0
+    bytes_before = 0
+    bytes_after = 0
+    last_id = after_id
+    while True:
+        with conn.begin():
+            rows = conn.execute(text("""
+                SELECT id, timestamp, keys_array, pg_column_size(keys_array) AS size
+                FROM activity_events
+                WHERE id > :last_id AND keys_array IS NOT NULL
+                ORDER BY id
+                LIMIT :limit
+                FOR UPDATE
+            """), {"last_id": last_id, "limit": batch_rows}).all()
+            if not rows:
+                return moved, bytes_before, bytes_after
+            last_id = rows[-1].id
+
+            updates = []
+            for row in rows:
+                keys = row.keys_array if isinstance(row.keys_array, list) else None
+                packed = encode_keys([str(k) for k in keys] if keys else None)
+                updates.append({"row_id": row.id, "ts": row.timestamp, "packed": packed})
+                bytes_before += row.size or 0
+                bytes_after += len(packed) if packed else 0
+
+            # timestamp в условии — чтобы UPDATE шёл только в нужную партицию
+            conn.execute(text("""
+                UPDATE activity_events
+                SET keys_packed = coalesce(keys_packed, :packed), keys_array = NULL
+                WHERE id = :row_id AND timestamp = :ts
+            """), updates)
+            moved += len(rows)
+        logger.info(f"Keys migration: {moved} rows packed ({bytes_before} -> {bytes_after} bytes), last id {last_id}")
+
+
+def main():
+    args = sys.argv[1:]
+    if args[:1] != ["migrate"] or len(args) not in (1, 3) or (len(args) == 3 and args[1] != "--after-id"):
+        print(f"Usage: {sys.argv[0]} migrate [--after-id ID]")
+        return 2
+    after_id = int(args[2]) if len(args) == 3 else 0
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    from database import engine
+
+    with engine.connect() as conn:
+        moved, before, after = migrate_legacy_keys(conn, after_id=after_id)
+    print(f"Done: {moved} rows packed, keys {before} -> {after} bytes (VACUUM activity_events to reclaim space)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""
+Кэш machine_id/email -> Machine.id на весь процесс.
+
+Каждый ingest запрос ищет машину по строковому machine_id — это самый
+частый запрос на горячем пути. Кэш ограничен по размеру (LRU) и по времени
+жизни записи (TTL). Отсутствие машины тоже кэшируется (negative entry),
+но с коротким TTL, чтобы новая машина быстро становилась видна.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+from uuid import UUID
+
+from sqlalchemy.orm import Session
+
+from models import Machine
+
+MACHINE_CACHE_SIZE = int(os.getenv("MACHINE_CACHE_SIZE", "10000"))
+MACHINE_CACHE_TTL_SEC = float(os.getenv("MACHINE_CACHE_TTL_SEC", "600"))
+MACHINE_CACHE_NEGATIVE_TTL_SEC = float(os.getenv("MACHINE_CACHE_NEGATIVE_TTL_SEC", "30"))
+
+# Маркер "ключа нет в кэше" (None означает закэшированное отсутствие машины)
+MISSING = object()
+
+
+class MachineCache:
+    """Потокобезопасный LRU/TTL кэш machine_id -> UUID"""
+
+    def __init__(self, max_size: int, ttl_sec: float, negative_ttl_sec: float):
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.negative_ttl_sec = negative_ttl_sec
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def get(self, key: str):
+        """UUID, None (машины нет) или MISSING"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[1] < now:
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return MISSING
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            if item[0] is None:
+                self.negative_hits += 1
+            return item[0]
+
+    def put(self, key: str, machine_uuid: Optional[UUID]):
+        """Запомнить UUID машины или её отсутствие (machine_uuid=None)"""
+        ttl = self.ttl_sec if machine_uuid is not None else self.negative_ttl_sec
+        with self._lock:
+            self._items[key] = (machine_uuid, time.monotonic() + ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key: str):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "negative_hits": self.negative_hits,
+                "hit_ratio": round(self.hits / total, 3) if total else None,
+            }
+
+
+machine_cache = MachineCache(MACHINE_CACHE_SIZE, MACHINE_CACHE_TTL_SEC, MACHINE_CACHE_NEGATIVE_TTL_SEC)
+
+
+def lookup_machine_uuid(db: Session, machine_id: str) -> Optional[UUID]:
+    """Найти Machine.id по machine_id (или email расширения) через кэш"""
+    cached = machine_cache.get(machine_id)
+    if cached is not MISSING:
+        return cached
+
+    machine_uuid = db.query(Machine.id).filter(Machine.machine_id == machine_id).scalar()
+    machine_cache.put(machine_id, machine_uuid)
+    return machine_uuid
@@ -3,11 +3,24 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import os
 
-from database import engine, Base
-from routers import ingest, machines, activity, dashboard, extension
+from database import engine, async_engine, Base
+from migrations import run_migrations
+from routers import ingest, machines, activity, dashboard, extension, tokens
+from machine_cache import machine_cache
+import ingest_spool
+import screenshot_spool
+from heartbeat import heartbeats
+import blocking
+from google_auth import token_verifier
+from agent_tokens import agent_tokens, revocations
+from partitions import partition_maintainer
+from retention import retention_job
+from archive import archive_job
+from string_dict import string_ids
 
 # Создаём таблицы
 Base.metadata.create_all(bind=engine)
+run_migrations(engine)
 
 app = FastAPI(
     title="Activity Tracker API",
@@ -30,6 +43,37 @@ app.include_router(machines.router)
 app.include_router(activity.router)
 app.include_router(dashboard.router)
 app.include_router(extension.router) # <--- Подключили
+app.include_router(tokens.router)
+
+
+@app.on_event("startup")
+async def startup():
+    heartbeats.start()
+    partition_maintainer.start()
+    retention_job.start()
+    archive_job.start()
+    if agent_tokens.enabled:
+        revocations.start()
+    if ingest_spool.spool:
+        ingest_spool.spool.start()
+    if screenshot_spool.screenshot_spool:
+        screenshot_spool.screenshot_spool.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if ingest_spool.spool:
+        ingest_spool.spool.stop()
+    if screenshot_spool.screenshot_spool:
+        screenshot_spool.screenshot_spool.stop()
+    heartbeats.stop()
+    partition_maintainer.stop()
+    retention_job.stop()
+    archive_job.stop()
+    revocations.stop()
+    await token_verifier.close()
+    await async_engine.dispose()
+    blocking.shutdown()
 
 
 @app.get("/")
@@ -40,3 +84,21 @@ async def root():
 @app.get("/health")
 async def health():
     return {"status": "healthy"}
+
+
+@app.get("/stats")
+async def stats():
+    """Внутренние счётчики процесса (кэши и т.п.)"""
+    return {
+        "machine_cache": machine_cache.stats(),
+        "ingest_spool": ingest_spool.spool.stats() if ingest_spool.spool else {"enabled": False},
+        "screenshot_spool": screenshot_spool.screenshot_spool.stats() if screenshot_spool.screenshot_spool else {"enabled": False},
+        "screenshot_dedupe": screenshot_spool.dedupe_stats.stats(),
+        "heartbeats": heartbeats.stats(),
+        "string_dict": string_ids.stats(),
+        "partitions": partition_maintainer.stats(),
+        "retention": retention_job.stats(),
+        "archive": archive_job.stats(),
+        "google_tokens": token_verifier.stats(),
+        "agent_tokens": agent_tokens.stats(),
+    }
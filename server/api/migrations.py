@@ -0,0 +1,125 @@
+"""
+Донастройка схемы существующей БД.
+
+Base.metadata.create_all создаёт только отсутствующие таблицы, поэтому
+новые колонки и индексы для уже существующих таблиц добавляются здесь
+(по аналогии с ensure_columns_exist в hash-worker). Все шаги идемпотентны.
+"""
+
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from partitions import ensure_clipboard_event_timestamp, run_maintenance
+
+logger = logging.getLogger(__name__)
+
+
+def _existing_columns(conn, table: str) -> set:
+    rows = conn.execute(text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = :table
+    """), {"table": table})
+    return {row[0] for row in rows}
+
+
+def _index_exists(conn, name: str) -> bool:
+    return conn.execute(text("SELECT 1 FROM pg_indexes WHERE indexname = :name"), {"name": name}).first() is not None
+
+
+def ensure_event_dedupe(conn):
+    """client_event_id + уникальный индекс для ON CONFLICT DO NOTHING"""
+    if "client_event_id" not in _existing_columns(conn, "activity_events"):
+        logger.info("Adding column: activity_events.client_event_id")
+        conn.execute(text("ALTER TABLE activity_events ADD COLUMN client_event_id VARCHAR(64) NOT NULL DEFAULT ''"))
+
+    if not _index_exists(conn, "uq_activity_events_dedupe"):
+        # Дубликаты, накопленные ретраями до появления индекса
+        logger.info("Removing duplicate activity_events before creating uq_activity_events_dedupe")
+        result = conn.execute(text("""
+            DELETE FROM activity_events a
+            USING activity_events b
+            WHERE a.machine_id = b.machine_id
+              AND a.timestamp = b.timestamp
+              AND a.agent_type = b.agent_type
+              AND a.client_event_id = b.client_event_id
+              AND a.id > b.id
+        """))
+        logger.info(f"Removed {result.rowcount} duplicate events")
+        conn.execute(text("""
+            CREATE UNIQUE INDEX uq_activity_events_dedupe
+            ON activity_events (machine_id, timestamp, agent_type, client_event_id)
+        """))
+
+
+def ensure_clipboard_blobs(conn):
+    """
+    Ссылка clipboard_events -> clipboard_blobs.
+    Перенос старого content в блобы — отдельно: python clipboard_store.py migrate
+    """
+    if "blob_hash" not in _existing_columns(conn, "clipboard_events"):
+        logger.info("Adding column: clipboard_events.blob_hash")
+        conn.execute(text("""
+            ALTER TABLE clipboard_events
+            ADD COLUMN blob_hash VARCHAR(64) REFERENCES clipboard_blobs (content_hash)
+        """))
+
+    if not _index_exists(conn, "ix_clipboard_events_blob_hash"):
+        conn.execute(text("CREATE INDEX ix_clipboard_events_blob_hash ON clipboard_events (blob_hash)"))
+
+
+def ensure_keys_packed(conn):
+    """
+    Компактные клавиши activity_events.keys_packed.
+    Перенос старого keys_array — отдельно: python keystrokes.py migrate
+    """
+    if "keys_packed" not in _existing_columns(conn, "activity_events"):
+        logger.info("Adding column: activity_events.keys_packed")
+        conn.execute(text("ALTER TABLE activity_events ADD COLUMN keys_packed BYTEA"))
+
+
+def ensure_string_dict_ids(conn):
+    """
+    Ссылки activity_events на словари строк (app_names, domain_names, window_titles).
+    Перенос старых строк — отдельно: python string_dict.py migrate
+    """
+    existing = _existing_columns(conn, "activity_events")
+    for column, table in (("app_id", "app_names"), ("domain_id", "domain_names"), ("window_id", "window_titles")):
+        if column not in existing:
+            logger.info(f"Adding column: activity_events.{column}")
+            conn.execute(text(f"ALTER TABLE activity_events ADD COLUMN {column} INTEGER REFERENCES {table} (id)"))
+
+
+def ensure_screenshot_upload_columns(conn):
+    """Состояние загрузки скриншота (см. screenshot_spool.py)"""
+    existing = _existing_columns(conn, "screenshots")
+    if "storage_key" not in existing:
+        logger.info("Adding column: screenshots.storage_key")
+        conn.execute(text("ALTER TABLE screenshots ADD COLUMN storage_key VARCHAR(500)"))
+    if "upload_status" not in existing:
+        logger.info("Adding column: screenshots.upload_status")
+        conn.execute(text("ALTER TABLE screenshots ADD COLUMN upload_status VARCHAR(20)"))
+    # content_hash раньше заполнял только hash-worker, теперь его пишет и загрузка
+    if "content_hash" not in existing:
+        logger.info("Adding column: screenshots.content_hash")
+        conn.execute(text("ALTER TABLE screenshots ADD COLUMN content_hash VARCHAR(64)"))
+    # Дедупликация ищет копию только среди скриншотов той же машины
+    if not _index_exists(conn, "ix_screenshots_machine_content_hash"):
+        logger.info("Creating index: ix_screenshots_machine_content_hash")
+        conn.execute(text("CREATE INDEX ix_screenshots_machine_content_hash ON screenshots (machine_id, content_hash)"))
+    if _index_exists(conn, "ix_screenshots_content_hash"):
+        conn.execute(text("DROP INDEX ix_screenshots_content_hash"))
+
+
+def run_migrations(engine: Engine):
+    with engine.begin() as conn:
+        ensure_event_dedupe(conn)
+        ensure_clipboard_blobs(conn)
+        ensure_keys_packed(conn)
+        ensure_string_dict_ids(conn)
+        ensure_screenshot_upload_columns(conn)
+        ensure_clipboard_event_timestamp(conn)
+
+    # Партиции на ближайшие периоды (до первого прохода PartitionMaintainer)
+    run_maintenance(engine)
@@ -1,10 +1,12 @@
-from sqlalchemy import Column, String, Integer, Float, Boolean, DateTime, BigInteger, ForeignKey, Text
+from sqlalchemy import Column, String, Integer, Float, Boolean, Date, DateTime, BigInteger, ForeignKey, Text, Index, LargeBinary
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 import uuid
+import zlib
 
 from database import Base
+from keystrokes import decode_keys
 
 
 class Machine(Base):
@@ -23,23 +25,32 @@ class Machine(Base):
 
 
 class ActivityEvent(Base):
+    """
+    Партиционирована по timestamp (см. partitions.py), поэтому ключ
+    партиции входит в первичный ключ и во все уникальные индексы.
+    """
     __tablename__ = "activity_events"
 
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     machine_id = Column(UUID(as_uuid=True), ForeignKey("machines.id"), nullable=False, index=True)
-    timestamp = Column(DateTime(timezone=True), nullable=False, index=True)
+    timestamp = Column(DateTime(timezone=True), primary_key=True, nullable=False, index=True)
     
     # Активность пользователя
     key_count = Column(Integer, default=0)
     mouse_clicks = Column(Integer, default=0)
     mouse_distance_px = Column(Integer, default=0)
     scroll_count = Column(Integer, default=0)
+    # Строки приложений/доменов/окон — id в словарях (string_dict.py),
+    # active_window/active_app/active_domain заполнены только у старых строк
+    window_id = Column(Integer, ForeignKey("window_titles.id"), nullable=True)
+    app_id = Column(Integer, ForeignKey("app_names.id"), nullable=True)
     active_window = Column(String(500))
     active_app = Column(String(255))
     is_idle = Column(Boolean, default=False)
     
     # Browser extension specific (NULL для desktop)
     active_url = Column(Text)
+    domain_id = Column(Integer, ForeignKey("domain_names.id"), nullable=True)
     active_domain = Column(String(255))
     tab_switches_count = Column(Integer)
 
@@ -49,7 +60,8 @@ class ActivityEvent(Base):
     # NEW fields
     copy_count = Column(Integer, default=0)
     paste_count = Column(Integer, default=0)
-    keys_array = Column(JSONB, nullable=True)
+    keys_array = Column(JSONB, nullable=True)  # только старые строки, новые пишутся в keys_packed
+    keys_packed = Column(LargeBinary, nullable=True)  # клавиши по байту, формат keystrokes.py
     mouse_avg_speed = Column(Float, nullable=True)
     extension_version = Column(String(20), nullable=True)
     
@@ -66,8 +78,44 @@ class ActivityEvent(Base):
     agent_type = Column(String(50))  # desktop, browser_extension
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
+    # Идемпотентность: id события от клиента ('' если клиент его не прислал,
+    # тогда дубликатом считается та же машина + timestamp + agent_type)
+    client_event_id = Column(String(64), nullable=False, server_default="")
+
     machine = relationship("Machine", back_populates="events")
-    clipboard_events = relationship("ClipboardEvent", back_populates="activity_event")
+    app = relationship("AppName")
+    domain = relationship("DomainName")
+    window = relationship("WindowTitle")
+    clipboard_events = relationship(
+        "ClipboardEvent",
+        back_populates="activity_event",
+        primaryjoin="and_(ActivityEvent.id == foreign(ClipboardEvent.activity_event_id), "
+                    "ActivityEvent.timestamp == foreign(ClipboardEvent.event_timestamp))",
+    )
+
+    __table_args__ = (
+        Index("uq_activity_events_dedupe", "machine_id", "timestamp", "agent_type", "client_event_id", unique=True),
+        {"postgresql_partition_by": "RANGE (timestamp)"},
+    )
+
+    @property
+    def app_name(self):
+        return self.app.value if self.app is not None else self.active_app
+
+    @property
+    def domain_name(self):
+        return self.domain.value if self.domain is not None else self.active_domain
+
+    @property
+    def window_title(self):
+        return self.window.value if self.window is not None else self.active_window
+
+    @property
+    def keys(self):
+        """Нажатые клавиши: из keys_packed или из старой колонки keys_array"""
+        if self.keys_packed is not None:
+            return decode_keys(self.keys_packed)
+        return self.keys_array
 
 
 class Screenshot(Base):
@@ -76,8 +124,11 @@ class Screenshot(Base):
     id = Column(BigInteger, primary_key=True, autoincrement=True)
     machine_id = Column(UUID(as_uuid=True), ForeignKey("machines.id"), nullable=False, index=True)
     timestamp = Column(DateTime(timezone=True), nullable=False)
-    image_path = Column(String(500))
+    image_path = Column(String(500))  # NULL, пока файл ждёт загрузки в локальном спуле
     thumbnail_path = Column(String(500))
+    storage_key = Column(String(500), nullable=True)  # ключ объекта в S3 бакете
+    upload_status = Column(String(20), nullable=True)  # pending / uploaded / failed (NULL у старых строк)
+    content_hash = Column(String(64), nullable=True)  # md5 файла, одинаковые скриншоты машины делят объект S3
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Source info (from extension)
@@ -93,6 +144,10 @@ class Screenshot(Base):
 
     machine = relationship("Machine", back_populates="screenshots")
 
+    __table_args__ = (
+        Index("ix_screenshots_machine_content_hash", "machine_id", "content_hash"),
+    )
+
 # Добавляем в models.py
 
 class ExtensionProfile(Base):
@@ -172,16 +227,171 @@ class ExtensionDiagnostic(Base):
     debug_log = Column(JSONB, nullable=True)
 
 
+class ActivityRollupColumns:
+    """
+    Агрегаты activity_events по (машина, начало интервала), см. rollups.py.
+    CPU/RAM хранятся как сумма + количество, чтобы интервалы складывались.
+    """
+    machine_id = Column(UUID(as_uuid=True), primary_key=True)
+    bucket_start = Column(DateTime(timezone=True), primary_key=True, index=True)
+
+    event_count = Column(Integer, nullable=False, default=0)      # событий (минут) всего
+    not_idle_count = Column(Integer, nullable=False, default=0)   # is_idle не true
+    active_minutes = Column(Integer, nullable=False, default=0)   # была активность клавиатуры/мыши
+    key_count = Column(BigInteger, nullable=False, default=0)
+    mouse_clicks = Column(BigInteger, nullable=False, default=0)
+    scroll_count = Column(BigInteger, nullable=False, default=0)
+    mouse_distance_px = Column(BigInteger, nullable=False, default=0)
+
+    # По всем событиям
+    cpu_sum = Column(Float, nullable=False, default=0)
+    cpu_count = Column(Integer, nullable=False, default=0)
+    ram_sum = Column(Float, nullable=False, default=0)
+    ram_count = Column(Integer, nullable=False, default=0)
+
+    # Только по активным минутам (графики dashboard)
+    active_cpu_sum = Column(Float, nullable=False, default=0)
+    active_cpu_count = Column(Integer, nullable=False, default=0)
+    active_ram_sum = Column(Float, nullable=False, default=0)
+    active_ram_count = Column(Integer, nullable=False, default=0)
+
+
+class ActivityRollup5m(ActivityRollupColumns, Base):
+    __tablename__ = "activity_rollup_5m"
+
+
+class ActivityRollupHourly(ActivityRollupColumns, Base):
+    __tablename__ = "activity_rollup_hourly"
+
+
+class ActivityRollupDaily(ActivityRollupColumns, Base):
+    __tablename__ = "activity_rollup_daily"
+
+
+class ActivityEventHourly(ActivityRollupColumns, Base):
+    """
+    Прореженные activity_events: сырые события старше окна хранения
+    заменяются часовыми строками с итогами и топом app/domain (retention.py).
+    """
+    __tablename__ = "activity_events_hourly"
+
+    top_app = Column(String(255), nullable=True)
+    top_app_minutes = Column(Integer, nullable=False, default=0)
+    top_domain = Column(String(255), nullable=True)
+    top_domain_minutes = Column(Integer, nullable=False, default=0)
+
+
 class ClipboardEvent(Base):
     """
     История копирования/вставки
+
+    Партиционирована по event_timestamp (= activity_events.timestamp
+    родительского события) теми же периодами, что и activity_events.
+    Внешнего ключа на activity_events нет: он мешал бы переносу и
+    удалению партиций, строки пишутся вместе с событием (bulk_ingest.py).
     """
     __tablename__ = "clipboard_events"
 
     id = Column(BigInteger, primary_key=True, autoincrement=True)
-    activity_event_id = Column(BigInteger, ForeignKey("activity_events.id", ondelete="CASCADE"), nullable=False, index=True)
+    activity_event_id = Column(BigInteger, nullable=False, index=True)
+    event_timestamp = Column(DateTime(timezone=True), primary_key=True, nullable=False)
     action = Column(String(10), nullable=False)  # 'copy' or 'paste'
-    content = Column(Text, nullable=True)
+    content = Column(Text, nullable=True)  # только старые строки, новые пишутся в clipboard_blobs
+    blob_hash = Column(String(64), ForeignKey("clipboard_blobs.content_hash"), nullable=True, index=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    activity_event = relationship(
+        "ActivityEvent",
+        back_populates="clipboard_events",
+        primaryjoin="and_(ActivityEvent.id == foreign(ClipboardEvent.activity_event_id), "
+                    "ActivityEvent.timestamp == foreign(ClipboardEvent.event_timestamp))",
+    )
+    blob = relationship("ClipboardBlob")
+
+    __table_args__ = (
+        {"postgresql_partition_by": "RANGE (event_timestamp)"},
+    )
+
+    @property
+    def text(self):
+        """Текст записи: из блоба или из старой колонки content"""
+        if self.blob is not None:
+            return self.blob.text
+        return self.content
+
+
+class ClipboardBlob(Base):
+    """
+    Уникальное содержимое буфера обмена (sha256 -> zlib), см. clipboard_store.py
+    """
+    __tablename__ = "clipboard_blobs"
+
+    content_hash = Column(String(64), primary_key=True)  # sha256 исходного текста, hex
+    content_zlib = Column(LargeBinary, nullable=False)
+    size_bytes = Column(Integer, nullable=False)  # размер до сжатия
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
-    activity_event = relationship("ActivityEvent", back_populates="clipboard_events")
\ No newline at end of file
+    @property
+    def text(self):
+        return zlib.decompress(self.content_zlib).decode("utf-8")
+
+
+class ActivityArchive(Base):
+    """
+    Манифест холодного архива: файл Parquet с событиями одной машины
+    за одни сутки (UTC), перенесёнными из activity_events (archive.py).
+    """
+    __tablename__ = "activity_archives"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    machine_id = Column(UUID(as_uuid=True), ForeignKey("machines.id"), nullable=False)
+    day = Column(Date, nullable=False)
+    storage = Column(String(10), nullable=False)  # local, s3
+    location = Column(String(500), nullable=False, unique=True)  # путь в ARCHIVE_DIR или ключ S3
+    row_count = Column(Integer, nullable=False)
+    min_timestamp = Column(DateTime(timezone=True), nullable=False)
+    max_timestamp = Column(DateTime(timezone=True), nullable=False)
+    size_bytes = Column(BigInteger, nullable=False)
+    sha256 = Column(String(64), nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index("ix_activity_archives_machine_day", "machine_id", "day"),
+    )
+
+
+class InternedStringColumns:
+    """Словарь строк: value <-> целочисленный id (см. string_dict.py)"""
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class AppName(InternedStringColumns, Base):
+    __tablename__ = "app_names"
+
+    value = Column(String(255), nullable=False, unique=True)
+
+
+class DomainName(InternedStringColumns, Base):
+    __tablename__ = "domain_names"
+
+    value = Column(String(255), nullable=False, unique=True)
+
+
+class WindowTitle(InternedStringColumns, Base):
+    __tablename__ = "window_titles"
+
+    value = Column(String(500), nullable=False, unique=True)
+
+
+class RevokedAgentToken(Base):
+    """
+    Отозванные подписанные токены агентов (см. agent_tokens.py).
+    Строка нужна только до expires_at, после — токен и так не пройдёт.
+    """
+    __tablename__ = "revoked_agent_tokens"
+
+    jti = Column(String(32), primary_key=True)
+    subject = Column(String(255), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    revoked_at = Column(DateTime(timezone=True), server_default=func.now())
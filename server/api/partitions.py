@@ -0,0 +1,441 @@
+"""
+Партиционирование activity_events и clipboard_events по времени.
+
+Обе таблицы объявлены как PARTITION BY RANGE (по activity_events.timestamp
+и clipboard_events.event_timestamp) с одинаковыми периодами
+EVENT_PARTITION_INTERVAL (month или day):
+
+    activity_events_p202501, activity_events_p202502, ..., activity_events_default
+    clipboard_events_p202501, ...,                          clipboard_events_default
+
+Запросы с фильтром по времени читают только нужные партиции (partition
+pruning), а удаление старых данных — DROP TABLE партиции вместо DELETE.
+
+PartitionMaintainer раз в PARTITION_MAINTENANCE_SEC:
+  - создаёт партиции на текущий и EVENT_PARTITION_PREMAKE следующих периодов
+  - выносит строки, попавшие в DEFAULT партицию (бэкфилл старых данных,
+    неверные часы агента), в партиции их периодов
+
+Старые партиции прореживаются и удаляются в retention.py.
+
+Существующая (непартиционированная) база переводится командой:
+
+    python partitions.py migrate [--keep-legacy]
+
+Проверка pruning на живой базе (EXPLAIN):
+
+    python partitions.py explain --days 1
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from database import Base, engine
+import models  # noqa: F401  (таблицы в Base.metadata для migrate)
+
+logger = logging.getLogger(__name__)
+
+EVENT_PARTITION_INTERVAL = os.getenv("EVENT_PARTITION_INTERVAL", "month")  # month | day
+EVENT_PARTITION_PREMAKE = int(os.getenv("EVENT_PARTITION_PREMAKE", "3"))
+PARTITION_MAINTENANCE_SEC = float(os.getenv("PARTITION_MAINTENANCE_SEC", "3600"))
+# DDL на родительской таблице ждёт блокировку не дольше этого, чтобы не
+# выстраивать очередь из ingest запросов за собой
+PARTITION_LOCK_TIMEOUT_MS = int(os.getenv("PARTITION_LOCK_TIMEOUT_MS", "10000"))
+
+# Родительская таблица -> ключ партиционирования
+PARTITIONED_TABLES = (
+    ("activity_events", "timestamp"),
+    ("clipboard_events", "event_timestamp"),
+)
+
+# pg_advisory_xact_lock: обслуживание (и retention.py) из нескольких воркеров uvicorn по очереди
+ADVISORY_LOCK_ID = 7316001
+
+Partition = namedtuple("Partition", ["name", "start", "end"])  # start/end = None у DEFAULT
+
+_BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+# ============ ПЕРИОДЫ ============
+
+def period_floor(ts: datetime, interval: str = EVENT_PARTITION_INTERVAL) -> datetime:
+    """Начало периода (UTC), в который попадает ts"""
+    ts = ts.astimezone(timezone.utc) if ts.tzinfo else ts.replace(tzinfo=timezone.utc)
+    if interval == "day":
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def period_next(start: datetime, interval: str = EVENT_PARTITION_INTERVAL) -> datetime:
+    if interval == "day":
+        return start + timedelta(days=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def partition_name(parent: str, start: datetime, interval: str = EVENT_PARTITION_INTERVAL) -> str:
+    suffix = start.strftime("%Y%m%d" if interval == "day" else "%Y%m")
+    return f"{parent}_p{suffix}"
+
+
+def default_partition_name(parent: str) -> str:
+    return f"{parent}_default"
+
+
+def _literal(ts: datetime) -> str:
+    """Граница партиции для DDL (bind параметры в DDL не работают)"""
+    return ts.astimezone(timezone.utc).strftime("'%Y-%m-%d %H:%M:%S+00'")
+
+
+# ============ КАТАЛОГ ============
+
+def is_partitioned(conn, table: str) -> bool:
+    relkind = conn.execute(
+        text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"), {"table": table}
+    ).scalar()
+    return relkind == "p"
+
+
+def list_partitions(conn, parent: str) -> List[Partition]:
+    rows = conn.execute(text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(:parent)
+        ORDER BY c.relname
+    """), {"parent": parent}).all()
+
+    partitions = []
+    for name, bound in rows:
+        match = _BOUND_RE.search(bound or "")
+        if match:
+            start, end = (datetime.fromisoformat(v) for v in match.groups())
+            partitions.append(Partition(name, start, end))
+        else:
+            partitions.append(Partition(name, None, None))
+    return partitions
+
+
+def _overlaps(partitions: List[Partition], start: datetime, end: datetime) -> bool:
+    return any(p.start is not None and p.start < end and p.end > start for p in partitions)
+
+
+# ============ СОЗДАНИЕ ============
+
+def ensure_default_partitions(conn):
+    for parent, _ in PARTITIONED_TABLES:
+        conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {default_partition_name(parent)} PARTITION OF {parent} DEFAULT"
+        ))
+
+
+def create_period(conn, start: datetime, interval: str = EVENT_PARTITION_INTERVAL) -> List[str]:
+    """
+    Создать партиции периода [start, next) для обеих таблиц, если их нет.
+    Строки этого периода из DEFAULT партиции переносятся в новую
+    (иначе Postgres не даст создать партицию). Возвращает имена созданных.
+    """
+    end = period_next(start, interval)
+    created = []
+    for parent, key in PARTITIONED_TABLES:
+        if _overlaps(list_partitions(conn, parent), start, end):
+            continue
+
+        default = default_partition_name(parent)
+        bounds = {"start": start, "end": end}
+        has_rows = conn.execute(text(
+            f"SELECT EXISTS (SELECT 1 FROM {default} WHERE {key} >= :start AND {key} < :end)"
+        ), bounds).scalar()
+
+        moving = f"_moving_{parent}"
+        if has_rows:
+            conn.execute(text(f"CREATE TEMP TABLE {moving} (LIKE {parent}) ON COMMIT DROP"))
+            conn.execute(text(f"""
+                WITH moved AS (
+                    DELETE FROM {default} WHERE {key} >= :start AND {key} < :end RETURNING *
+                )
+                INSERT INTO {moving} SELECT * FROM moved
+            """), bounds)
+
+        name = partition_name(parent, start, interval)
+        conn.execute(text(
+            f"CREATE TABLE {name} PARTITION OF {parent} FOR VALUES FROM ({_literal(start)}) TO ({_literal(end)})"
+        ))
+
+        if has_rows:
+            moved = conn.execute(text(f"INSERT INTO {parent} SELECT * FROM {moving}")).rowcount
+            conn.execute(text(f"DROP TABLE {moving}"))
+            logger.info(f"Partitions: moved {moved} rows from {default} to {name}")
+        logger.info(f"Partitions: created {name}")
+        created.append(name)
+    return created
+
+
+def default_periods(conn, interval: str = EVENT_PARTITION_INTERVAL) -> List[datetime]:
+    """Периоды, строки которых лежат в DEFAULT партициях"""
+    unit = "day" if interval == "day" else "month"
+    periods = set()
+    for parent, key in PARTITIONED_TABLES:
+        rows = conn.execute(text(
+            f"SELECT DISTINCT date_trunc('{unit}', {key} AT TIME ZONE 'UTC') FROM {default_partition_name(parent)}"
+        ))
+        periods.update(row[0].replace(tzinfo=timezone.utc) for row in rows)
+    return sorted(periods)
+
+
+def ensure_partitions(conn, now: Optional[datetime] = None, interval: str = EVENT_PARTITION_INTERVAL,
+                      premake: int = EVENT_PARTITION_PREMAKE) -> List[str]:
+    """Партиции на текущий и premake следующих периодов + разбор DEFAULT"""
+    ensure_default_partitions(conn)
+
+    start = period_floor(now or datetime.now(timezone.utc), interval)
+    periods = [start]
+    for _ in range(premake):
+        periods.append(period_next(periods[-1], interval))
+
+    created = []
+    for period in sorted(set(periods) | set(default_periods(conn, interval))):
+        created += create_period(conn, period, interval)
+    return created
+
+
+# ============ ОБСЛУЖИВАНИЕ ============
+
+def lock_maintenance(conn):
+    """Блокировка обслуживания партиций на время транзакции"""
+    conn.execute(text(f"SET LOCAL lock_timeout = {PARTITION_LOCK_TIMEOUT_MS}"))
+    conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+
+
+def run_maintenance(engine: Engine, now: Optional[datetime] = None) -> dict:
+    """Одна транзакция обслуживания; на непартиционированной базе ничего не делает"""
+    with engine.begin() as conn:
+        lock_maintenance(conn)
+        if not all(is_partitioned(conn, parent) for parent, _ in PARTITIONED_TABLES):
+            logger.warning("activity_events is not partitioned yet, run: python partitions.py migrate")
+            return {"partitioned": False, "created": []}
+
+        created = ensure_partitions(conn, now)
+    return {"partitioned": True, "created": created}
+
+
+class PartitionMaintainer:
+    """Фоновый поток, периодически вызывающий run_maintenance"""
+
+    def __init__(self, engine: Engine, interval_sec: float):
+        self.engine = engine
+        self.interval_sec = interval_sec
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.runs = 0
+        self.errors = 0
+        self.created = 0
+        self.last_run_at: Optional[float] = None
+
+    def run_once(self):
+        try:
+            result = run_maintenance(self.engine)
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Partition maintenance failed: {e}")
+            return
+        self.runs += 1
+        self.created += len(result["created"])
+        self.last_run_at = time.time()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval_sec):
+            self.run_once()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="partition-maintainer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+
+    def stats(self) -> dict:
+        return {
+            "interval": EVENT_PARTITION_INTERVAL,
+            "runs": self.runs,
+            "errors": self.errors,
+            "created": self.created,
+            "last_run_at": self.last_run_at,
+        }
+
+
+partition_maintainer = PartitionMaintainer(engine, PARTITION_MAINTENANCE_SEC)
+
+
+# ============ ПЕРЕХОД СО СТАРОЙ СХЕМЫ ============
+
+def ensure_clipboard_event_timestamp(conn):
+    """
+    Старая clipboard_events без event_timestamp: колонка заполняется из
+    activity_events, чтобы новый код записи работал и до migrate.
+    """
+    if is_partitioned(conn, "clipboard_events"):
+        return
+    exists = conn.execute(text("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'clipboard_events' AND column_name = 'event_timestamp'
+    """)).first()
+    if exists:
+        return
+    logger.info("Adding column: clipboard_events.event_timestamp")
+    conn.execute(text("ALTER TABLE clipboard_events ADD COLUMN event_timestamp TIMESTAMP WITH TIME ZONE"))
+    conn.execute(text("""
+        UPDATE clipboard_events c SET event_timestamp = a.timestamp
+        FROM activity_events a WHERE a.id = c.activity_event_id
+    """))
+
+
+def _columns(conn, table: str) -> List[str]:
+    return list(conn.execute(text("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_name = :table ORDER BY ordinal_position
+    """), {"table": table}).scalars())
+
+
+def _rename_legacy(conn, parent: str) -> str:
+    """activity_events -> activity_events_legacy вместе с индексами и sequence"""
+    legacy = f"{parent}_legacy"
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence(:t, 'id')"), {"t": parent}).scalar()
+    indexes = conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :t"), {"t": parent}).scalars().all()
+
+    conn.execute(text(f"LOCK TABLE {parent} IN ACCESS EXCLUSIVE MODE"))
+    conn.execute(text(f"ALTER TABLE {parent} RENAME TO {legacy}"))
+    for index in indexes:
+        conn.execute(text(f'ALTER INDEX "{index}" RENAME TO "{(index + "_legacy")[:63]}"'))
+    if sequence:
+        conn.execute(text(f"ALTER SEQUENCE {sequence} RENAME TO {legacy}_id_seq"))
+    return legacy
+
+
+def migrate_legacy(engine: Engine, keep_legacy: bool = False) -> dict:
+    """
+    Перевести обычные activity_events / clipboard_events в партиционированные.
+    Одна транзакция: API на время переноса лучше остановить.
+    """
+    copied = {}
+    with engine.begin() as conn:
+        conn.execute(text("SELECT pg_advisory_xact_lock(:id)"), {"id": ADVISORY_LOCK_ID})
+        if is_partitioned(conn, "activity_events"):
+            logger.info("activity_events is already partitioned")
+            return copied
+
+        ensure_clipboard_event_timestamp(conn)
+        legacy = {parent: _rename_legacy(conn, parent) for parent, _ in PARTITIONED_TABLES}
+
+        for parent, _ in PARTITIONED_TABLES:
+            Base.metadata.tables[parent].create(conn)
+        ensure_default_partitions(conn)
+
+        unit = "day" if EVENT_PARTITION_INTERVAL == "day" else "month"
+        periods = {
+            row[0].replace(tzinfo=timezone.utc)
+            for row in conn.execute(text(
+                f"SELECT DISTINCT date_trunc('{unit}', timestamp AT TIME ZONE 'UTC') FROM {legacy['activity_events']}"
+            ))
+        }
+        for period in sorted(periods):
+            create_period(conn, period)
+        ensure_partitions(conn)
+
+        for parent, key in PARTITIONED_TABLES:
+            columns = [c for c in _columns(conn, parent) if c in set(_columns(conn, legacy[parent]))]
+            column_list = ", ".join(f'"{c}"' for c in columns)
+            copied[parent] = conn.execute(text(
+                f"INSERT INTO {parent} ({column_list}) SELECT {column_list} FROM {legacy[parent]} WHERE {key} IS NOT NULL"
+            )).rowcount
+            conn.execute(text(f"""
+                SELECT setval(pg_get_serial_sequence('{parent}', 'id'),
+                              COALESCE((SELECT max(id) FROM {parent}), 0) + 1, false)
+            """))
+            logger.info(f"Partitions: copied {copied[parent]} rows into {parent}")
+
+        if not keep_legacy:
+            # clipboard_events_legacy ссылается на activity_events_legacy
+            for parent, _ in reversed(PARTITIONED_TABLES):
+                conn.execute(text(f"DROP TABLE {legacy[parent]}"))
+
+        for parent, _ in PARTITIONED_TABLES:
+            conn.execute(text(f"ANALYZE {parent}"))
+    return copied
+
+
+# ============ ПРОВЕРКА PRUNING ============
+
+def _scanned_relations(plan: dict) -> List[str]:
+    relations = [plan["Relation Name"]] if "Relation Name" in plan else []
+    for child in plan.get("Plans", []):
+        relations += _scanned_relations(child)
+    return relations
+
+
+def explain_range(conn, start: datetime, end: datetime) -> List[str]:
+    """Партиции activity_events, которые читает запрос за [start, end)"""
+    plan = conn.execute(text("""
+        EXPLAIN (FORMAT JSON)
+        SELECT machine_id, count(*) FROM activity_events
+        WHERE timestamp >= :start AND timestamp < :end
+        GROUP BY machine_id
+    """), {"start": start, "end": end}).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return sorted(set(_scanned_relations(plan[0]["Plan"])))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Time-range partitions of activity_events / clipboard_events")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("maintain", help="create upcoming partitions and split DEFAULT")
+    migrate = sub.add_parser("migrate", help="convert existing tables to partitioned ones")
+    migrate.add_argument("--keep-legacy", action="store_true", help="keep *_legacy tables after copying")
+    explain = sub.add_parser("explain", help="check partition pruning with EXPLAIN")
+    explain.add_argument("--days", type=float, default=1, help="query range ending now")
+    args = parser.parse_args()
+
+    if args.command == "maintain":
+        print(run_maintenance(engine))
+    elif args.command == "migrate":
+        print(migrate_legacy(engine, keep_legacy=args.keep_legacy))
+        print(run_maintenance(engine))
+    elif args.command == "explain":
+        end = datetime.now(timezone.utc)
+        start = end - timedelta(days=args.days)
+        with engine.connect() as conn:
+            scanned = explain_range(conn, start, end)
+            expected = {
+                p.name for p in list_partitions(conn, "activity_events")
+                if p.start is not None and p.start < end and p.end > start
+            }
+        print(f"range {start.isoformat()} .. {end.isoformat()}")
+        print(f"scanned:  {', '.join(scanned)}")
+        print(f"expected: {', '.join(sorted(expected))}")
+        extra = set(scanned) - expected - {default_partition_name("activity_events")}
+        if extra:
+            print(f"NOT PRUNED: {', '.join(sorted(extra))}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
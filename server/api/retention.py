@@ -0,0 +1,297 @@
+"""
+Хранение сырых событий с прореживанием.
+
+Сырые поминутные activity_events (с клавишами и заголовками окон)
+хранятся EVENT_RETENTION_DAYS дней. Более старые заменяются часовыми
+строками activity_events_hourly (итоги + самые частые app и domain),
+после чего сырые данные удаляются:
+
+  - партиционированная база (partitions.py): партиция, целиком лежащая
+    раньше границы, прореживается и удаляется DROP TABLE вместе с
+    партицией clipboard_events того же периода — без DELETE и без bloat
+  - база без партиций: по одним суткам, а внутри суток пачками машин
+    (не больше RETENTION_BATCH_ROWS строк) с commit после каждой пачки,
+    чтобы не держать один огромный DELETE
+
+Каждая единица работы (партиция или пачка машин за сутки) — одна
+транзакция: часовые строки пишутся ровно из тех событий, что удаляются
+в ней же, поэтому прерванный проход просто продолжается со следующего
+запуска.
+Агрегаты rollups.py не удаляются, dashboard за старые периоды работает
+как прежде; топ приложений за такие дни считается по прореженным часам.
+
+    python retention.py run [--days 30]
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from sqlalchemy import text
+
+from database import engine
+from models import ActivityEventHourly
+from partitions import is_partitioned, list_partitions, lock_maintenance
+from rollups import BUCKET_HOUR_SQL, SUM_COLUMNS, aggregate_columns_sql
+
+logger = logging.getLogger(__name__)
+
+# 0 = хранить сырые события всегда
+EVENT_RETENTION_DAYS = int(os.getenv("EVENT_RETENTION_DAYS", "0"))
+RETENTION_INTERVAL_SEC = float(os.getenv("RETENTION_INTERVAL_SEC", "3600"))
+# База без партиций: сколько строк activity_events удалять за транзакцию
+# (пачка — целые сутки нескольких машин, одна машина может её превысить)
+RETENTION_BATCH_ROWS = int(os.getenv("RETENTION_BATCH_ROWS", "20000"))
+
+HOURLY_TABLE = ActivityEventHourly.__tablename__
+
+
+def downsample_sql(source: str, where: str = "TRUE") -> str:
+    """INSERT часовых строк из source (таблица/партиция с колонками activity_events)"""
+    hour = BUCKET_HOUR_SQL.format(ts="e.timestamp")
+    columns = ", ".join(SUM_COLUMNS)
+    updates = ", ".join(f"{c} = {HOURLY_TABLE}.{c} + EXCLUDED.{c}" for c in SUM_COLUMNS)
+    top_updates = ", ".join(
+        f"{name} = CASE WHEN EXCLUDED.{name}_minutes > {HOURLY_TABLE}.{name}_minutes"
+        f" THEN EXCLUDED.{name} ELSE {HOURLY_TABLE}.{name} END, "
+        f"{name}_minutes = GREATEST(EXCLUDED.{name}_minutes, {HOURLY_TABLE}.{name}_minutes)"
+        for name in ("top_app", "top_domain")
+    )
+
+    def top(expr: str, dictionary: str, id_column: str, alias: str) -> str:
+        # строка из словаря (string_dict.py) или из старой колонки
+        return f"""
+            SELECT DISTINCT ON (machine_id, bucket_start) machine_id, bucket_start, value, minutes
+            FROM (
+                SELECT e.machine_id, {hour} AS bucket_start, {expr} AS value, count(*) AS minutes
+                FROM {source} e
+                LEFT JOIN {dictionary} n ON n.id = e.{id_column}
+                WHERE {where}
+                GROUP BY 1, 2, 3
+            ) {alias}
+            WHERE value IS NOT NULL
+            ORDER BY machine_id, bucket_start, minutes DESC, value
+        """
+
+    return f"""
+        WITH totals (machine_id, bucket_start, {columns}) AS (
+            SELECT e.machine_id, {hour},
+                   {aggregate_columns_sql("e")}
+            FROM {source} e
+            WHERE {where}
+            GROUP BY 1, 2
+        ),
+        apps AS ({top("coalesce(nullif(coalesce(n.value, e.active_app), ''), 'Unknown')", "app_names", "app_id", "a")}),
+        domains AS ({top("nullif(coalesce(n.value, e.active_domain), '')", "domain_names", "domain_id", "d")})
+        INSERT INTO {HOURLY_TABLE} (machine_id, bucket_start, {columns},
+                                    top_app, top_app_minutes, top_domain, top_domain_minutes)
+        SELECT t.*, a.value, coalesce(a.minutes, 0), d.value, coalesce(d.minutes, 0)
+        FROM totals t
+        LEFT JOIN apps a USING (machine_id, bucket_start)
+        LEFT JOIN domains d USING (machine_id, bucket_start)
+        ON CONFLICT (machine_id, bucket_start) DO UPDATE SET {updates}, {top_updates}
+    """
+
+
+def machine_batches(counts, batch_rows: int):
+    """[(machine_id, строк)] -> списки machine_id, в сумме не больше batch_rows строк"""
+    batch, size = [], 0
+    for machine_id, rows in counts:
+        if batch and size + rows > batch_rows:
+            yield batch
+            batch, size = [], 0
+        batch.append(str(machine_id))
+        size += rows
+    if batch:
+        yield batch
+
+
+class RetentionJob:
+    """Фоновое прореживание: партиция или пачка машин за транзакцию, счётчики прогресса"""
+
+    def __init__(self, retention_days: int, interval_sec: float):
+        self.retention_days = retention_days
+        self.interval_sec = interval_sec
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        self.runs = 0
+        self.errors = 0
+        self.partitions_dropped = 0
+        self.days_downsampled = 0
+        self.events_downsampled = 0
+        self.hourly_rows = 0
+        self.bytes_freed = 0
+        self.current: Optional[str] = None
+        self.last_cutoff: Optional[datetime] = None
+        self.last_run_at: Optional[float] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.retention_days > 0
+
+    # ---------- единицы работы ----------
+
+    def _downsample_partition(self, conn, cutoff: datetime) -> bool:
+        """Самая старая истёкшая партиция activity_events; False — таких нет"""
+        expired = [p for p in list_partitions(conn, "activity_events") if p.end is not None and p.end <= cutoff]
+        if not expired:
+            return False
+        partition = min(expired, key=lambda p: p.start)
+        self.current = partition.name
+
+        events, size = conn.execute(text(
+            f"SELECT (SELECT count(*) FROM {partition.name}), pg_total_relation_size('{partition.name}')"
+        )).one()
+        hourly = conn.execute(text(downsample_sql(partition.name))).rowcount
+
+        # clipboard_events того же периода (строки ссылаются на удаляемые события)
+        for clip in list_partitions(conn, "clipboard_events"):
+            if clip.end is not None and clip.start >= partition.start and clip.end <= partition.end:
+                size += conn.execute(text(f"SELECT pg_total_relation_size('{clip.name}')")).scalar()
+                conn.execute(text(f"DROP TABLE {clip.name}"))
+                self.partitions_dropped += 1
+        conn.execute(text(f"DROP TABLE {partition.name}"))
+
+        self.partitions_dropped += 1
+        self.events_downsampled += events
+        self.hourly_rows += hourly
+        self.bytes_freed += size
+        logger.info(f"Retention: {partition.name} -> {hourly} hourly rows ({events} events, {size} bytes freed)")
+        return True
+
+    def _downsample_day(self, cutoff: datetime) -> bool:
+        """
+        Самые старые полные сутки раньше cutoff (база без партиций).
+        Каждая пачка машин — своя транзакция; False — таких суток нет
+        или проход остановлен.
+        """
+        with engine.begin() as conn:
+            first = conn.execute(
+                text("SELECT min(timestamp) FROM activity_events WHERE timestamp < :cutoff"), {"cutoff": cutoff}
+            ).scalar()
+            if first is None:
+                return False
+            start = first.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+            end = start + timedelta(days=1)
+            if end > cutoff:
+                return False
+            bounds = {"start": start, "end": end}
+            counts = conn.execute(text("""
+                SELECT machine_id, count(*) FROM activity_events
+                WHERE timestamp >= :start AND timestamp < :end
+                GROUP BY machine_id ORDER BY machine_id
+            """), bounds).all()
+        self.current = start.date().isoformat()
+
+        where = "e.timestamp >= :start AND e.timestamp < :end AND e.machine_id = ANY(CAST(:machines AS uuid[]))"
+        hourly = events = 0
+        for machines in machine_batches(counts, RETENTION_BATCH_ROWS):
+            if self._stopping.is_set():
+                return False
+            params = {**bounds, "machines": machines}
+            with engine.begin() as conn:
+                lock_maintenance(conn)
+                hourly += conn.execute(text(downsample_sql("activity_events", where)), params).rowcount
+                conn.execute(text("""
+                    DELETE FROM clipboard_events
+                    WHERE event_timestamp >= :start AND event_timestamp < :end
+                      AND activity_event_id IN (
+                          SELECT id FROM activity_events e WHERE """ + where + """
+                      )
+                """), params)
+                events += conn.execute(text("""
+                    DELETE FROM activity_events e WHERE """ + where), params).rowcount
+
+        self.days_downsampled += 1
+        self.events_downsampled += events
+        self.hourly_rows += hourly
+        logger.info(f"Retention: {self.current} -> {hourly} hourly rows ({events} events)")
+        return True
+
+    # ---------- проход ----------
+
+    def run_once(self, now: Optional[datetime] = None) -> dict:
+        """Прорядить всё, что старше окна хранения"""
+        if not self.enabled:
+            return self.stats()
+        cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=self.retention_days)
+        self.last_cutoff = cutoff
+
+        try:
+            while not self._stopping.is_set():
+                with engine.begin() as conn:
+                    lock_maintenance(conn)
+                    partitioned = is_partitioned(conn, "activity_events")
+                    done = self._downsample_partition(conn, cutoff) if partitioned else False
+                if not partitioned:
+                    done = self._downsample_day(cutoff)
+                if not done:
+                    break
+        except Exception as e:
+            self.errors += 1
+            logger.error(f"Retention failed at {self.current}: {e}")
+        finally:
+            self.current = None
+
+        self.runs += 1
+        self.last_run_at = time.time()
+        return self.stats()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval_sec):
+            self.run_once()
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._run, name="event-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "retention_days": self.retention_days or None,
+            "runs": self.runs,
+            "errors": self.errors,
+            "current": self.current,
+            "last_cutoff": self.last_cutoff.isoformat() if self.last_cutoff else None,
+            "partitions_dropped": self.partitions_dropped,
+            "days_downsampled": self.days_downsampled,
+            "events_downsampled": self.events_downsampled,
+            "hourly_rows": self.hourly_rows,
+            "bytes_freed": self.bytes_freed,
+            "last_run_at": self.last_run_at,
+        }
+
+
+retention_job = RetentionJob(EVENT_RETENTION_DAYS, RETENTION_INTERVAL_SEC)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Downsample and drop raw activity_events past the retention window")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="run one retention pass")
+    run.add_argument("--days", type=int, default=EVENT_RETENTION_DAYS, help="raw retention window in days")
+    args = parser.parse_args()
+
+    if args.days <= 0:
+        print("Retention is disabled (set EVENT_RETENTION_DAYS or --days)")
+        return 2
+    print(RetentionJob(args.days, RETENTION_INTERVAL_SEC).run_once())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
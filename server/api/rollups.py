@@ -0,0 +1,352 @@
+"""
+Агрегаты активности по машине: 5 минут, час, сутки (UTC).
+
+Dashboard и /api/activity читают эти таблицы вместо сырых поминутных
+событий, поэтому неделя или месяц — это O(интервалов), а не O(событий).
+
+Таблицы поддерживаются инкрементально в той же транзакции, что и
+вставка событий: bulk_ingest.insert_events и backfill добавляют вклад
+только реально вставленных (не дубликатов) событий через
+INSERT ... ON CONFLICT DO UPDATE SET x = x + excluded.x. Поздно
+пришедшие события (бэкфилл после оффлайна) просто добавляются к своим
+интервалам.
+
+Пересчёт из activity_events (после миграции, ручных правок и т.п.):
+
+    python rollups.py rebuild [--since 2025-01-01] [--until 2025-02-01] [--machine vm-01]
+"""
+
+import argparse
+import logging
+import sys
+from datetime import date, datetime, timedelta, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import DateTime, extract, func, literal, select, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from database import engine
+from models import Machine, ActivityArchive, ActivityRollup5m, ActivityRollupHourly, ActivityRollupDaily, ActivityEventHourly
+
+logger = logging.getLogger(__name__)
+
+# Складываемые колонки агрегатов
+SUM_COLUMNS = (
+    "event_count", "not_idle_count", "active_minutes",
+    "key_count", "mouse_clicks", "scroll_count", "mouse_distance_px",
+    "cpu_sum", "cpu_count", "ram_sum", "ram_count",
+    "active_cpu_sum", "active_cpu_count", "active_ram_sum", "active_ram_count",
+)
+
+
+def floor_5m(ts: datetime) -> datetime:
+    return ts.replace(minute=ts.minute - ts.minute % 5, second=0, microsecond=0)
+
+
+def floor_hour(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def floor_day(ts: datetime) -> datetime:
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+# Округление колонки {ts} до начала интервала (UTC) в SQL
+BUCKET_5M_SQL = (
+    "(date_trunc('hour', {ts} AT TIME ZONE 'UTC')"
+    " + floor(extract(minute FROM {ts} AT TIME ZONE 'UTC') / 5) * interval '5 minutes') AT TIME ZONE 'UTC'"
+)
+BUCKET_HOUR_SQL = "date_trunc('hour', {ts} AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'"
+BUCKET_DAY_SQL = "date_trunc('day', {ts} AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'"
+
+# (модель, округление в Python, округление в SQL)
+ROLLUP_LEVELS: Tuple[Tuple[type, Callable[[datetime], datetime], str], ...] = (
+    (ActivityRollup5m, floor_5m, BUCKET_5M_SQL),
+    (ActivityRollupHourly, floor_hour, BUCKET_HOUR_SQL),
+    (ActivityRollupDaily, floor_day, BUCKET_DAY_SQL),
+)
+
+
+def has_activity(key_count, mouse_clicks, scroll_count, mouse_distance_px) -> bool:
+    """Активная минута — была хоть какая-то активность клавиатуры/мыши"""
+    return (key_count or 0) > 0 or (mouse_clicks or 0) > 0 or (scroll_count or 0) > 0 or (mouse_distance_px or 0) > 0
+
+
+# ============ ИНКРЕМЕНТАЛЬНОЕ ОБНОВЛЕНИЕ ============
+
+def event_contribution(row: dict) -> Dict[str, float]:
+    """Вклад одной строки activity_events (dict из bulk_ingest) в агрегаты"""
+    active = has_activity(row.get("key_count"), row.get("mouse_clicks"),
+                          row.get("scroll_count"), row.get("mouse_distance_px"))
+    cpu = row.get("cpu_percent")
+    ram = row.get("ram_used_percent")
+    return {
+        "event_count": 1,
+        "not_idle_count": 0 if row.get("is_idle") else 1,
+        "active_minutes": 1 if active else 0,
+        "key_count": row.get("key_count") or 0,
+        "mouse_clicks": row.get("mouse_clicks") or 0,
+        "scroll_count": row.get("scroll_count") or 0,
+        "mouse_distance_px": row.get("mouse_distance_px") or 0,
+        "cpu_sum": cpu or 0,
+        "cpu_count": 0 if cpu is None else 1,
+        "ram_sum": ram or 0,
+        "ram_count": 0 if ram is None else 1,
+        "active_cpu_sum": (cpu or 0) if active else 0,
+        "active_cpu_count": 1 if active and cpu is not None else 0,
+        "active_ram_sum": (ram or 0) if active else 0,
+        "active_ram_count": 1 if active and ram is not None else 0,
+    }
+
+
+def _upsert_stmt(model):
+    stmt = pg_insert(model)
+    return stmt.on_conflict_do_update(
+        index_elements=["machine_id", "bucket_start"],
+        set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in SUM_COLUMNS},
+    )
+
+
+def apply_rows(db: Session, rows: Iterable[dict]) -> int:
+    """
+    Добавить вставленные события к агрегатам (без commit).
+    Возвращает число затронутых строк агрегатов.
+    """
+    contributions = [(row["machine_id"], row["timestamp"].astimezone(timezone.utc), event_contribution(row))
+                     for row in rows]
+    if not contributions:
+        return 0
+
+    touched = 0
+    for model, floor, _ in ROLLUP_LEVELS:
+        buckets: Dict[tuple, Dict[str, float]] = {}
+        for machine_uuid, ts, values in contributions:
+            bucket = buckets.setdefault((machine_uuid, floor(ts)), dict.fromkeys(SUM_COLUMNS, 0))
+            for name, value in values.items():
+                bucket[name] += value
+
+        # Один порядок ключей во всех транзакциях — без взаимных блокировок
+        params = [
+            {"machine_id": machine_uuid, "bucket_start": bucket_start, **values}
+            for (machine_uuid, bucket_start), values in sorted(buckets.items(), key=lambda kv: (str(kv[0][0]), kv[0][1]))
+        ]
+        db.execute(_upsert_stmt(model), params)
+        touched += len(params)
+    return touched
+
+
+# ============ SQL АГРЕГАЦИЯ (backfill, rebuild) ============
+
+_ACTIVE_SQL = (
+    "(coalesce({a}key_count, 0) > 0 OR coalesce({a}mouse_clicks, 0) > 0"
+    " OR coalesce({a}scroll_count, 0) > 0 OR coalesce({a}mouse_distance_px, 0) > 0)"
+)
+
+
+def aggregate_columns_sql(alias: str = "") -> str:
+    """Агрегаты в порядке SUM_COLUMNS по строкам activity_events"""
+    a = f"{alias}." if alias else ""
+    active = _ACTIVE_SQL.format(a=a)
+    return ",\n".join([
+        "count(*)",
+        f"count(*) FILTER (WHERE {a}is_idle IS NOT TRUE)",
+        f"count(*) FILTER (WHERE {active})",
+        f"coalesce(sum({a}key_count), 0)",
+        f"coalesce(sum({a}mouse_clicks), 0)",
+        f"coalesce(sum({a}scroll_count), 0)",
+        f"coalesce(sum({a}mouse_distance_px), 0)",
+        f"coalesce(sum({a}cpu_percent), 0)",
+        f"count({a}cpu_percent)",
+        f"coalesce(sum({a}ram_used_percent), 0)",
+        f"count({a}ram_used_percent)",
+        f"coalesce(sum({a}cpu_percent) FILTER (WHERE {active}), 0)",
+        f"count({a}cpu_percent) FILTER (WHERE {active})",
+        f"coalesce(sum({a}ram_used_percent) FILTER (WHERE {active}), 0)",
+        f"count({a}ram_used_percent) FILTER (WHERE {active})",
+    ])
+
+
+def upsert_from_sql(table: str, bucket_sql: str, source: str, where: str = "TRUE") -> str:
+    """
+    INSERT агрегатов из source (таблица, CTE или подзапрос с колонками
+    activity_events) в table с прибавлением к существующим интервалам.
+    """
+    columns = ", ".join(SUM_COLUMNS)
+    updates = ", ".join(f"{c} = {table}.{c} + EXCLUDED.{c}" for c in SUM_COLUMNS)
+    bucket = bucket_sql.format(ts="e.timestamp")
+    return f"""
+        INSERT INTO {table} (machine_id, bucket_start, {columns})
+        SELECT e.machine_id, {bucket},
+               {aggregate_columns_sql("e")}
+        FROM {source} e
+        WHERE {where}
+        GROUP BY 1, 2
+        ON CONFLICT (machine_id, bucket_start) DO UPDATE SET {updates}
+    """
+
+
+def upsert_ctes_sql(source: str) -> str:
+    """
+    Data-modifying CTE для всех уровней: ", upsert_activity_rollup_5m AS (...), ..." —
+    дописывается после CTE source в одном запросе (см. backfill.py).
+    """
+    return "".join(
+        f",\n        upsert_{model.__tablename__} AS ({upsert_from_sql(model.__tablename__, bucket_sql, source)})"
+        for model, _, bucket_sql in ROLLUP_LEVELS
+    )
+
+
+def rebuild_day(conn, day: date, machine_uuid=None) -> int:
+    """
+    Пересчитать агрегаты одних суток (UTC) из activity_events.
+    Если сутки уже прорежены (retention.py), часовые и дневные агрегаты
+    строятся из activity_events_hourly, а 5-минутные не трогаются.
+    Машины, чьи сутки уже в архиве (archive.py), пропускаются: сырых
+    строк у них нет, и агрегаты остаются как были.
+    """
+    start = datetime.combine(day, datetime.min.time(), tzinfo=timezone.utc)
+    params = {"start": start, "end": start + timedelta(days=1), "day": day, "machine_uuid": machine_uuid}
+    machine_filter = "AND machine_id = :machine_uuid" if machine_uuid else ""
+    event_filter = f"e.timestamp >= :start AND e.timestamp < :end AND {_not_archived_sql('e')}"
+    if machine_uuid:
+        event_filter += " AND e.machine_id = :machine_uuid"
+
+    downsampled = conn.execute(text(f"""
+        SELECT EXISTS (
+            SELECT 1 FROM {ActivityEventHourly.__tablename__}
+            WHERE bucket_start >= :start AND bucket_start < :end {machine_filter}
+        )
+    """), params).scalar()
+
+    rows = 0
+    for model, _, bucket_sql in ROLLUP_LEVELS:
+        table = model.__tablename__
+        if downsampled and model is ActivityRollup5m:
+            continue
+        conn.execute(text(f"""
+            DELETE FROM {table}
+            WHERE bucket_start >= :start AND bucket_start < :end {machine_filter}
+              AND {_not_archived_sql(table)}
+        """), params)
+        if downsampled:
+            rows += conn.execute(text(_upsert_from_hourly_sql(table, bucket_sql, machine_filter)), params).rowcount
+        rows += conn.execute(text(upsert_from_sql(table, bucket_sql, "activity_events", event_filter)), params).rowcount
+    return rows
+
+
+def _not_archived_sql(alias: str) -> str:
+    """Условие: сутки :day машины {alias}.machine_id не перенесены в activity_archives"""
+    return (f"NOT EXISTS (SELECT 1 FROM {ActivityArchive.__tablename__} a"
+            f" WHERE a.machine_id = {alias}.machine_id AND a.day = :day)")
+
+
+def _upsert_from_hourly_sql(table: str, bucket_sql: str, machine_filter: str) -> str:
+    """Агрегаты из прореженных часовых строк activity_events_hourly"""
+    columns = ", ".join(SUM_COLUMNS)
+    sums = ", ".join(f"sum({c})" for c in SUM_COLUMNS)
+    updates = ", ".join(f"{c} = {table}.{c} + EXCLUDED.{c}" for c in SUM_COLUMNS)
+    return f"""
+        INSERT INTO {table} (machine_id, bucket_start, {columns})
+        SELECT machine_id, {bucket_sql.format(ts="bucket_start")}, {sums}
+        FROM {ActivityEventHourly.__tablename__} h
+        WHERE bucket_start >= :start AND bucket_start < :end {machine_filter}
+          AND {_not_archived_sql("h")}
+        GROUP BY 1, 2
+        ON CONFLICT (machine_id, bucket_start) DO UPDATE SET {updates}
+    """
+
+
+def rebuild(since: Optional[date] = None, until: Optional[date] = None, machine_id: Optional[str] = None) -> int:
+    """Пересчитать агрегаты за [since, until) по суткам, каждые сутки — своя транзакция"""
+    with engine.connect() as conn:
+        machine_uuid = None
+        if machine_id:
+            machine_uuid = conn.execute(select(Machine.id).where(Machine.machine_id == machine_id)).scalar()
+            if machine_uuid is None:
+                raise ValueError(f"Unknown machine: {machine_id}")
+        if since is None or until is None:
+            first, last = conn.execute(text("SELECT min(timestamp), max(timestamp) FROM activity_events")).one()
+            if first is None:
+                return 0
+            since = since or first.astimezone(timezone.utc).date()
+            until = until or last.astimezone(timezone.utc).date() + timedelta(days=1)
+
+    rows = 0
+    day = since
+    while day < until:
+        with engine.begin() as conn:
+            day_rows = rebuild_day(conn, day, machine_uuid)
+        rows += day_rows
+        logger.info(f"Rollups: rebuilt {day.isoformat()} ({day_rows} rows)")
+        day += timedelta(days=1)
+    return rows
+
+
+# ============ ЧТЕНИЕ ============
+
+async def fetch_rollups(db: AsyncSession, model, machine_uuid, start: datetime, end: datetime) -> List:
+    """Строки агрегатов машины с bucket_start в [start, end]"""
+    result = await db.execute(
+        select(model)
+        .where(model.machine_id == machine_uuid, model.bucket_start >= start, model.bucket_start <= end)
+        .order_by(model.bucket_start)
+    )
+    return result.scalars().all()
+
+
+async def fetch_fleet_rollups(
+    db: AsyncSession, model, machine_uuids: Iterable, start: datetime, end: datetime,
+    origin: datetime, bucket_minutes: int,
+) -> Dict:
+    """
+    Агрегаты нескольких машин одним запросом: суммы SUM_COLUMNS по
+    (машина, номер интервала bucket_minutes от origin) для bucket_start в [start, end].
+    Возвращает {machine uuid: {номер интервала: {колонка: значение}}}.
+    """
+    machine_uuids = list(machine_uuids)
+    if not machine_uuids:
+        return {}
+    offset = extract("epoch", model.bucket_start - literal(origin, DateTime(timezone=True)))
+    buckets = (
+        select(
+            model.machine_id,
+            func.floor(offset / (bucket_minutes * 60)).label("bucket"),
+            *[getattr(model, c) for c in SUM_COLUMNS],
+        )
+        .where(model.machine_id.in_(machine_uuids), model.bucket_start >= start, model.bucket_start <= end)
+        .subquery()
+    )
+    result = await db.execute(
+        select(buckets.c.machine_id, buckets.c.bucket, *[func.sum(buckets.c[c]).label(c) for c in SUM_COLUMNS])
+        .group_by(buckets.c.machine_id, buckets.c.bucket)
+    )
+
+    fleet = {}
+    for row in result:
+        # sum(bigint) приходит как Decimal; *_sum — суммы CPU/RAM (float)
+        fleet.setdefault(row.machine_id, {})[int(row.bucket)] = {
+            c: float(getattr(row, c)) if c.endswith("_sum") else int(getattr(row, c)) for c in SUM_COLUMNS
+        }
+    return fleet
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    parser = argparse.ArgumentParser(description="Activity rollup tables")
+    sub = parser.add_subparsers(dest="command", required=True)
+    rebuild_cmd = sub.add_parser("rebuild", help="recompute rollups from activity_events")
+    rebuild_cmd.add_argument("--since", type=date.fromisoformat, help="first day (UTC), default: oldest event")
+    rebuild_cmd.add_argument("--until", type=date.fromisoformat, help="day after the last one, default: after newest event")
+    rebuild_cmd.add_argument("--machine", help="machine_id (default: all machines)")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        rows = rebuild(args.since, args.until, args.machine)
+        print(f"Rebuilt {rows} rollup rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
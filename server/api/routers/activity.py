@@ -1,57 +1,161 @@
 from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import func, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, desc, literal_column, select, union_all
+from sqlalchemy.orm import joinedload
 from typing import List, Optional
-from datetime import datetime, timedelta, date
+from datetime import datetime, timedelta, date, timezone
 
 from database import get_db
-from models import Machine, ActivityEvent
+from models import Machine, ActivityEvent, ActivityEventHourly, ActivityRollupHourly, ActivityRollupDaily, AppName, ActivityArchive
 from schemas import ActivitySummary
+from routers.machines import get_machine_or_404
+from archive import app_minutes as archived_app_minutes, read_archives
+from blocking import run_blocking
+from keystrokes import decode_keys
+from aggregation import average
 
 router = APIRouter(prefix="/api/activity", tags=["activity"])
 
 
+def utc_day(ts: datetime) -> date:
+    return (ts.astimezone(timezone.utc) if ts.tzinfo else ts).date()
+
+
+async def get_archive_entries(db: AsyncSession, machine: Machine, start: Optional[datetime], end: Optional[datetime]) -> list:
+    """Файлы холодного архива (archive.py) машины за интервал, новые сутки первыми"""
+    query = select(ActivityArchive).where(ActivityArchive.machine_id == machine.id)
+    if start:
+        query = query.where(ActivityArchive.day >= utc_day(start))
+    if end:
+        query = query.where(ActivityArchive.day <= utc_day(end))
+    return (await db.execute(query.order_by(desc(ActivityArchive.day), desc(ActivityArchive.id)))).scalars().all()
+
+
+async def get_top_apps(db: AsyncSession, machine: Machine, start: datetime, end: datetime, limit: int = 10) -> list:
+    """
+    Топ приложений по числу минут одним запросом: группировка по app_id,
+    имена из app_names подставляются уже для групп, сортировка и LIMIT в БД.
+    За прореженные часы (retention.py) учитывается только top_app часа.
+    """
+    counts = (
+        select(ActivityEvent.app_id, ActivityEvent.active_app, func.count().label("minutes"))
+        .where(
+            ActivityEvent.machine_id == machine.id,
+            ActivityEvent.timestamp >= start,
+            ActivityEvent.timestamp <= end
+        )
+        .group_by(ActivityEvent.app_id, ActivityEvent.active_app)
+        .subquery()
+    )
+    app = func.coalesce(func.nullif(func.coalesce(AppName.value, counts.c.active_app), ""), "Unknown")
+    raw = (
+        select(app.label("app"), counts.c.minutes)
+        .select_from(counts.outerjoin(AppName, AppName.id == counts.c.app_id))
+    )
+    downsampled = (
+        select(ActivityEventHourly.top_app.label("app"), ActivityEventHourly.top_app_minutes.label("minutes"))
+        .where(
+            ActivityEventHourly.machine_id == machine.id,
+            ActivityEventHourly.bucket_start >= start,
+            ActivityEventHourly.bucket_start <= end,
+            ActivityEventHourly.top_app.isnot(None)
+        )
+    )
+    merged = union_all(raw, downsampled).subquery()
+    minutes = func.sum(merged.c.minutes)
+    query = select(merged.c.app, minutes.label("minutes")).group_by(merged.c.app).order_by(desc(minutes), merged.c.app)
+
+    # Сутки, перенесённые в холодный архив, складываются уже в Python,
+    # поэтому LIMIT в БД только когда архива за интервал нет
+    entries = await get_archive_entries(db, machine, start, end)
+    if not entries:
+        query = query.limit(limit)
+
+    app_minutes = {row.app: int(row.minutes) for row in await db.execute(query)}
+    if entries:
+        for app, mins in (await run_blocking(archived_app_minutes, entries, start, end)).items():
+            app_minutes[app] = app_minutes.get(app, 0) + mins
+
+    top_apps = sorted(app_minutes.items(), key=lambda x: x[1], reverse=True)[:limit]
+    return [{"app": app, "minutes": mins} for app, mins in top_apps]
+
+
 @router.get("/{machine_id}/events")
 async def get_events(
     machine_id: str,
     start: Optional[datetime] = None,
     end: Optional[datetime] = None,
     limit: int = Query(default=1000, le=10000),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Получить сырые события для машины"""
-    machine = db.query(Machine).filter(Machine.machine_id == machine_id).first()
-    if not machine:
-        raise HTTPException(status_code=404, detail="Machine not found")
+    machine = await get_machine_or_404(db, machine_id)
     
-    query = db.query(ActivityEvent).filter(ActivityEvent.machine_id == machine.id)
+    query = (
+        select(ActivityEvent)
+        .options(joinedload(ActivityEvent.app), joinedload(ActivityEvent.window))
+        .where(ActivityEvent.machine_id == machine.id)
+    )
     
     if start:
-        query = query.filter(ActivityEvent.timestamp >= start)
+        query = query.where(ActivityEvent.timestamp >= start)
     if end:
-        query = query.filter(ActivityEvent.timestamp <= end)
-    
-    events = query.order_by(desc(ActivityEvent.timestamp)).limit(limit).all()
+        query = query.where(ActivityEvent.timestamp <= end)
     
+    events = [
+        {
+            "timestamp": e.timestamp,
+            "key_count": e.key_count,
+            "mouse_clicks": e.mouse_clicks,
+            "mouse_distance_px": e.mouse_distance_px,
+            "scroll_count": e.scroll_count,
+            "active_window": e.window_title,
+            "active_app": e.app_name,
+            "is_idle": e.is_idle,
+            "cpu_percent": e.cpu_percent,
+            "ram_used_percent": e.ram_used_percent,
+            "disk_used_percent": e.disk_used_percent,
+            "keys": e.keys,
+        }
+        for e in (await db.execute(query.order_by(desc(ActivityEvent.timestamp)).limit(limit))).scalars().all()
+    ]
+
+    # Старые сутки из холодного архива: целыми сутками, пока не наберётся limit
+    entries = []
+    archived_rows = 0
+    for entry in await get_archive_entries(db, machine, start, end):
+        if archived_rows >= limit and entry.day != entries[-1].day:
+            break
+        entries.append(entry)
+        archived_rows += entry.row_count
+    if entries:
+        table = await run_blocking(read_archives, entries, start, end)
+        events.extend(
+            {
+                "timestamp": row["timestamp"],
+                "key_count": row["key_count"],
+                "mouse_clicks": row["mouse_clicks"],
+                "mouse_distance_px": row["mouse_distance_px"],
+                "scroll_count": row["scroll_count"],
+                "active_window": row["active_window"],
+                "active_app": row["active_app"],
+                "is_idle": row["is_idle"],
+                "cpu_percent": row["cpu_percent"],
+                "ram_used_percent": row["ram_used_percent"],
+                "disk_used_percent": row["disk_used_percent"],
+                "keys": decode_keys(row["keys_packed"]),
+            }
+            for row in table.to_pylist()
+        )
+        events = sorted(events, key=lambda e: e["timestamp"], reverse=True)[:limit]
+
+    for e in events:
+        e["timestamp"] = e["timestamp"].isoformat()
+
     return {
         "machine_id": machine_id,
         "count": len(events),
-        "events": [
-            {
-                "timestamp": e.timestamp.isoformat(),
-                "key_count": e.key_count,
-                "mouse_clicks": e.mouse_clicks,
-                "mouse_distance_px": e.mouse_distance_px,
-                "scroll_count": e.scroll_count,
-                "active_window": e.active_window,
-                "active_app": e.active_app,
-                "is_idle": e.is_idle,
-                "cpu_percent": e.cpu_percent,
-                "ram_used_percent": e.ram_used_percent,
-                "disk_used_percent": e.disk_used_percent
-            }
-            for e in events
-        ]
+        "events": events
     }
 
 
@@ -59,12 +163,10 @@ async def get_events(
 async def get_summary(
     machine_id: str,
     date_str: Optional[str] = None,  # YYYY-MM-DD
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Получить суммарную статистику за день"""
-    machine = db.query(Machine).filter(Machine.machine_id == machine_id).first()
-    if not machine:
-        raise HTTPException(status_code=404, detail="Machine not found")
+    machine = await get_machine_or_404(db, machine_id)
     
     # По умолчанию - сегодня
     if date_str:
@@ -75,13 +177,24 @@ async def get_summary(
     start = datetime.combine(target_date, datetime.min.time())
     end = datetime.combine(target_date, datetime.max.time())
     
-    events = db.query(ActivityEvent).filter(
-        ActivityEvent.machine_id == machine.id,
-        ActivityEvent.timestamp >= start,
-        ActivityEvent.timestamp <= end
-    ).all()
+    # Одна строка скаляров по суточному агрегату
+    daily = ActivityRollupDaily
+    day = (await db.execute(
+        select(
+            func.count().label("buckets"),
+            func.sum(daily.event_count).label("event_count"),
+            func.sum(daily.not_idle_count).label("not_idle_count"),
+            func.sum(daily.key_count).label("key_count"),
+            func.sum(daily.mouse_clicks).label("mouse_clicks"),
+            func.sum(daily.cpu_sum).label("cpu_sum"),
+            func.sum(daily.cpu_count).label("cpu_count"),
+            func.sum(daily.ram_sum).label("ram_sum"),
+            func.sum(daily.ram_count).label("ram_count"),
+        )
+        .where(daily.machine_id == machine.id, daily.bucket_start >= start, daily.bucket_start <= end)
+    )).one()
     
-    if not events:
+    if not day.buckets:
         return {
             "machine_id": machine_id,
             "date": target_date.isoformat(),
@@ -95,26 +208,17 @@ async def get_summary(
             "top_apps": []
         }
     
-    total_minutes = len(events)
-    active_minutes = sum(1 for e in events if not e.is_idle)
+    total_minutes = int(day.event_count)
+    active_minutes = int(day.not_idle_count)
     idle_minutes = total_minutes - active_minutes
-    total_keys = sum(e.key_count or 0 for e in events)
-    total_clicks = sum(e.mouse_clicks or 0 for e in events)
-    
-    cpu_values = [e.cpu_percent for e in events if e.cpu_percent is not None]
-    ram_values = [e.ram_used_percent for e in events if e.ram_used_percent is not None]
+    total_keys = int(day.key_count)
+    total_clicks = int(day.mouse_clicks)
     
-    avg_cpu = round(sum(cpu_values) / len(cpu_values), 1) if cpu_values else None
-    avg_ram = round(sum(ram_values) / len(ram_values), 1) if ram_values else None
+    avg_cpu = average(day.cpu_sum, day.cpu_count, None)
+    avg_ram = average(day.ram_sum, day.ram_count, None)
     
     # Топ приложений по времени
-    app_minutes = {}
-    for e in events:
-        app = e.active_app or "Unknown"
-        app_minutes[app] = app_minutes.get(app, 0) + 1
-    
-    top_apps = sorted(app_minutes.items(), key=lambda x: x[1], reverse=True)[:10]
-    top_apps = [{"app": app, "minutes": mins} for app, mins in top_apps]
+    top_apps = await get_top_apps(db, machine, start, end)
     
     return {
         "machine_id": machine_id,
@@ -134,12 +238,10 @@ async def get_summary(
 async def get_timeline(
     machine_id: str,
     date_str: Optional[str] = None,  # YYYY-MM-DD
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Получить таймлайн активности по часам для heatmap"""
-    machine = db.query(Machine).filter(Machine.machine_id == machine_id).first()
-    if not machine:
-        raise HTTPException(status_code=404, detail="Machine not found")
+    machine = await get_machine_or_404(db, machine_id)
     
     if date_str:
         target_date = datetime.strptime(date_str, "%Y-%m-%d").date()
@@ -149,22 +251,25 @@ async def get_timeline(
     start = datetime.combine(target_date, datetime.min.time())
     end = datetime.combine(target_date, datetime.max.time())
     
-    events = db.query(ActivityEvent).filter(
-        ActivityEvent.machine_id == machine.id,
-        ActivityEvent.timestamp >= start,
-        ActivityEvent.timestamp <= end
-    ).all()
+    # Группируем по часам (UTC) в БД: не больше 24 строк скаляров.
+    # Литералы, а не bind параметры — иначе выражения в SELECT и GROUP BY разные
+    hourly = ActivityRollupHourly
+    hour = func.date_part(literal_column("'hour'"), func.timezone(literal_column("'UTC'"), hourly.bucket_start))
+    buckets = await db.execute(
+        select(
+            hour.label("hour"),
+            func.sum(hourly.event_count).label("total"),
+            func.sum(hourly.not_idle_count).label("active"),
+        )
+        .where(hourly.machine_id == machine.id, hourly.bucket_start >= start, hourly.bucket_start <= end)
+        .group_by(hour)
+    )
     
-    # Группируем по часам
     hours = {h: {"active": 0, "idle": 0, "total": 0} for h in range(24)}
     
-    for e in events:
-        hour = e.timestamp.hour
-        hours[hour]["total"] += 1
-        if e.is_idle:
-            hours[hour]["idle"] += 1
-        else:
-            hours[hour]["active"] += 1
+    for b in buckets:
+        total, active = int(b.total), int(b.active)
+        hours[int(b.hour)] = {"active": active, "idle": total - active, "total": total}
     
     return {
         "machine_id": machine_id,
@@ -1,102 +1,76 @@
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Request
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select, update
 from datetime import datetime
-import uuid
 import os
-import re
-import boto3
-from botocore.exceptions import ClientError
 
 from database import get_db
-from models import ExtensionProfile, CookieVault, BlockingRule, Machine, ActivityEvent, Screenshot, ClipboardEvent
+from blocking import run_blocking
+from body_codecs import DecodedBodyRoute
+from models import ExtensionProfile, CookieVault, BlockingRule, Screenshot
 from schemas import HandshakeRequest, AgentConfigResponse, TelemetryBatch
+from bulk_ingest import ingest_telemetry_events
+from ingest_spool import spool_batch
+from machine_cache import lookup_machine_uuid
+import storage
+from screenshot_spool import store_screenshot
+from google_auth import token_verifier
+from agent_tokens import agent_tokens, looks_like_agent_token, TOKEN_TYPE_PROFILE
 
 # ============ CONFIG ============
 
 # Google OAuth
 GOOGLE_CLIENT_ID = os.getenv("GOOGLE_CLIENT_ID", None)
 
-# S3 (Wasabi)
-S3_ENDPOINT = os.getenv("S3_ENDPOINT", "https://s3.wasabisys.com")
-S3_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
-S3_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-S3_BUCKET = os.getenv("S3_BUCKET", "instaloader")
-S3_SCREENSHOTS_PREFIX = "screenshots/"  # Папка внутри бакета
-
-# Ограничения
-MAX_FILE_SIZE_MB = 5
-ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp"}
-
-# ============ S3 CLIENT ============
-
-def get_s3_client():
-    """Создаёт S3 клиент для Wasabi."""
-    return boto3.client(
-        's3',
-        endpoint_url=S3_ENDPOINT,
-        aws_access_key_id=S3_ACCESS_KEY,
-        aws_secret_access_key=S3_SECRET_KEY
-    )
-
 # ============ HELPERS ============
 
-def sanitize_filename(email: str) -> str:
-    """
-    Убирает опасные символы из email для безопасного имени файла.
-    """
-    return re.sub(r'[^a-zA-Z0-9@._-]', '_', email)
-
-
-import requests as http_requests  # Переименовываем чтобы не конфликтовать с google.auth.transport.requests
-
-def verify_google_user(token: str, expected_email: str) -> dict:
+async def verify_google_user(token: str, expected_email: str, allow_agent_token: bool = True) -> dict:
     """
-    Проверяет Google OAuth Access Token через Google API.
+    Проверяет токен расширения: подписанный токен из handshake проверяется
+    локально (agent_tokens.py), Google OAuth Access Token — через tokeninfo
+    с кэшем (google_auth.py). allow_agent_token=False — только Google
+    (handshake: иначе утёкший токен продлевал бы сам себя бесконечно).
     """
     if not token:
         raise HTTPException(status_code=401, detail="Missing auth token")
+    if looks_like_agent_token(token) and not allow_agent_token:
+        raise HTTPException(status_code=401, detail="Google auth token required")
+    if agent_tokens.enabled and looks_like_agent_token(token):
+        claims = agent_tokens.verify(token, TOKEN_TYPE_PROFILE, subject=expected_email)
+        return {"email": claims["sub"], "sub": None}
     # Manual API key для AdsPower
     if token == 'manual-tracker-key-2026':
         return {"email": expected_email, "sub": f"manual_{expected_email}"}
 
-    try:
-        # Валидируем Access Token через Google tokeninfo endpoint
-        response = http_requests.get(
-            f"https://oauth2.googleapis.com/tokeninfo?access_token={token}"
-        )
-        
-        if response.status_code != 200:
-            raise HTTPException(status_code=401, detail="Invalid token")
-        
-        token_info = response.json()
-        token_email = token_info.get("email")
-        
-        if not token_email:
-            raise HTTPException(status_code=401, detail="Token has no email scope")
-        
-        if token_email != expected_email:
-            raise HTTPException(status_code=403, detail="Token email does not match request email")
-
-        return token_info
-
-    except http_requests.RequestException as e:
-        raise HTTPException(status_code=401, detail=f"Token validation failed: {str(e)}")
+    token_info = await token_verifier.verify(token)
+    token_email = token_info.get("email")
+
+    if not token_email:
+        raise HTTPException(status_code=401, detail="Token has no email scope")
+
+    if token_email != expected_email:
+        raise HTTPException(status_code=403, detail="Token email does not match request email")
+
+    return token_info
+
+
 # ============ ROUTER ============
 
-router = APIRouter(prefix="/api/extension", tags=["extension"])
+router = APIRouter(prefix="/api/extension", tags=["extension"], route_class=DecodedBodyRoute)
 
 
 @router.post("/handshake", response_model=AgentConfigResponse)
-async def handshake(req: HandshakeRequest, db: Session = Depends(get_db)):
+async def handshake(req: HandshakeRequest, db: AsyncSession = Depends(get_db)):
     """
     Расширение стучится при запуске.
     Проверяем юзера, отдаем конфиг, куки и правила.
     """
-    id_info = verify_google_user(req.auth_token, req.email)
+    id_info = await verify_google_user(req.auth_token, req.email, allow_agent_token=False)
     google_sub = id_info.get("sub")
     
-    profile = db.query(ExtensionProfile).filter(ExtensionProfile.email == req.email).first()
+    profile = (await db.execute(
+        select(ExtensionProfile).where(ExtensionProfile.email == req.email)
+    )).scalars().first()
 
     if not profile:
         profile = ExtensionProfile(
@@ -104,11 +78,11 @@ async def handshake(req: HandshakeRequest, db: Session = Depends(get_db)):
             google_sub_id=google_sub
         )
         db.add(profile)
-        db.commit()
-        db.refresh(profile)
+        await db.commit()
+        await db.refresh(profile)
     elif profile.google_sub_id is None and google_sub:
         profile.google_sub_id = google_sub
-        db.commit()
+        await db.commit()
 
     # Kill Switch
     if not profile.is_active:
@@ -121,10 +95,10 @@ async def handshake(req: HandshakeRequest, db: Session = Depends(get_db)):
         }
 
     # Получаем только неинжектированные куки
-    cookies = db.query(CookieVault).filter(
+    cookies = (await db.execute(select(CookieVault).where(
         CookieVault.profile_id == profile.id,
         CookieVault.injected_at.is_(None)
-    ).all()
+    ))).scalars().all()
 
     cookies_list = [
         {
@@ -139,12 +113,16 @@ async def handshake(req: HandshakeRequest, db: Session = Depends(get_db)):
         for c in cookies
     ]
 
+    # Явный запрос вместо lazy load profile.blocking_rules (недоступен в AsyncSession)
+    rules = (await db.execute(
+        select(BlockingRule).where(BlockingRule.profile_id == profile.id)
+    )).scalars().all()
     rules_list = [
         {"pattern": r.pattern, "action": r.action}
-        for r in profile.blocking_rules
+        for r in rules
     ]
 
-    return {
+    response = {
         "status": "active",
         "idle_threshold_sec": profile.idle_threshold_sec,
         "screenshot_interval_sec": profile.screenshot_interval_sec,
@@ -153,79 +131,33 @@ async def handshake(req: HandshakeRequest, db: Session = Depends(get_db)):
         "blocking_rules": rules_list,
         "autofill_config": profile.autofill_config
     }
+    if agent_tokens.enabled:
+        # Дальше /telemetry и /screenshot авторизуются без обращения к Google
+        response["agent_token"] = agent_tokens.issue(req.email, TOKEN_TYPE_PROFILE)
+        response["agent_token_expires_in"] = agent_tokens.ttl_sec
+    return response
 
 
 @router.post("/telemetry")
-async def ingest_telemetry(batch: TelemetryBatch, db: Session = Depends(get_db)):
+async def ingest_telemetry(batch: TelemetryBatch, db: AsyncSession = Depends(get_db)):
     """
     Прием пачки логов (раз в минуту).
     """
-    verify_google_user(batch.auth_token, batch.email)
+    await verify_google_user(batch.auth_token, batch.email)
 
-    machine = db.query(Machine).filter(Machine.machine_id == batch.email).first()
-
-    if not machine:
-        machine = Machine(
-            id=uuid.uuid4(),
-            machine_id=batch.email,
-            machine_type="browser_extension",
-            user_label=f"Extension: {batch.email}",
-            is_active=True
-        )
-        db.add(machine)
-        db.commit()
-        db.refresh(machine)
+    # Write-behind режим: ack сразу после fsync в локальный спул
+    if await run_blocking(spool_batch, "telemetry", batch.model_dump(mode="json", include={"email", "events"})):
+        return {
+            "status": "ok",
+            "saved_events": len(batch.events),
+            "saved_clipboard": sum(len(e.clipboard_history or []) for e in batch.events),
+            "spooled": True,
+        }
 
-    machine.last_seen_at = datetime.now()
+    result = await db.run_sync(ingest_telemetry_events, batch.email, batch.events)
 
-    count = 0
-    clipboard_count = 0
-    
-    for item in batch.events:
-        event = ActivityEvent(
-            machine_id=machine.id,
-            timestamp=item.start_ts,
-            duration_seconds=item.duration_sec,
-
-            active_domain=item.domain,
-            active_url=item.url,
-            active_app="Google Chrome",
-            active_window=item.window_title or item.domain,
-
-            mouse_clicks=item.clicks,
-            key_count=item.keypresses,
-            scroll_count=item.scroll_px,
-            mouse_distance_px=item.mouse_px,
-            focus_time_sec=item.focus_time_sec,
-            
-            is_idle=item.is_idle,
-            agent_type="extension",
-            
-            # NEW fields
-            copy_count=item.copy_count,
-            paste_count=item.paste_count,
-            keys_array=item.keys_array if item.keys_array and len(item.keys_array) > 0 else None,
-            mouse_avg_speed=item.mouse_avg_speed,
-            extension_version=item.extension_version
-        )
-        db.add(event)
-        db.flush()  # Получаем ID для связи с clipboard_events
-        
-        # NEW: Сохраняем clipboard history в отдельную таблицу
-        if item.clipboard_history:
-            for clip_item in item.clipboard_history:
-                clipboard_event = ClipboardEvent(
-                    activity_event_id=event.id,
-                    action=clip_item.action,
-                    content=clip_item.text
-                )
-                db.add(clipboard_event)
-                clipboard_count += 1
-        
-        count += 1
-
-    db.commit()
-    return {"status": "ok", "saved_events": count, "saved_clipboard": clipboard_count}
+    await db.commit()
+    return {"status": "ok", **result}
 
 @router.post("/screenshot")
 async def upload_screenshot(
@@ -236,100 +168,58 @@ async def upload_screenshot(
     source_url: str = Form(None),
     source_domain: str = Form(None),
     source_window: str = Form(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """
     Принимает скриншот и загружает в S3 (Wasabi).
     """
     # 1. Авторизация
-    verify_google_user(auth_token, email)
+    await verify_google_user(auth_token, email)
 
     # 2. Валидация файла
-    if file.content_type not in ALLOWED_CONTENT_TYPES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid file type: {file.content_type}. Allowed: {ALLOWED_CONTENT_TYPES}"
-        )
-
-    contents = await file.read()
-    file_size_mb = len(contents) / (1024 * 1024)
-
-    if file_size_mb > MAX_FILE_SIZE_MB:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large: {file_size_mb:.1f}MB. Max: {MAX_FILE_SIZE_MB}MB"
-        )
+    size = storage.validate_screenshot(file)
 
     # 3. Находим машину
-    machine = db.query(Machine).filter(Machine.machine_id == email).first()
-    if not machine:
+    machine_uuid = await db.run_sync(lookup_machine_uuid, email)
+    if not machine_uuid:
         raise HTTPException(status_code=404, detail="Machine not initialized via telemetry yet")
 
-    # 4. Генерируем имя файла и S3 ключ
-    safe_email = sanitize_filename(email)
-    extension = file.content_type.split("/")[-1]
-    if extension == "jpeg":
-        extension = "jpg"
-    
-    # Структура: screenshots/2025/01/15/email_timestamp.jpg
-    dt = datetime.fromtimestamp(created_at_ts)
-    date_path = dt.strftime("%Y/%m/%d")
-    filename = f"{safe_email}_{int(created_at_ts)}.{extension}"
-    s3_key = f"{S3_SCREENSHOTS_PREFIX}{date_path}/{filename}"
-
-    # 5. Загружаем в S3
-    try:
-        s3 = get_s3_client()
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=s3_key,
-            Body=contents,
-            ContentType=file.content_type
-        )
-    except ClientError as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to upload to S3: {str(e)}"
-        )
-
-    # 6. Формируем URL для доступа
-    s3_url = f"{S3_ENDPOINT}/{S3_BUCKET}/{s3_key}"
-
-    # 7. Сохраняем в БД
+    # 4. Сохраняем: в локальный спул (загрузка в S3 в фоне) или сразу в S3
+    filename, s3_key = storage.screenshot_key(email, created_at_ts, file.content_type)
     screenshot = Screenshot(
-        machine_id=machine.id,
-        timestamp=dt,
-        image_path=s3_url,
-        thumbnail_path=s3_url,
+        machine_id=machine_uuid,
+        timestamp=datetime.fromtimestamp(created_at_ts),
         source_url=source_url,
         source_domain=source_domain,
         source_window=source_window
     )
-
-    db.add(screenshot)
-    db.commit()
+    upload_status = await store_screenshot(db, screenshot, file, s3_key, size)
 
     return {
         "status": "ok",
         "file": filename,
-        "s3_key": s3_key,
-        "url": s3_url
+        "s3_key": screenshot.storage_key,
+        "url": storage.object_url(screenshot.storage_key),
+        "upload_status": upload_status,
     }
 
 
 @router.post("/cookies-injected")
 async def mark_cookies_injected(
     request: Request,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     data = await request.json()
     cookie_ids = data.get("cookie_ids", [])
     
     if cookie_ids:
-        db.query(CookieVault).filter(
-            CookieVault.id.in_(cookie_ids)
-        ).update({CookieVault.injected_at: func.now()}, synchronize_session=False)
-        db.commit()
+        await db.execute(
+            update(CookieVault)
+            .where(CookieVault.id.in_(cookie_ids))
+            .values(injected_at=func.now())
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
     
     return {"status": "ok"}
 
@@ -349,7 +239,7 @@ class DiagnosticRequest(BaseModel):
     debug_log: Optional[List[dict]] = None
 
 @router.post("/diagnostic")
-async def save_diagnostic(req: DiagnosticRequest, db: Session = Depends(get_db)):
+async def save_diagnostic(req: DiagnosticRequest, db: AsyncSession = Depends(get_db)):
     """
     Сохраняет диагностику расширения.
     """
@@ -365,23 +255,23 @@ async def save_diagnostic(req: DiagnosticRequest, db: Session = Depends(get_db))
         debug_log=req.debug_log
     )
     db.add(diagnostic)
-    db.commit()
+    await db.commit()
     
     return {"status": "ok"}
 
 @router.get("/diagnostic")
-async def get_diagnostics(email: Optional[str] = None, db: Session = Depends(get_db)):
+async def get_diagnostics(email: Optional[str] = None, db: AsyncSession = Depends(get_db)):
     """
     Получает диагностику для просмотра.
     """
     from models import ExtensionDiagnostic
     
-    query = db.query(ExtensionDiagnostic).order_by(ExtensionDiagnostic.created_at.desc())
+    query = select(ExtensionDiagnostic).order_by(ExtensionDiagnostic.created_at.desc())
     
     if email:
-        query = query.filter(ExtensionDiagnostic.email == email)
+        query = query.where(ExtensionDiagnostic.email == email)
     
-    diagnostics = query.limit(50).all()
+    diagnostics = (await db.execute(query.limit(50))).scalars().all()
     
     return [
         {
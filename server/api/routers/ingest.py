@@ -1,107 +1,266 @@
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
+from fastapi import APIRouter, Depends, Header, HTTPException, UploadFile, File, Form, Query, Request
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy.sql import func
-from typing import List
+from typing import Optional
+from datetime import datetime
+from uuid import UUID
+import hmac
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
 
+from database import get_db, engine
+from models import Machine, Screenshot
+import storage
+from screenshot_spool import store_screenshot
+from blocking import run_blocking
+from body_codecs import DecodedBodyRoute, iter_decoded_stream, iter_lines
+from schemas import ActivityEventCreate, EventsBatch, DesktopRegisterRequest, AgentTokenResponse
+from bulk_ingest import resolve_machines, ingest_agent_events, guess_machine_type
+from ingest_spool import spool_batch
+from backfill import load_file, BACKFILL_FORMATS
+from agent_tokens import (
+    agent_tokens, desktop_agent_claims, check_machine_ids, bearer_token,
+    TOKEN_TYPE_MACHINE, AGENT_REGISTRATION_SECRET,
+)
 
-from database import get_db
-from models import Machine, ActivityEvent
-from schemas import ActivityEventCreate, EventsBatch
+logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/api", tags=["ingest"])
+# Потоковый NDJSON приём
+MAX_NDJSON_LINE_BYTES = 1024 * 1024
+MAX_REPORTED_ERRORS = 100
 
+router = APIRouter(prefix="/api", tags=["ingest"], route_class=DecodedBodyRoute)
 
-def get_or_create_machine(db: Session, machine_id: str, agent_type: str = "desktop") -> Machine:
-    """Найти машину или создать новую автоматически"""
-    machine = db.query(Machine).filter(Machine.machine_id == machine_id).first()
-    
-    if not machine:
-        machine = Machine(
-            machine_id=machine_id,
-            user_label=machine_id,  # по умолчанию = machine_id, потом можно переименовать
-            machine_type="vps" if "vm-" in machine_id else "local",
-            is_active=True
-        )
-        db.add(machine)
-        db.commit()
-        db.refresh(machine)
-    
-    return machine
+
+def get_or_create_machine_id(db: Session, machine_id: str) -> UUID:
+    """Найти машину или создать новую автоматически, вернуть Machine.id"""
+    return resolve_machines(db, {machine_id: {}})[machine_id]
+
+
+def create_new_machine(db: Session, machine_id: str, user_label: Optional[str]) -> bool:
+    """Создать машину; False, если machine_id уже существует"""
+    stmt = pg_insert(Machine).values(
+        machine_id=machine_id,
+        user_label=user_label or machine_id,
+        machine_type=guess_machine_type(machine_id),
+        is_active=True,
+    ).on_conflict_do_nothing(index_elements=[Machine.machine_id]).returning(Machine.id)
+    return db.execute(stmt).scalar() is not None
+
+
+@router.post("/desktop/register", response_model=AgentTokenResponse)
+async def register_desktop(
+    req: DesktopRegisterRequest,
+    db: AsyncSession = Depends(get_db),
+    authorization: Optional[str] = Header(None),
+):
+    """
+    Регистрация desktop агента: машина создаётся (если её нет) и получает
+    подписанный токен для Authorization: Bearer.
+
+    Без AGENT_REGISTRATION_SECRET токен получает только новая машина, а
+    существующая — в обмен на свой прежний токен (Authorization, можно
+    истёкший): иначе любой мог бы взять токен чужого machine_id.
+    """
+    if not agent_tokens.enabled:
+        raise HTTPException(status_code=503, detail="Agent tokens are not configured on this server")
+    if AGENT_REGISTRATION_SECRET:
+        if not hmac.compare_digest(
+            (req.registration_secret or "").encode(), AGENT_REGISTRATION_SECRET.encode()
+        ):
+            raise HTTPException(status_code=403, detail="Invalid registration secret")
+        await db.run_sync(resolve_machines, {req.machine_id: {"user_label": req.user_label}})
+    elif not await db.run_sync(create_new_machine, req.machine_id, req.user_label):
+        previous_token = bearer_token(authorization)
+        if previous_token is None:
+            raise HTTPException(
+                status_code=403,
+                detail="Machine is already registered: send its previous agent token or the registration secret",
+            )
+        agent_tokens.verify_renewal(previous_token, req.machine_id)
+    await db.commit()
+
+    return {
+        "status": "ok",
+        "machine_id": req.machine_id,
+        "agent_token": agent_tokens.issue(req.machine_id, TOKEN_TYPE_MACHINE),
+        "expires_in": agent_tokens.ttl_sec,
+    }
 
 
 @router.post("/events")
-async def receive_events(batch: EventsBatch, db: Session = Depends(get_db)):
+async def receive_events(
+    batch: EventsBatch,
+    db: AsyncSession = Depends(get_db),
+    claims: Optional[dict] = Depends(desktop_agent_claims),
+):
     """Приём пачки событий от агента"""
-    
-    processed = 0
-    machines_updated = set()
-    
-    for event_data in batch.events:
-        # Получить или создать машину
-        machine = get_or_create_machine(db, event_data.machine_id, event_data.agent_type)
-        machines_updated.add(machine.id)
-        
-        # Создать событие
-# Создать событие
-# Создать событие
-        event = ActivityEvent(
-            machine_id=machine.id,
-            timestamp=event_data.timestamp,
-            key_count=event_data.key_count,
-            mouse_clicks=event_data.mouse_clicks,
-            mouse_distance_px=event_data.mouse_distance_px,
-            scroll_count=event_data.scroll_count,
-            active_window=event_data.active_window,
-            active_app=event_data.active_app,
-            is_idle=event_data.is_idle,
-            active_url=event_data.active_url,
-            active_domain=event_data.active_domain,
-            tab_switches_count=event_data.tab_switches_count,
-            cpu_percent=event_data.cpu_percent,
-            ram_used_percent=event_data.ram_used_percent,
-            disk_used_percent=event_data.disk_used_percent,
-            agent_type=event_data.agent_type,
-            # NEW fields
-            duration_seconds=event_data.duration_seconds,
-            focus_time_sec=event_data.focus_time_sec,
-            copy_count=event_data.copy_count,
-            paste_count=event_data.paste_count,
-            keys_array=event_data.keys_array,
-            mouse_avg_speed=event_data.mouse_avg_speed,
-        )
-        db.add(event)
-        db.flush()  # ← ДОБАВЬ это, чтобы получить event.id
-        
-        # ← ДОБАВЬ весь этот блок:
-        # Сохраняем clipboard history в отдельную таблицу
-        if event_data.clipboard_history:
-            from models import ClipboardEvent
-            for clip_item in event_data.clipboard_history:
-                clipboard_event = ClipboardEvent(
-                    activity_event_id=event.id,
-                    action=clip_item.action,
-                    content=clip_item.text
-                )
-                db.add(clipboard_event)
-        
-        processed += 1
-    
-    # Обновить last_seen_at для всех затронутых машин
-    db.query(Machine).filter(Machine.id.in_(machines_updated)).update(
-        {Machine.last_seen_at: func.now()},
-        synchronize_session=False
-    )
-    
-    db.commit()
-    
-    return {"status": "ok", "processed": processed}
+    check_machine_ids(claims, {e.machine_id for e in batch.events})
+
+    # Write-behind режим: ack сразу после fsync в локальный спул
+    if await run_blocking(spool_batch, "events", batch.model_dump(mode="json")):
+        return {"status": "ok", "processed": len(batch.events), "spooled": True}
+
+    result = await db.run_sync(ingest_agent_events, batch.events)
+    await db.commit()
+
+    return {
+        "status": "ok",
+        "processed": result["processed"],
+        "inserted": result["inserted"],
+        "duplicates": result["duplicates"],
+    }
 
 
 @router.post("/event")
-async def receive_single_event(event_data: ActivityEventCreate, db: Session = Depends(get_db)):
+async def receive_single_event(
+    event_data: ActivityEventCreate,
+    db: AsyncSession = Depends(get_db),
+    claims: Optional[dict] = Depends(desktop_agent_claims),
+):
     """Приём одного события (для простоты тестирования)"""
     batch = EventsBatch(events=[event_data])
-    return await receive_events(batch, db)
+    return await receive_events(batch, db, claims)
+
+
+@router.post("/events/stream")
+async def receive_events_stream(
+    request: Request,
+    chunk_size: int = Query(default=500, ge=1, le=10000),
+    offset: int = Query(default=0, ge=0),
+    db: AsyncSession = Depends(get_db),
+    claims: Optional[dict] = Depends(desktop_agent_claims),
+):
+    """
+    Потоковый приём событий в формате NDJSON (одно ActivityEventCreate на строку).
+
+    Тело читается построчно и коммитится чанками по chunk_size строк, поэтому
+    память сервера не зависит от размера загрузки. После обрыва клиент
+    продолжает с ?offset=<committed_offset> (строки до offset пропускаются),
+    а повтор уже записанных строк безопасен благодаря дедупликации.
+    """
+    line_no = 0
+    chunk = []
+    chunk_start = offset
+    committed_offset = offset
+    chunks = []
+    errors = []
+    invalid = 0
+
+    async def commit_chunk():
+        nonlocal chunk, chunk_start, committed_offset
+        result = await db.run_sync(ingest_agent_events, chunk) if chunk else {"inserted": 0, "duplicates": 0}
+        await db.commit()
+        chunks.append({
+            "start": chunk_start,
+            "end": line_no,
+            "inserted": result["inserted"],
+            "duplicates": result["duplicates"],
+        })
+        committed_offset = chunk_start = line_no
+        chunk = []
+
+    try:
+        async for line in iter_lines(iter_decoded_stream(request), MAX_NDJSON_LINE_BYTES):
+            if line_no < offset or not line.strip():
+                line_no += 1
+                continue
+
+            try:
+                event = ActivityEventCreate.model_validate_json(line)
+                check_machine_ids(claims, [event.machine_id])
+                chunk.append(event)
+            except ValidationError as e:
+                invalid += 1
+                if len(errors) < MAX_REPORTED_ERRORS:
+                    errors.append({"line": line_no, "error": str(e.errors()[0]["msg"])})
+            line_no += 1
+
+            if line_no - chunk_start >= chunk_size:
+                await commit_chunk()
+
+        if line_no > chunk_start:
+            await commit_chunk()
+    except SQLAlchemyError as e:
+        await db.rollback()
+        logger.error(f"Stream ingest failed after offset {committed_offset}: {e}")
+        return JSONResponse(status_code=503, content={
+            "status": "error",
+            "detail": "Database error, resume from committed_offset",
+            "committed_offset": committed_offset,
+            "chunks": chunks,
+        })
+
+    return {
+        "status": "ok",
+        "lines": line_no,
+        "committed_offset": committed_offset,
+        "inserted": sum(c["inserted"] for c in chunks),
+        "duplicates": sum(c["duplicates"] for c in chunks),
+        "invalid": invalid,
+        "chunks": chunks,
+        "errors": errors,
+    }
+
+
+def run_backfill(upload, fmt: Optional[str], machine_id: Optional[str], include_sent: bool) -> dict:
+    """
+    Бэкфилл в отдельном потоке: COPY идёт через psycopg2 соединение
+    синхронного движка (у asyncpg другой API для COPY).
+    """
+    # SQLite нужен путь к файлу, поэтому сохраняем загрузку во временный файл
+    suffix = os.path.splitext(upload.filename or "")[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+        shutil.copyfileobj(upload.file, tmp)
+        tmp.flush()
+
+        def report(stats):
+            logger.info(f"Backfill {upload.filename}: read={stats['read']} staged={stats['staged']}")
+
+        raw_conn = engine.raw_connection()
+        try:
+            stats = load_file(raw_conn, tmp.name, fmt, machine_id, include_sent, progress=report)
+            raw_conn.commit()
+        except (ValueError, sqlite3.DatabaseError, json.JSONDecodeError) as e:
+            raw_conn.rollback()
+            raise HTTPException(status_code=400, detail=f"Cannot read backfill file: {e}")
+        except Exception:
+            raw_conn.rollback()
+            raise
+        finally:
+            raw_conn.close()
+
+    return stats
+
+
+@router.post("/events/backfill")
+async def backfill_events(
+    file: UploadFile = File(...),
+    format: Optional[str] = Form(None),
+    machine_id: Optional[str] = Form(None),
+    include_sent: bool = Form(False),
+    claims: Optional[dict] = Depends(desktop_agent_claims),
+):
+    """
+    Загрузка бэклога агента целиком: buffer.db (SQLite) или NDJSON/CSV
+    выгрузка его таблицы events. Грузится через COPY, дубликаты пропускаются.
+    """
+    if format is not None and format not in BACKFILL_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Invalid format: {format}. Allowed: {BACKFILL_FORMATS}")
+    if claims is not None:
+        # С токеном машины весь бэклог пишется от её имени
+        machine_id = claims["sub"]
+
+    stats = await run_blocking(run_backfill, file, format, machine_id, include_sent)
+    return {"status": "ok", **stats}
 
 
 @router.post("/desktop/screenshot")
@@ -111,106 +270,32 @@ async def upload_desktop_screenshot(
     created_at_ts: float = Form(...),
     source_window: str = Form(None),
     source_app: str = Form(None),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    claims: Optional[dict] = Depends(desktop_agent_claims),
 ):
     """
     Принимает скриншот от desktop трекера и загружает в S3.
     """
-    from datetime import datetime
-    import uuid
-    import os
-    import boto3
-    from botocore.exceptions import ClientError
-    
-    # S3 config
-    S3_ENDPOINT = os.getenv("S3_ENDPOINT", "https://s3.wasabisys.com")
-    S3_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
-    S3_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
-    S3_BUCKET = os.getenv("S3_BUCKET", "instaloader")
-    S3_SCREENSHOTS_PREFIX = "screenshots/"
-    
-    ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp"}
-    MAX_FILE_SIZE_MB = 5
+    check_machine_ids(claims, [machine_id])
 
     # 1. Валидация файла
-    if file.content_type not in ALLOWED_CONTENT_TYPES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Invalid file type: {file.content_type}"
-        )
-
-    contents = await file.read()
-    file_size_mb = len(contents) / (1024 * 1024)
-
-    if file_size_mb > MAX_FILE_SIZE_MB:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large: {file_size_mb:.1f}MB"
-        )
+    size = storage.validate_screenshot(file)
 
     # 2. Находим или создаём машину
-    machine = db.query(Machine).filter(Machine.machine_id == machine_id).first()
-    if not machine:
-        machine = Machine(
-            machine_id=machine_id,
-            user_label=machine_id,
-            machine_type="vps" if "vm-" in machine_id else "local",
-            is_active=True
-        )
-        db.add(machine)
-        db.commit()
-        db.refresh(machine)
-
-    # 3. Генерируем имя файла
-    import re
-    safe_id = re.sub(r'[^a-zA-Z0-9._-]', '_', machine_id)
-    extension = file.content_type.split("/")[-1]
-    if extension == "jpeg":
-        extension = "jpg"
-    
-    dt = datetime.fromtimestamp(created_at_ts)
-    date_path = dt.strftime("%Y/%m/%d")
-    filename = f"{safe_id}_{int(created_at_ts)}.{extension}"
-    s3_key = f"{S3_SCREENSHOTS_PREFIX}{date_path}/{filename}"
-
-    # 4. Загружаем в S3
-    try:
-        s3 = boto3.client(
-            's3',
-            endpoint_url=S3_ENDPOINT,
-            aws_access_key_id=S3_ACCESS_KEY,
-            aws_secret_access_key=S3_SECRET_KEY
-        )
-        s3.put_object(
-            Bucket=S3_BUCKET,
-            Key=s3_key,
-            Body=contents,
-            ContentType=file.content_type
-        )
-    except ClientError as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Failed to upload to S3: {str(e)}"
-        )
-
-    # 5. URL для доступа
-    s3_url = f"{S3_ENDPOINT}/{S3_BUCKET}/{s3_key}"
-
-    # 6. Сохраняем в БД
-    from models import Screenshot
+    machine_uuid = await db.run_sync(get_or_create_machine_id, machine_id)
+
+    # 3. Сохраняем: в локальный спул (загрузка в S3 в фоне) или сразу в S3
+    filename, s3_key = storage.screenshot_key(machine_id, created_at_ts, file.content_type)
     screenshot = Screenshot(
-        machine_id=machine.id,
-        timestamp=dt,
-        image_path=s3_url,
-        thumbnail_path=s3_url,
+        machine_id=machine_uuid,
+        timestamp=datetime.fromtimestamp(created_at_ts),
         source_window=source_window,
     )
-
-    db.add(screenshot)
-    db.commit()
+    upload_status = await store_screenshot(db, screenshot, file, s3_key, size)
 
     return {
         "status": "ok",
         "file": filename,
-        "url": s3_url
-    }
\ No newline at end of file
+        "url": storage.object_url(screenshot.storage_key),
+        "upload_status": upload_status,
+    }
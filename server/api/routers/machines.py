@@ -1,52 +1,72 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import delete, or_, select
 from typing import List
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
 from database import get_db
-from models import Machine, ActivityEvent
+from models import (
+    Machine, ActivityEvent, ActivityArchive, ClipboardEvent,
+    ActivityEventHourly, ActivityRollup5m, ActivityRollupHourly, ActivityRollupDaily,
+)
 from schemas import MachineResponse, MachineUpdate
+from machine_cache import machine_cache
+from heartbeat import heartbeats
+from blocking import run_blocking
+import archive
 
 router = APIRouter(prefix="/api/machines", tags=["machines"])
 
 
+def with_pending_heartbeat(machine: Machine) -> MachineResponse:
+    """Ответ с last_seen_at, учитывающим ещё не сброшенный heartbeat"""
+    response = MachineResponse.model_validate(machine)
+    response.last_seen_at = heartbeats.last_seen(machine.id, machine.last_seen_at)
+    return response
+
+
+async def get_machine_or_404(db: AsyncSession, machine_id: str) -> Machine:
+    machine = (await db.execute(select(Machine).where(Machine.machine_id == machine_id))).scalars().first()
+    if not machine:
+        raise HTTPException(status_code=404, detail="Machine not found")
+    return machine
+
+
 @router.get("/", response_model=List[MachineResponse])
 async def list_machines(
     active_only: bool = False,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Список всех машин"""
-    query = db.query(Machine)
+    query = select(Machine)
     
     if active_only:
         # Считаем активной если была активность за последние 10 минут
-        threshold = datetime.utcnow() - timedelta(minutes=10)
-        query = query.filter(Machine.last_seen_at >= threshold)
+        threshold = datetime.now(timezone.utc) - timedelta(minutes=10)
+        # + машины, чей свежий heartbeat ещё не записан в БД
+        recent = [machine_uuid for machine_uuid, seen_at in heartbeats.pending().items() if seen_at >= threshold]
+        query = query.where(or_(Machine.last_seen_at >= threshold, Machine.id.in_(recent)))
     
-    machines = query.order_by(desc(Machine.last_seen_at)).all()
+    machines = [with_pending_heartbeat(m) for m in (await db.execute(query)).scalars()]
+    machines.sort(key=lambda m: m.last_seen_at, reverse=True)
     return machines
 
 
 @router.get("/{machine_id}", response_model=MachineResponse)
-async def get_machine(machine_id: str, db: Session = Depends(get_db)):
+async def get_machine(machine_id: str, db: AsyncSession = Depends(get_db)):
     """Получить информацию о машине"""
-    machine = db.query(Machine).filter(Machine.machine_id == machine_id).first()
-    if not machine:
-        raise HTTPException(status_code=404, detail="Machine not found")
-    return machine
+    machine = await get_machine_or_404(db, machine_id)
+    return with_pending_heartbeat(machine)
 
 
 @router.patch("/{machine_id}", response_model=MachineResponse)
 async def update_machine(
     machine_id: str,
     update: MachineUpdate,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Обновить информацию о машине (например, user_label)"""
-    machine = db.query(Machine).filter(Machine.machine_id == machine_id).first()
-    if not machine:
-        raise HTTPException(status_code=404, detail="Machine not found")
+    machine = await get_machine_or_404(db, machine_id)
     
     if update.user_label is not None:
         machine.user_label = update.user_label
@@ -55,23 +75,50 @@ async def update_machine(
     if update.is_active is not None:
         machine.is_active = update.is_active
     
-    db.commit()
-    db.refresh(machine)
-    return machine
+    await db.commit()
+    await db.refresh(machine)
+    machine_cache.invalidate(machine_id)
+    return with_pending_heartbeat(machine)
 
 
 @router.delete("/{machine_id}")
-async def delete_machine(machine_id: str, db: Session = Depends(get_db)):
+async def delete_machine(machine_id: str, db: AsyncSession = Depends(get_db)):
     """Удалить машину и все её события"""
-    machine = db.query(Machine).filter(Machine.machine_id == machine_id).first()
-    if not machine:
-        raise HTTPException(status_code=404, detail="Machine not found")
+    machine = await get_machine_or_404(db, machine_id)
     
+    # Clipboard записи событий машины: внешнего ключа с каскадом у
+    # партиционированной clipboard_events нет, удаляем явно до событий
+    await db.execute(delete(ClipboardEvent).where(ClipboardEvent.activity_event_id.in_(
+        select(ActivityEvent.id).where(ActivityEvent.machine_id == machine.id)
+    )))
+
     # Удалить все события
-    db.query(ActivityEvent).filter(ActivityEvent.machine_id == machine.id).delete()
+    await db.execute(delete(ActivityEvent).where(ActivityEvent.machine_id == machine.id))
+
+    # Прореженная история retention.py (с top_app/top_domain)
+    await db.execute(delete(ActivityEventHourly).where(ActivityEventHourly.machine_id == machine.id))
+
+    # Агрегаты rollups.py (внешнего ключа на machines у них нет)
+    for model in (ActivityRollup5m, ActivityRollupHourly, ActivityRollupDaily):
+        await db.execute(delete(model).where(model.machine_id == machine.id))
+
+    # Манифест холодного архива (файлы удаляются после commit)
+    archived = (await db.execute(
+        delete(ActivityArchive)
+        .where(ActivityArchive.machine_id == machine.id)
+        .returning(ActivityArchive.storage, ActivityArchive.location)
+    )).all()
     
     # Удалить машину
-    db.delete(machine)
-    db.commit()
+    await db.delete(machine)
+    await db.commit()
+    machine_cache.invalidate(machine_id)
+
+    archive_errors = await run_blocking(archive.delete_files, archived) if archived else 0
     
-    return {"status": "deleted", "machine_id": machine_id}
+    return {
+        "status": "deleted",
+        "machine_id": machine_id,
+        "archive_files_deleted": len(archived) - archive_errors,
+        "archive_files_failed": archive_errors,
+    }
@@ -0,0 +1,16 @@
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import get_db
+from schemas import RevokeTokenRequest
+from agent_tokens import revoke_token
+
+router = APIRouter(prefix="/api/tokens", tags=["tokens"])
+
+
+@router.post("/revoke")
+async def revoke(req: RevokeTokenRequest, db: AsyncSession = Depends(get_db)):
+    """Отозвать подписанный токен агента или расширения"""
+    claims = await db.run_sync(revoke_token, req.token)
+    await db.commit()
+    return {"status": "revoked", "jti": claims["jti"], "sub": claims["sub"]}
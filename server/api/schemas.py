@@ -1,15 +1,40 @@
-from pydantic import BaseModel
+from pydantic import Base64Bytes, BaseModel, Field, field_validator, model_validator
 from typing import Optional, List, Any
 from datetime import datetime
 from uuid import UUID
 
+from keystrokes import decode_keys, encode_keys
+
 class ClipboardItem(BaseModel):
     action: str  # 'copy' or 'paste'
     text: str
 
-class ActivityEventCreate(BaseModel):
+class PackedKeysMixin(BaseModel):
+    """
+    Нажатые клавиши: keys_packed (base64 формата keystrokes.py) или старый
+    keys_array. После валидации остаётся только keys_packed.
+    """
+    keys_array: Optional[List[str]] = None
+    keys_packed: Optional[Base64Bytes] = None
+
+    @field_validator("keys_packed")
+    @classmethod
+    def check_keys_packed(cls, value):
+        if value:
+            decode_keys(value)
+        return value or None
+
+    @model_validator(mode="after")
+    def pack_keys_array(self):
+        if self.keys_packed is None and self.keys_array:
+            self.keys_packed = encode_keys(self.keys_array)
+        self.keys_array = None
+        return self
+
+class ActivityEventCreate(PackedKeysMixin):
     machine_id: str
     timestamp: datetime
+    client_event_id: Optional[str] = Field(default=None, max_length=64)  # для безопасных ретраев
     
     # Активность пользователя
     key_count: int = 0
@@ -30,7 +55,6 @@ class ActivityEventCreate(BaseModel):
     focus_time_sec: Optional[int] = 0
     copy_count: Optional[int] = 0
     paste_count: Optional[int] = 0
-    keys_array: Optional[List[str]] = None
     mouse_avg_speed: Optional[float] = None
     clipboard_history: Optional[List['ClipboardItem']] = None  # ← ДОБАВЬ ЭТО
 
@@ -107,15 +131,19 @@ class AgentConfigResponse(BaseModel):
     cookies: List[CookieData]
     blocking_rules: List[BlockingRuleData]
     autofill_config: Optional[dict] = None
+    # Подписанный токен для /telemetry и /screenshot (без обращения к Google)
+    agent_token: Optional[str] = None
+    agent_token_expires_in: Optional[int] = None
 
 # 2. Телеметрия (Логи)
 
-class ExtensionSessionEvent(BaseModel):
+class ExtensionSessionEvent(PackedKeysMixin):
     url: str
     domain: str
     window_title: Optional[str] = None
     start_ts: datetime
     duration_sec: int
+    client_event_id: Optional[str] = Field(default=None, max_length=64)  # для безопасных ретраев
     focus_time_sec: int = 0
     is_idle: bool
     
@@ -128,7 +156,6 @@ class ExtensionSessionEvent(BaseModel):
     # NEW fields
     copy_count: int = 0
     paste_count: int = 0
-    keys_array: Optional[List[str]] = None
     clipboard_history: Optional[List[ClipboardItem]] = None
     mouse_avg_speed: Optional[float] = None
     extension_version: Optional[str] = None
@@ -136,4 +163,22 @@ class ExtensionSessionEvent(BaseModel):
 class TelemetryBatch(BaseModel):
     email: str
     auth_token: Optional[str] = None
-    events: List[ExtensionSessionEvent]
\ No newline at end of file
+    events: List[ExtensionSessionEvent]
+
+# ============ ТОКЕНЫ АГЕНТОВ ============
+
+class DesktopRegisterRequest(BaseModel):
+    machine_id: str
+    user_label: Optional[str] = None
+    registration_secret: Optional[str] = None
+
+
+class AgentTokenResponse(BaseModel):
+    status: str
+    machine_id: str
+    agent_token: str
+    expires_in: int
+
+
+class RevokeTokenRequest(BaseModel):
+    token: str
@@ -0,0 +1,387 @@
+"""
+Локальный спул скриншотов + фоновая загрузка в S3.
+
+Если задан SCREENSHOT_SPOOL_DIR, эндпоинты скриншотов не ждут Wasabi:
+файл копируется на локальный диск (fsync), строка Screenshot пишется
+с upload_status='pending' и image_path=NULL, и клиент сразу получает 200.
+Пул из SCREENSHOT_UPLOAD_WORKERS потоков загружает файлы в S3 с
+ретраями и экспоненциальной паузой, затем проставляет image_path /
+thumbnail_path и upload_status='uploaded'.
+
+Файл спула называется по id строки screenshots, ключ S3 хранится
+в screenshots.storage_key, поэтому после рестарта очередь
+восстанавливается простым просмотром каталога.
+
+Перед загрузкой считается md5 файла (screenshots.content_hash). Если
+такой файл этой же машины уже лежит в S3 (простаивающая машина шлёт
+одинаковые кадры), новая строка ссылается на существующий объект и PUT
+не делается. Между машинами объекты не делятся: у каждой свои ключи,
+удаление и хранение.
+"""
+
+import heapq
+import logging
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Optional
+
+from botocore.exceptions import BotoCoreError, ClientError
+from fastapi import UploadFile
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from database import SessionLocal
+from models import Screenshot
+from blocking import run_blocking
+import storage
+
+logger = logging.getLogger(__name__)
+
+SCREENSHOT_SPOOL_DIR = os.getenv("SCREENSHOT_SPOOL_DIR", "")
+SCREENSHOT_SPOOL_MAX_MB = int(os.getenv("SCREENSHOT_SPOOL_MAX_MB", "2048"))
+SCREENSHOT_UPLOAD_WORKERS = int(os.getenv("SCREENSHOT_UPLOAD_WORKERS", "4"))
+# После стольких неудачных попыток строка получает upload_status='failed',
+# а файл переносится в <spool>/failed
+SCREENSHOT_UPLOAD_MAX_ATTEMPTS = int(os.getenv("SCREENSHOT_UPLOAD_MAX_ATTEMPTS", "12"))
+SCREENSHOT_UPLOAD_MAX_BACKOFF_SEC = float(os.getenv("SCREENSHOT_UPLOAD_MAX_BACKOFF_SEC", "600"))
+
+UPLOAD_PENDING = "pending"
+UPLOAD_DONE = "uploaded"
+UPLOAD_FAILED = "failed"
+
+FAILED_DIR = "failed"
+
+class DedupeStats:
+    """Счётчики дедупликации по content_hash (см. /stats)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def hit(self, size: int):
+        with self._lock:
+            self.hits += 1
+            self.bytes_saved += size
+
+    def miss(self):
+        with self._lock:
+            self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "bytes_saved": self.bytes_saved}
+
+
+dedupe_stats = DedupeStats()
+
+
+class ScreenshotSpool:
+    """Каталог файлов <screenshot_id> + очередь с отложенными ретраями"""
+
+    def __init__(self, directory: str, max_bytes: int, workers: int,
+                 max_attempts: int, max_backoff_sec: float):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.max_backoff_sec = max_backoff_sec
+
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._queue = []              # heap (due_at, screenshot_id)
+        self._attempts = {}           # screenshot_id -> число неудачных попыток
+        self._total_bytes = 0
+        self._reserved_bytes = 0
+        self._stopping = threading.Event()
+        self._threads = []
+
+        self.spooled = 0
+        self.uploaded = 0
+        self.upload_errors = 0
+        self.failed = 0
+        self.rejected_full = 0
+
+    # ---------- lifecycle ----------
+
+    def start(self):
+        """Восстановить очередь из каталога и запустить загрузчики"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / FAILED_DIR).mkdir(exist_ok=True)
+
+        now = time.monotonic()
+        with self._lock:
+            for path in self.directory.iterdir():
+                if path.is_file() and path.name.isdigit():
+                    self._total_bytes += path.stat().st_size
+                    heapq.heappush(self._queue, (now, int(path.name)))
+                elif path.is_file():
+                    # Недописанный файл (процесс упал во время копирования)
+                    path.unlink()
+        if self._queue:
+            logger.info(f"Screenshot spool: recovering {len(self._queue)} pending uploads ({self._total_bytes} bytes)")
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"screenshot-uploader-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        with self._ready:
+            self._ready.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=30)
+
+    # ---------- write path ----------
+
+    def reserve(self, size: int) -> bool:
+        """Зарезервировать место под файл; False — спул переполнен"""
+        with self._lock:
+            if self._total_bytes + self._reserved_bytes + size > self.max_bytes:
+                self.rejected_full += 1
+                return False
+            self._reserved_bytes += size
+            return True
+
+    def release(self, size: int):
+        with self._lock:
+            self._reserved_bytes = max(0, self._reserved_bytes - size)
+
+    def write(self, screenshot_id: int, fileobj: BinaryIO, size: int):
+        """
+        Скопировать файл в спул (с fsync). Вызывать из пула потоков,
+        после reserve(); запись станет видна загрузчикам после enqueue().
+        """
+        tmp_path = self.directory / f"{screenshot_id}.tmp"
+        fileobj.seek(0)
+        try:
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(fileobj, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self._path(screenshot_id))
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+        with self._lock:
+            self._reserved_bytes = max(0, self._reserved_bytes - size)
+            self._total_bytes += size
+
+    def discard(self, screenshot_id: int):
+        """Убрать файл, строка для которого не была закоммичена"""
+        path = self._path(screenshot_id)
+        if path.exists():
+            size = path.stat().st_size
+            path.unlink()
+            with self._lock:
+                self._total_bytes = max(0, self._total_bytes - size)
+
+    def enqueue(self, screenshot_id: int):
+        with self._ready:
+            heapq.heappush(self._queue, (time.monotonic(), screenshot_id))
+            self.spooled += 1
+            self._ready.notify()
+
+    def _path(self, screenshot_id: int) -> Path:
+        return self.directory / str(screenshot_id)
+
+    # ---------- upload path ----------
+
+    def _next(self) -> Optional[int]:
+        with self._ready:
+            while not self._stopping.is_set():
+                if self._queue:
+                    due_at, screenshot_id = self._queue[0]
+                    wait = due_at - time.monotonic()
+                    if wait <= 0:
+                        heapq.heappop(self._queue)
+                        return screenshot_id
+                    self._ready.wait(wait)
+                else:
+                    self._ready.wait()
+        return None
+
+    def _worker(self):
+        while True:
+            screenshot_id = self._next()
+            if screenshot_id is None:
+                return
+            try:
+                self._upload(screenshot_id)
+            except Exception as e:
+                self._retry(screenshot_id, e)
+
+    def _upload(self, screenshot_id: int):
+        path = self._path(screenshot_id)
+        db = SessionLocal()
+        try:
+            row = db.execute(
+                select(Screenshot.storage_key, Screenshot.upload_status).where(Screenshot.id == screenshot_id)
+            ).first()
+            if row is None or row.upload_status != UPLOAD_PENDING or not row.storage_key:
+                # Строка не закоммичена или уже обработана — файл больше не нужен
+                logger.warning(f"Screenshot spool: dropping {screenshot_id}, no pending row")
+                self.discard(screenshot_id)
+                return
+
+            size = path.stat().st_size
+            content_type = storage.content_type_for_key(row.storage_key)
+            with open(path, "rb") as f:
+                storage.put_fileobj(f, row.storage_key, size, content_type)
+
+            url = storage.object_url(row.storage_key)
+            db.execute(
+                update(Screenshot)
+                .where(Screenshot.id == screenshot_id)
+                .values(image_path=url, thumbnail_path=url, upload_status=UPLOAD_DONE)
+            )
+            db.commit()
+        finally:
+            db.close()
+
+        self.discard(screenshot_id)
+        with self._lock:
+            self._attempts.pop(screenshot_id, None)
+        self.uploaded += 1
+
+    def _retry(self, screenshot_id: int, error: Exception):
+        self.upload_errors += 1
+        with self._lock:
+            attempts = self._attempts.get(screenshot_id, 0) + 1
+            self._attempts[screenshot_id] = attempts
+
+        if attempts >= self.max_attempts:
+            logger.error(f"Screenshot spool: giving up on {screenshot_id} after {attempts} attempts: {error}")
+            self._give_up(screenshot_id)
+            return
+
+        backoff = min(2 ** attempts, self.max_backoff_sec)
+        if not isinstance(error, (ClientError, BotoCoreError)):
+            logger.error(f"Screenshot spool: upload of {screenshot_id} failed: {error}")
+        logger.warning(f"Screenshot spool: retry {screenshot_id} in {backoff:.0f}s (attempt {attempts})")
+        with self._ready:
+            heapq.heappush(self._queue, (time.monotonic() + backoff, screenshot_id))
+            self._ready.notify()
+
+    def _give_up(self, screenshot_id: int):
+        path = self._path(screenshot_id)
+        db = SessionLocal()
+        try:
+            db.execute(
+                update(Screenshot)
+                .where(Screenshot.id == screenshot_id)
+                .values(upload_status=UPLOAD_FAILED)
+            )
+            db.commit()
+        except Exception as e:
+            # Файл уже отложен в failed/, статус останется pending
+            logger.error(f"Screenshot spool: cannot mark {screenshot_id} as failed: {e}")
+        finally:
+            db.close()
+
+        if path.exists():
+            size = path.stat().st_size
+            path.rename(self.directory / FAILED_DIR / path.name)
+            with self._lock:
+                self._total_bytes = max(0, self._total_bytes - size)
+        with self._lock:
+            self._attempts.pop(screenshot_id, None)
+        self.failed += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": True,
+                "queued": len(self._queue),
+                "pending_bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "workers": self.workers,
+                "spooled": self.spooled,
+                "uploaded": self.uploaded,
+                "upload_errors": self.upload_errors,
+                "failed": self.failed,
+                "rejected_full": self.rejected_full,
+            }
+
+
+screenshot_spool: Optional[ScreenshotSpool] = None
+if SCREENSHOT_SPOOL_DIR:
+    screenshot_spool = ScreenshotSpool(
+        SCREENSHOT_SPOOL_DIR,
+        max_bytes=SCREENSHOT_SPOOL_MAX_MB * 1024 * 1024,
+        workers=SCREENSHOT_UPLOAD_WORKERS,
+        max_attempts=SCREENSHOT_UPLOAD_MAX_ATTEMPTS,
+        max_backoff_sec=SCREENSHOT_UPLOAD_MAX_BACKOFF_SEC,
+    )
+
+
+async def find_uploaded_duplicate(db: AsyncSession, machine_id, content_hash: str):
+    """(storage_key, image_path, thumbnail_path) уже загруженного файла машины с тем же md5"""
+    result = await db.execute(
+        select(Screenshot.storage_key, Screenshot.image_path, Screenshot.thumbnail_path)
+        .where(
+            Screenshot.machine_id == machine_id,
+            Screenshot.content_hash == content_hash,
+            Screenshot.image_path.isnot(None),
+            Screenshot.upload_status == UPLOAD_DONE,
+        )
+        .order_by(Screenshot.id.desc())
+        .limit(1)
+    )
+    return result.first()
+
+
+async def store_screenshot(db: AsyncSession, screenshot: Screenshot, file: UploadFile, s3_key: str, size: int) -> str:
+    """
+    Сохранить скриншот: сослаться на уже загруженный объект этой машины
+    с тем же содержимым, иначе через локальный спул, если он включён и не
+    переполнен, иначе сразу в S3. Коммитит строку, возвращает upload_status.
+    Итоговый ключ объекта — screenshot.storage_key.
+    """
+    screenshot.content_hash = await run_blocking(storage.file_md5, file.file)
+    duplicate = await find_uploaded_duplicate(db, screenshot.machine_id, screenshot.content_hash)
+    if duplicate is not None:
+        dedupe_stats.hit(size)
+        screenshot.storage_key = duplicate.storage_key
+        screenshot.image_path = duplicate.image_path
+        screenshot.thumbnail_path = duplicate.thumbnail_path or duplicate.image_path
+        screenshot.upload_status = UPLOAD_DONE
+        db.add(screenshot)
+        await db.commit()
+        return UPLOAD_DONE
+    dedupe_stats.miss()
+
+    screenshot.storage_key = s3_key
+
+    if screenshot_spool is None or not screenshot_spool.reserve(size):
+        url = await storage.upload_screenshot(file, s3_key, size)
+        screenshot.image_path = url
+        screenshot.thumbnail_path = url
+        screenshot.upload_status = UPLOAD_DONE
+        db.add(screenshot)
+        await db.commit()
+        return UPLOAD_DONE
+
+    # image_path появится после загрузки (hash-worker такие строки пропускает)
+    screenshot.upload_status = UPLOAD_PENDING
+    db.add(screenshot)
+    try:
+        await db.flush()
+        await run_blocking(screenshot_spool.write, screenshot.id, file.file, size)
+    except BaseException:
+        screenshot_spool.release(size)
+        raise
+
+    try:
+        await db.commit()
+    except BaseException:
+        await run_blocking(screenshot_spool.discard, screenshot.id)
+        raise
+
+    screenshot_spool.enqueue(screenshot.id)
+    return UPLOAD_PENDING
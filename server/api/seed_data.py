@@ -7,10 +7,14 @@
 import random
 from datetime import datetime, timedelta
 from database import SessionLocal, engine
-from models import Base, Machine, ActivityEvent
+from models import Base, Machine, ActivityEvent, ActivityRollup5m, ActivityRollupHourly, ActivityRollupDaily, AppName, WindowTitle
+from migrations import run_migrations
+from rollups import rebuild
+from string_dict import intern_strings
 
-# Создаём таблицы если не существуют
+# Создаём таблицы (и партиции activity_events) если не существуют
 Base.metadata.create_all(bind=engine)
+run_migrations(engine)
 
 
 def generate_activity_pattern(hour: int, worker_type: str) -> dict:
@@ -81,6 +85,12 @@ def seed_data():
                 db.query(Machine.id).filter(Machine.machine_id.like("vm-seed-%"))
             )
         ).delete(synchronize_session=False)
+        for rollup in (ActivityRollup5m, ActivityRollupHourly, ActivityRollupDaily):
+            db.query(rollup).filter(
+                rollup.machine_id.in_(
+                    db.query(Machine.id).filter(Machine.machine_id.like("vm-seed-%"))
+                )
+            ).delete(synchronize_session=False)
         db.query(Machine).filter(Machine.machine_id.like("vm-seed-%")).delete()
         db.commit()
         
@@ -115,6 +125,9 @@ def seed_data():
             "Slack - Team Chat",
             "Figma - Design v2"
         ]
+        app_ids = intern_strings(db, AppName, apps)
+        window_ids = intern_strings(db, WindowTitle, windows)
+        db.commit()
         
         total_events = 0
         
@@ -147,8 +160,8 @@ def seed_data():
                             mouse_clicks=int(pattern["mouse_clicks"] * variation / 60) if not is_idle else 0,
                             mouse_distance_px=int(pattern["mouse_distance_px"] * variation / 60) if not is_idle else 0,
                             scroll_count=int(pattern["scroll_count"] * variation / 60) if not is_idle else 0,
-                            active_window=random.choice(windows) if not is_idle else None,
-                            active_app=random.choice(apps) if not is_idle else None,
+                            window_id=window_ids[random.choice(windows)] if not is_idle else None,
+                            app_id=app_ids[random.choice(apps)] if not is_idle else None,
                             is_idle=is_idle,
                             cpu_percent=round(pattern["cpu_percent"] * random.uniform(0.8, 1.2), 1),
                             ram_used_percent=round(pattern["ram_used_percent"] * random.uniform(0.95, 1.05), 1),
@@ -163,6 +176,10 @@ def seed_data():
             
             print(f"Generated data for {day_start.date()}")
         
+        # Агрегаты для dashboard (события вставлены через ORM, мимо bulk_ingest)
+        for machine, _ in machines:
+            rebuild((now - timedelta(days=7)).date(), now.date(), machine.machine_id)
+        
         print(f"\nTotal events created: {total_events}")
         print("Seed data complete!")
         
@@ -0,0 +1,142 @@
+"""
+S3 (Wasabi) для скриншотов: один клиент на процесс и потоковая загрузка.
+
+boto3 клиент потокобезопасен, но создавать его дорого (сессия, загрузка
+моделей сервисов, новый пул соединений), поэтому он создаётся один раз
+с пулом на S3_MAX_POOL_CONNECTIONS соединений.
+
+Загрузка идёт прямо из временного файла UploadFile (Starlette уже
+сбросил большое тело на диск) в потоке blocking пула: файл не читается
+в память целиком и event loop не блокируется.
+
+Для локальной разработки S3_ENDPOINT можно направить на MinIO или
+moto_server (path-style адресация включена по умолчанию).
+"""
+
+import hashlib
+import os
+import re
+import threading
+from datetime import datetime
+from typing import BinaryIO, Optional
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from fastapi import HTTPException, UploadFile
+
+from blocking import run_blocking
+
+S3_ENDPOINT = os.getenv("S3_ENDPOINT", "https://s3.wasabisys.com")
+S3_ACCESS_KEY = os.getenv("AWS_ACCESS_KEY")
+S3_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+S3_BUCKET = os.getenv("S3_BUCKET", "instaloader")
+S3_REGION = os.getenv("S3_REGION") or None
+S3_ADDRESSING_STYLE = os.getenv("S3_ADDRESSING_STYLE", "path")
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+S3_SCREENSHOTS_PREFIX = "screenshots/"  # Папка внутри бакета
+
+# Ограничения на скриншоты
+MAX_FILE_SIZE_MB = 5
+MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024
+ALLOWED_CONTENT_TYPES = {"image/jpeg", "image/png", "image/webp"}
+EXTENSION_CONTENT_TYPES = {"jpg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_s3_client():
+    """Общий S3 клиент процесса (создаётся при первом обращении)"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = boto3.session.Session().client(
+                    "s3",
+                    endpoint_url=S3_ENDPOINT,
+                    aws_access_key_id=S3_ACCESS_KEY,
+                    aws_secret_access_key=S3_SECRET_KEY,
+                    region_name=S3_REGION,
+                    config=Config(
+                        max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                        s3={"addressing_style": S3_ADDRESSING_STYLE},
+                        retries={"max_attempts": 3, "mode": "standard"},
+                        connect_timeout=5,
+                        read_timeout=30,
+                    ),
+                )
+    return _client
+
+
+def object_url(key: str) -> str:
+    return f"{S3_ENDPOINT}/{S3_BUCKET}/{key}"
+
+
+def screenshot_key(owner: str, created_at_ts: float, content_type: str) -> tuple:
+    """
+    (filename, s3_key) для скриншота.
+    Структура: screenshots/2025/01/15/<owner>_<timestamp>.jpg
+    """
+    safe_owner = re.sub(r'[^a-zA-Z0-9@._-]', '_', owner)
+    extension = content_type.split("/")[-1]
+    if extension == "jpeg":
+        extension = "jpg"
+
+    date_path = datetime.fromtimestamp(created_at_ts).strftime("%Y/%m/%d")
+    filename = f"{safe_owner}_{int(created_at_ts)}.{extension}"
+    return filename, f"{S3_SCREENSHOTS_PREFIX}{date_path}/{filename}"
+
+
+def content_type_for_key(key: str) -> Optional[str]:
+    return EXTENSION_CONTENT_TYPES.get(key.rsplit(".", 1)[-1].lower())
+
+
+def validate_screenshot(file: UploadFile) -> int:
+    """Проверить тип и размер загруженного файла, вернуть размер в байтах"""
+    if file.content_type not in ALLOWED_CONTENT_TYPES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid file type: {file.content_type}. Allowed: {ALLOWED_CONTENT_TYPES}"
+        )
+
+    # Размер по временному файлу, без чтения содержимого
+    file.file.seek(0, os.SEEK_END)
+    size = file.file.tell()
+    file.file.seek(0)
+
+    if size > MAX_FILE_SIZE_BYTES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"File too large: {size / (1024 * 1024):.1f}MB. Max: {MAX_FILE_SIZE_MB}MB"
+        )
+    return size
+
+
+def file_md5(fileobj: BinaryIO) -> str:
+    """MD5 содержимого (как content_hash в hash-worker), читает блоками"""
+    fileobj.seek(0)
+    digest = hashlib.md5()
+    for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def put_fileobj(fileobj: BinaryIO, key: str, size: int, content_type: Optional[str]):
+    """PUT из файла потоком (вызывать из пула потоков)"""
+    fileobj.seek(0)
+    extra = {"ContentType": content_type} if content_type else {}
+    get_s3_client().put_object(Bucket=S3_BUCKET, Key=key, Body=fileobj, ContentLength=size, **extra)
+
+
+async def upload_screenshot(file: UploadFile, key: str, size: int) -> str:
+    """Загрузить провалидированный скриншот в S3, вернуть URL"""
+    try:
+        await run_blocking(put_fileobj, file.file, key, size, file.content_type)
+    except (ClientError, BotoCoreError) as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Failed to upload to S3: {str(e)}"
+        )
+    return object_url(key)
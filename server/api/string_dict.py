@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Словари строк activity_events: приложения, домены, заголовки окон.
+
+Одни и те же несколько сотен значений active_app / active_domain /
+active_window повторялись в миллионах строк. Теперь строка хранится
+один раз в app_names / domain_names / window_titles, а событие —
+только app_id / domain_id / window_id (INTEGER).
+
+Пачка событий резолвится так:
+  1. значения, известные процессу (StringIds), берутся из кэша
+  2. остальные — одним INSERT ... ON CONFLICT DO UPDATE RETURNING на словарь
+     (как resolve_machines в bulk_ingest.py)
+
+Чтение: ActivityEvent.app_name / domain_name / window_title (join со
+словарём или старая строковая колонка). Старые строки переносятся командой:
+    python string_dict.py migrate
+"""
+
+import logging
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+from sqlalchemy import event, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from models import AppName, DomainName, WindowTitle
+
+logger = logging.getLogger(__name__)
+
+# Сколько строк (всех словарей вместе) помнить в процессе
+STRING_DICT_CACHE_SIZE = int(os.getenv("STRING_DICT_CACHE_SIZE", "100000"))
+
+MIGRATE_BATCH_ROWS = 5000
+
+# строковая колонка activity_events -> (словарь, колонка с id)
+DICTIONARIES = {
+    "active_app": (AppName, "app_id"),
+    "active_domain": (DomainName, "domain_id"),
+    "active_window": (WindowTitle, "window_id"),
+}
+
+# Session.info: id, созданные в текущей (ещё не закоммиченной) транзакции
+PENDING_STRINGS_KEY = "pending_string_ids"
+
+
+class StringIds:
+    """LRU кэш (словарь, строка) -> id для строк, которые точно есть в БД"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._items: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, table: str, values: Iterable[str]) -> Tuple[Dict[str, int], List[str]]:
+        """({значение: id} найденных, [не найденные])"""
+        found = {}
+        unknown = []
+        with self._lock:
+            for value in values:
+                key = (table, value)
+                if key in self._items:
+                    self._items.move_to_end(key)
+                    found[value] = self._items[key]
+                else:
+                    unknown.append(value)
+            self.hits += len(found)
+            self.misses += len(unknown)
+        return found, unknown
+
+    def add(self, items: Iterable[Tuple[Tuple[str, str], int]]):
+        with self._lock:
+            for key, value_id in items:
+                self._items[key] = value_id
+                self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {"size": len(self._items), "max_size": self.max_size, "hits": self.hits, "misses": self.misses}
+
+
+string_ids = StringIds(STRING_DICT_CACHE_SIZE)
+
+
+def upsert_values(db, model, values: Iterable[str]) -> Dict[str, int]:
+    """
+    Найти или создать строки словаря одним запросом.
+    db — Session или Connection. Возвращает {значение: id}.
+    """
+    values = sorted(set(values))  # стабильный порядок блокировок
+    if not values:
+        return {}
+    stmt = pg_insert(model).values([{"value": v} for v in values])
+    # DO UPDATE (а не DO NOTHING), чтобы RETURNING вернул и уже существующие строки
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[model.value],
+        set_={"value": stmt.excluded.value},
+    ).returning(model.value, model.id)
+    return {row.value: row.id for row in db.execute(stmt)}
+
+
+def intern_strings(db: Session, model, values: Iterable[str]) -> Dict[str, int]:
+    """Строки -> id словаря model (без commit)"""
+    table = model.__tablename__
+    pending = db.info.get(PENDING_STRINGS_KEY, {})
+    resolved = {}
+    missing = []
+    found, unknown = string_ids.lookup(table, set(values))
+    resolved.update(found)
+    for value in unknown:
+        value_id = pending.get((table, value))
+        if value_id is None:
+            missing.append(value)
+        else:
+            resolved[value] = value_id
+
+    if missing:
+        created = upsert_values(db, model, missing)
+        # В кэш попадут только после commit (см. _publish_pending_strings),
+        # чтобы id из кэша всегда указывал на существующую строку
+        db.info.setdefault(PENDING_STRINGS_KEY, {}).update(
+            ((table, value), value_id) for value, value_id in created.items()
+        )
+        resolved.update(created)
+    return resolved
+
+
+def intern_rows(db: Session, rows: List[dict]):
+    """
+    Заменить в строках activity_events active_app/active_domain/active_window
+    на app_id/domain_id/window_id (на месте, без commit).
+    """
+    for column, (model, id_column) in DICTIONARIES.items():
+        ids = intern_strings(db, model, {row[column] for row in rows if row.get(column) is not None})
+        for row in rows:
+            value = row.pop(column, None)
+            row[id_column] = ids[value] if value is not None else None
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_pending_strings(session: Session):
+    string_ids.add(session.info.pop(PENDING_STRINGS_KEY, {}).items())
+
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending_strings(session: Session):
+    session.info.pop(PENDING_STRINGS_KEY, None)
+
+
+# ============ МИГРАЦИЯ СТАРЫХ СТРОК ============
+
+def migrate_legacy_strings(conn, batch_rows: int = MIGRATE_BATCH_ROWS) -> Dict[str, int]:
+    """
+    Перенести строковые колонки activity_events в словари пачками.
+    Каждая пачка — отдельная транзакция, прерванную миграцию можно продолжить.
+    Строки, занятые ingest или retention, ждутся (без SKIP LOCKED): иначе
+    пустая выборка из одних занятых строк выглядела бы как конец миграции.
+    Возвращает {колонка: перенесено строк}.
+    """
+    moved = {}
+    for column, (model, id_column) in DICTIONARIES.items():
+        moved[column] = 0
+        while True:
+            with conn.begin():
+                rows = conn.execute(text(f"""
+                    SELECT id, timestamp, {column} AS value
+                    FROM activity_events
+                    WHERE {column} IS NOT NULL
+                    ORDER BY id
+                    LIMIT :limit
+                    FOR UPDATE
+                """), {"limit": batch_rows}).all()
+                if not rows:
+                    break
+
+                ids = upsert_values(conn, model, {row.value for row in rows})
+                # timestamp в условии — чтобы UPDATE шёл только в нужную партицию
+                conn.execute(
+                    text(f"""
+                        UPDATE activity_events
+                        SET {id_column} = coalesce({id_column}, :value_id), {column} = NULL
+                        WHERE id = :row_id AND timestamp = :ts
+                    """),
+                    [{"row_id": row.id, "ts": row.timestamp, "value_id": ids[row.value]} for row in rows],
+                )
+                moved[column] += len(rows)
+            logger.info(f"String dictionary migration: {column} {moved[column]} rows moved")
+    return moved
+
+
+def main():
+    if sys.argv[1:] != ["migrate"]:
+        print(f"Usage: {sys.argv[0]} migrate")
+        return 2
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    from database import engine
+
+    with engine.connect() as conn:
+        moved = migrate_legacy_strings(conn)
+    print("Done: " + ", ".join(f"{column} {count} rows" for column, count in moved.items())
+          + " (VACUUM activity_events to reclaim space)")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
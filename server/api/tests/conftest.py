@@ -0,0 +1,40 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+# Модули API импортируются плоско (from rollups import ...), как в main.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Тесты с Postgres: TEST_DATABASE_URL=postgresql://... python -m pytest
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+
+@pytest.fixture
+def pg_conn():
+    """
+    Соединение с тестовой базой в отдельной схеме (search_path).
+    Всё делается в одной транзакции и откатывается после теста.
+    """
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import OperationalError
+
+    engine = create_engine(TEST_DATABASE_URL)
+    try:
+        conn = engine.connect()
+    except OperationalError as e:
+        engine.dispose()
+        pytest.skip(f"Test database is not reachable: {e}")
+
+    schema = f"test_{uuid.uuid4().hex[:12]}"
+    conn.execute(text(f"CREATE SCHEMA {schema}"))
+    conn.execute(text(f"SET LOCAL search_path TO {schema}"))
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        conn.close()
+        engine.dispose()
@@ -0,0 +1,117 @@
+"""
+Dashboard по агрегатам (rollups.py + aggregation.py) против прежнего прохода
+по событиям (bench_aggregation.legacy_*).
+
+Агрегаты строятся в Python тем же вкладом события и округлением интервала,
+что и rollups.apply_rows, а суммы по интервалам — как в fetch_fleet_rollups.
+
+Ответы совпадают полностью, кроме средних CPU/RAM ровно на границе
+округления (точное среднее x.x5): суммы float складываются в другом
+порядке (в БД — sum() по строкам агрегата), и round() может уйти в
+любую сторону. Такие значения сверяются с точным средним в Decimal.
+"""
+
+import math
+import random
+from datetime import date, timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+from bench_aggregation import has_activity, legacy_interval_data, legacy_period_data, synthetic_events
+from models import ActivityRollup5m, ActivityRollupDaily, ActivityRollupHourly
+from rollups import ROLLUP_LEVELS, SUM_COLUMNS, event_contribution
+from routers.dashboard import build_interval_data, build_period_data, day_origin
+
+MACHINE = SimpleNamespace(id=None, machine_id="vm-test-01", user_label=None)
+START = date(2025, 3, 1)
+END = date(2025, 3, 7)
+
+
+@pytest.fixture(scope="module")
+def events():
+    """Неделя поминутных событий плюс сутки до и после периода"""
+    rng = random.Random(42)
+    days = [START - timedelta(days=1)] + [START + timedelta(days=i) for i in range((END - START).days + 2)]
+    return [e for day in days for e in synthetic_events(rng, day)]
+
+
+def rollup(events, model):
+    """Строки агрегата model: {bucket_start: {колонка: сумма}} — как apply_rows"""
+    floor = next(f for m, f, _ in ROLLUP_LEVELS if m is model)
+    rows = {}
+    for event in events:
+        row = rows.setdefault(floor(event.timestamp), {c: 0 for c in SUM_COLUMNS})
+        for column, value in event_contribution(vars(event)).items():
+            row[column] += value
+    return rows
+
+
+def fleet_buckets(rows, first: date, last: date, bucket_minutes: int):
+    """Суммы строк агрегата по интервалам от полуночи first — как fetch_fleet_rollups для одной машины"""
+    origin = day_origin(first)
+    end = day_origin(last) + timedelta(days=1)
+    buckets = {}
+    for bucket_start, row in rows.items():
+        if not origin <= bucket_start < end:
+            continue
+        index = math.floor((bucket_start - origin).total_seconds() / (bucket_minutes * 60))
+        bucket = buckets.setdefault(index, {c: 0 for c in SUM_COLUMNS})
+        for column in SUM_COLUMNS:
+            bucket[column] += row[column]
+    return {index: {c: float(v) if c.endswith("_sum") else int(v) for c, v in bucket.items()}
+            for index, bucket in buckets.items()}
+
+
+def exact_averages(events, bin_of, bins: int, field: str):
+    """Точные средние field по активным событиям в Decimal (None — нет значений)"""
+    sums, counts = [Decimal(0)] * bins, [0] * bins
+    for event in events:
+        value = getattr(event, field)
+        if value is None or not has_activity(event):
+            continue
+        sums[bin_of(event)] += Decimal(str(value))
+        counts[bin_of(event)] += 1
+    return [s / c if c else None for s, c in zip(sums, counts)]
+
+
+def assert_same_averages(actual, expected, exact):
+    """Совпадение, либо расхождение на 0.1 при точном среднем ровно на границе округления"""
+    assert len(actual) == len(expected) == len(exact)
+    for a, e, x in zip(actual, expected, exact):
+        if a != e:
+            assert x is not None and (x * 10) % 1 == Decimal("0.5"), (a, e, x)
+            assert abs(Decimal(str(a)) - Decimal(str(e))) == Decimal("0.1")
+
+
+@pytest.mark.parametrize("interval", [5, 10, 15, 30, 60])
+def test_interval_data_matches_per_event(events, interval):
+    model = ActivityRollupHourly if interval % 60 == 0 else ActivityRollup5m
+    day_events = [e for e in events if e.timestamp.date() == END]
+
+    expected = legacy_interval_data(MACHINE, day_events, interval)
+    actual = build_interval_data(MACHINE, fleet_buckets(rollup(events, model), END, END, interval), interval)
+
+    bins = 24 * 60 // interval
+    for key, field in (("cpu", "cpu_percent"), ("ram", "ram_used_percent")):
+        exact = exact_averages(day_events, lambda e: (e.timestamp.hour * 60 + e.timestamp.minute) // interval,
+                               bins, field)
+        assert_same_averages(actual["chart"].pop(key), expected["chart"].pop(key), exact)
+    assert actual == expected
+
+
+def test_period_data_matches_per_event(events):
+    period_events = [e for e in events if START <= e.timestamp.date() <= END]
+
+    expected = legacy_period_data(MACHINE, period_events, START, END)
+    actual = build_period_data(MACHINE, fleet_buckets(rollup(events, ActivityRollupDaily), START, END, 24 * 60),
+                               START, END)
+    assert len(actual["daily_stats"]) == (END - START).days + 1
+
+    day_count = (END - START).days + 1
+    for key, field in (("avg_cpu", "cpu_percent"), ("avg_ram", "ram_used_percent")):
+        exact = exact_averages(period_events, lambda e: (e.timestamp.date() - START).days, day_count, field)
+        assert_same_averages([d.pop(key) for d in actual["daily_stats"]],
+                             [d.pop(key) for d in expected["daily_stats"]], exact)
+    assert actual == expected
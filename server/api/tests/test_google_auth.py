@@ -0,0 +1,136 @@
+"""
+Кэш проверки Google токенов (google_auth.py) против tokeninfo_stub.py:
+число запросов к tokeninfo при повторных, одновременных и невалидных токенах.
+"""
+
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer
+
+import pytest
+from fastapi import HTTPException
+
+import google_auth
+import tokeninfo_stub
+from agent_tokens import TOKEN_VERSION
+from routers import extension
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    """tokeninfo заглушка на свободном порту; stub.requests_served — число запросов"""
+    handler = tokeninfo_stub.TokenInfoHandler
+    monkeypatch.setattr(handler, "requests_served", 0)
+    monkeypatch.setattr(handler, "delay_sec", 0.0)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(handler, "url", f"http://127.0.0.1:{server.server_address[1]}/tokeninfo", raising=False)
+    yield handler
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def verifier(stub, monkeypatch):
+    """Отдельный GoogleTokenVerifier на заглушке вместо общего token_verifier"""
+    instance = google_auth.GoogleTokenVerifier(stub.url, max_size=100, ttl_sec=600, negative_ttl_sec=30)
+    monkeypatch.setattr(extension, "token_verifier", instance)
+    return instance
+
+
+def run(verifier, coro):
+    async def wrapped():
+        try:
+            return await coro
+        finally:
+            await verifier.close()
+    return asyncio.run(wrapped())
+
+
+def test_repeated_token_hits_upstream_once(stub, verifier):
+    async def scenario():
+        for _ in range(5):
+            info = await extension.verify_google_user("stub:user@example.com", "user@example.com")
+            assert info["email"] == "user@example.com"
+
+    run(verifier, scenario())
+    assert stub.requests_served == 1
+    assert verifier.upstream_calls == 1
+    assert verifier.hits == 4
+
+
+def test_ttl_capped_by_expires_in(stub, verifier):
+    async def scenario():
+        await extension.verify_google_user("stub:user@example.com:1", "user@example.com")
+        await extension.verify_google_user("stub:user@example.com:1", "user@example.com")
+        assert stub.requests_served == 1
+        await asyncio.sleep(1.1)
+        await extension.verify_google_user("stub:user@example.com:1", "user@example.com")
+
+    run(verifier, scenario())
+    assert stub.requests_served == 2
+
+
+def test_ttl_capped_by_cache_ttl(stub, verifier):
+    verifier.ttl_sec = 0.2
+
+    async def scenario():
+        await extension.verify_google_user("stub:user@example.com", "user@example.com")
+        await asyncio.sleep(0.3)
+        await extension.verify_google_user("stub:user@example.com", "user@example.com")
+
+    run(verifier, scenario())
+    assert stub.requests_served == 2
+
+
+def test_concurrent_checks_coalesce(stub, verifier):
+    stub.delay_sec = 0.2
+
+    async def scenario():
+        return await asyncio.gather(*(
+            extension.verify_google_user("stub:user@example.com", "user@example.com") for _ in range(20)
+        ))
+
+    results = run(verifier, scenario())
+    assert all(info["email"] == "user@example.com" for info in results)
+    assert stub.requests_served == 1
+    assert verifier.coalesced == 19
+
+
+def test_invalid_token_cached_negatively(stub, verifier):
+    verifier.negative_ttl_sec = 0.2
+
+    async def scenario():
+        for _ in range(3):
+            with pytest.raises(HTTPException) as exc:
+                await extension.verify_google_user("not-a-stub-token", "user@example.com")
+            assert exc.value.status_code == 401
+        assert stub.requests_served == 1
+        await asyncio.sleep(0.3)
+        with pytest.raises(HTTPException):
+            await extension.verify_google_user("not-a-stub-token", "user@example.com")
+
+    run(verifier, scenario())
+    assert stub.requests_served == 2
+
+
+def test_email_mismatch_uses_cache(stub, verifier):
+    async def scenario():
+        await extension.verify_google_user("stub:user@example.com", "user@example.com")
+        with pytest.raises(HTTPException) as exc:
+            await extension.verify_google_user("stub:user@example.com", "other@example.com")
+        assert exc.value.status_code == 403
+
+    run(verifier, scenario())
+    assert stub.requests_served == 1
+
+
+def test_handshake_rejects_agent_token(stub, verifier):
+    async def scenario():
+        with pytest.raises(HTTPException) as exc:
+            await extension.verify_google_user(f"{TOKEN_VERSION}.payload.signature", "user@example.com",
+                                               allow_agent_token=False)
+        assert exc.value.status_code == 401
+
+    run(verifier, scenario())
+    assert stub.requests_served == 0
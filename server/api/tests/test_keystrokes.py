@@ -0,0 +1,17 @@
+"""
+Упаковка клавиш (keystrokes.py): туда и обратно, включая редкие клавиши.
+"""
+
+from keystrokes import MAX_ESCAPED_BYTES, decode_keys, encode_keys
+
+
+def test_round_trip():
+    keys = ["a", "Я", "Enter", "F12", "€", "Ω"]
+    assert decode_keys(encode_keys(keys)) == keys
+
+
+def test_long_escaped_key_cut_on_character_boundary():
+    key = "ж" * MAX_ESCAPED_BYTES  # 2 байта на символ, предел посреди символа
+    packed = encode_keys([key])
+    assert packed[2] <= MAX_ESCAPED_BYTES
+    assert decode_keys(packed) == ["ж" * (MAX_ESCAPED_BYTES // 2)]
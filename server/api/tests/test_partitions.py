@@ -0,0 +1,46 @@
+"""
+Partition pruning activity_events (partitions.py): запрос за сутки
+читает только партицию своего периода. Нужен Postgres (TEST_DATABASE_URL).
+"""
+
+from datetime import datetime, timezone
+
+from database import Base
+from partitions import create_period, ensure_partitions, explain_range, list_partitions
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def create_schema(conn):
+    Base.metadata.create_all(conn)
+
+
+def test_one_day_range_reads_only_its_month(pg_conn):
+    create_schema(pg_conn)
+    ensure_partitions(pg_conn, now=utc(2025, 3, 15), interval="month", premake=2)
+    for month in (1, 2):
+        create_period(pg_conn, utc(2025, month, 1), interval="month")
+
+    names = {p.name for p in list_partitions(pg_conn, "activity_events")}
+    assert {"activity_events_p202501", "activity_events_p202502", "activity_events_p202503",
+            "activity_events_p202504", "activity_events_p202505", "activity_events_default"} <= names
+
+    assert explain_range(pg_conn, utc(2025, 2, 10), utc(2025, 2, 11)) == ["activity_events_p202502"]
+
+
+def test_range_across_boundary_reads_both_months(pg_conn):
+    create_schema(pg_conn)
+    ensure_partitions(pg_conn, now=utc(2025, 1, 15), interval="month", premake=2)
+
+    assert explain_range(pg_conn, utc(2025, 1, 31, 12), utc(2025, 2, 1, 12)) == [
+        "activity_events_p202501", "activity_events_p202502",
+    ]
+
+
+def test_one_day_range_with_daily_partitions(pg_conn):
+    create_schema(pg_conn)
+    ensure_partitions(pg_conn, now=utc(2025, 2, 9), interval="day", premake=3)
+
+    assert explain_range(pg_conn, utc(2025, 2, 10), utc(2025, 2, 11)) == ["activity_events_p20250210"]
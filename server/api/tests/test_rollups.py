@@ -0,0 +1,50 @@
+"""
+Пересчёт агрегатов (rollups.rebuild_day): сутки, перенесённые в архив
+(archive.py), не теряют агрегатов. Нужен Postgres (TEST_DATABASE_URL).
+"""
+
+import uuid
+from datetime import date, datetime, timezone
+
+from sqlalchemy import insert, select
+
+from database import Base
+from models import ActivityArchive, ActivityEvent, ActivityRollup5m, ActivityRollupDaily, ActivityRollupHourly, Machine
+from partitions import ensure_default_partitions
+from rollups import SUM_COLUMNS, rebuild_day
+
+DAY = date(2025, 2, 10)
+MIDNIGHT = datetime(2025, 2, 10, tzinfo=timezone.utc)
+
+
+def key_counts(conn, model):
+    rows = conn.execute(select(model.machine_id, model.key_count)).all()
+    return {machine_id: key_count for machine_id, key_count in rows}
+
+
+def test_rebuild_day_keeps_archived_machine_rollups(pg_conn):
+    Base.metadata.create_all(pg_conn)
+    ensure_default_partitions(pg_conn)
+    archived, live = uuid.uuid4(), uuid.uuid4()
+    pg_conn.execute(insert(Machine), [
+        {"id": archived, "machine_id": "vm-archived"},
+        {"id": live, "machine_id": "vm-live"},
+    ])
+
+    # У архивной машины сырых строк нет, есть только агрегаты и манифест
+    for model in (ActivityRollup5m, ActivityRollupHourly, ActivityRollupDaily):
+        sums = {**{c: 0 for c in SUM_COLUMNS}, "event_count": 1, "key_count": 40}
+        pg_conn.execute(insert(model).values(machine_id=archived, bucket_start=MIDNIGHT, **sums))
+    pg_conn.execute(insert(ActivityArchive).values(
+        machine_id=archived, day=DAY, storage="local", location="vm-archived/2025-02-10/1.parquet",
+        row_count=1, min_timestamp=MIDNIGHT, max_timestamp=MIDNIGHT, size_bytes=1, sha256="0" * 64,
+    ))
+    pg_conn.execute(insert(ActivityEvent), [
+        {"machine_id": live, "timestamp": MIDNIGHT.replace(hour=9, minute=m), "key_count": 5}
+        for m in range(3)
+    ])
+
+    rebuild_day(pg_conn, DAY)
+
+    for model in (ActivityRollup5m, ActivityRollupHourly, ActivityRollupDaily):
+        assert key_counts(pg_conn, model) == {archived: 40, live: 15}
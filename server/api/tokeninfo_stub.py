@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Локальная заглушка Google tokeninfo для тестов и нагрузочных прогонов.
+
+Токен вида "stub:<email>" или "stub:<email>:<expires_in>" считается
+валидным, любой другой — нет (400, как у Google).
+
+    python tokeninfo_stub.py --port 8099
+    GOOGLE_TOKENINFO_URL=http://127.0.0.1:8099/tokeninfo uvicorn main:app
+"""
+
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_EXPIRES_IN = 3599
+
+
+def token_info(token: str):
+    """Ответ tokeninfo для токена заглушки или None"""
+    parts = token.split(":")
+    if len(parts) not in (2, 3) or parts[0] != "stub" or "@" not in parts[1]:
+        return None
+    email = parts[1]
+    expires_in = int(parts[2]) if len(parts) == 3 and parts[2].isdigit() else DEFAULT_EXPIRES_IN
+    return {
+        "azp": "stub",
+        "aud": "stub",
+        "sub": f"stub_{email}",
+        "scope": "openid https://www.googleapis.com/auth/userinfo.email",
+        "exp": str(int(time.time()) + expires_in),
+        "expires_in": str(expires_in),
+        "email": email,
+        "email_verified": "true",
+    }
+
+
+class TokenInfoHandler(BaseHTTPRequestHandler):
+    delay_sec = 0.0
+    requests_served = 0
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != "/tokeninfo":
+            self._reply(404, {"error": "not_found"})
+            return
+
+        TokenInfoHandler.requests_served += 1
+        if self.delay_sec:
+            # Имитация задержки до Google
+            time.sleep(self.delay_sec)
+
+        token = parse_qs(url.query).get("access_token", [""])[0]
+        info = token_info(token)
+        if info is None:
+            self._reply(400, {"error": "invalid_token", "error_description": "Invalid Value"})
+        else:
+            self._reply(200, info)
+
+    def _reply(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stub Google tokeninfo server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--delay-ms", type=float, default=0, help="artificial upstream latency")
+    args = parser.parse_args()
+
+    TokenInfoHandler.delay_sec = args.delay_ms / 1000
+    server = ThreadingHTTPServer((args.host, args.port), TokenInfoHandler)
+    print(f"tokeninfo stub on http://{args.host}:{args.port}/tokeninfo")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,17 @@ Screenshot Hash Worker
 
 pHash игнорирует мелкие изменения (часы, курсор, колёсико загрузки),
 поэтому похожие скриншоты получат одинаковый/близкий хеш.
+
+Из того же декодированного изображения делается WebP превью
+(thumbnails/... рядом с screenshots/...), ссылка пишется в thumbnail_path.
+Декодирование и кодирование идут в пуле процессов (THUMBNAIL_WORKERS).
 """
 
 import os
 import time
 import hashlib
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 from urllib.parse import urlparse
 
@@ -42,6 +47,15 @@ BATCH_SIZE = int(os.getenv("HASH_BATCH_SIZE", "50"))
 SLEEP_INTERVAL = int(os.getenv("HASH_SLEEP_INTERVAL", "30"))
 PHASH_SIZE = int(os.getenv("PHASH_SIZE", "16"))  # 16x16 = 256 бит, более точный
 
+# Превью
+THUMBNAIL_WORKERS = int(os.getenv("THUMBNAIL_WORKERS", str(os.cpu_count() or 2)))
+THUMBNAIL_MAX_SIZE = int(os.getenv("THUMBNAIL_MAX_SIZE", "320"))  # по большей стороне, px
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", "70"))
+# Делать превью и для старых скриншотов, у которых уже есть pHash
+THUMBNAIL_BACKFILL = os.getenv("THUMBNAIL_BACKFILL", "false").lower() in ("1", "true", "yes")
+SCREENSHOTS_PREFIX = "screenshots/"
+THUMBNAILS_PREFIX = "thumbnails/"
+
 
 def get_db_connection():
     """Создать подключение к PostgreSQL"""
@@ -90,12 +104,13 @@ def download_image(s3_client, url: str) -> bytes | None:
         return None
 
 
-def compute_hashes(image_data: bytes) -> tuple[str, int] | None:
+def process_image(image_data: bytes) -> tuple[str, int, bytes | None] | None:
     """
-    Вычислить MD5 и pHash для изображения.
+    Вычислить MD5, pHash и WebP превью за одно декодирование.
+    Выполняется в пуле процессов.
     
     Returns:
-        (content_hash, phash_int) или None при ошибке
+        (content_hash, phash_int, thumbnail_webp) или None при ошибке
     """
     try:
         # MD5 - точный хеш
@@ -116,11 +131,40 @@ def compute_hashes(image_data: bytes) -> tuple[str, int] | None:
         # Поэтому берём только первые 64 бита или используем hash_size=8
         phash_int = int(str(phash), 16)
         
-        return content_hash, phash_int
-        
     except Exception as e:
         logger.error(f"Error computing hashes: {e}")
         return None
+    
+    # Превью не обязательно: без него остаётся ссылка на оригинал
+    try:
+        image.thumbnail((THUMBNAIL_MAX_SIZE, THUMBNAIL_MAX_SIZE))
+        out = BytesIO()
+        image.save(out, format="WEBP", quality=THUMBNAIL_QUALITY, method=4)
+        thumbnail = out.getvalue()
+    except Exception as e:
+        logger.error(f"Error creating thumbnail: {e}")
+        thumbnail = None
+    
+    return content_hash, phash_int, thumbnail
+
+
+def thumbnail_key(image_key: str) -> str:
+    """screenshots/2025/01/15/a.png -> thumbnails/2025/01/15/a.webp"""
+    if image_key.startswith(SCREENSHOTS_PREFIX):
+        image_key = image_key[len(SCREENSHOTS_PREFIX):]
+    return THUMBNAILS_PREFIX + os.path.splitext(image_key)[0] + ".webp"
+
+
+def upload_thumbnail(s3_client, image_url: str, thumbnail: bytes) -> str | None:
+    """Загрузить превью рядом с оригиналом, вернуть его URL"""
+    try:
+        bucket, key = parse_s3_url(image_url)
+        thumb_key = thumbnail_key(key)
+        s3_client.put_object(Bucket=bucket, Key=thumb_key, Body=thumbnail, ContentType="image/webp")
+        return f"{S3_ENDPOINT}/{bucket}/{thumb_key}"
+    except ClientError as e:
+        logger.error(f"S3 thumbnail upload error for {image_url}: {e}")
+        return None
 
 
 def ensure_columns_exist(conn):
@@ -131,7 +175,7 @@ def ensure_columns_exist(conn):
             SELECT column_name 
             FROM information_schema.columns 
             WHERE table_name = 'screenshots' 
-            AND column_name IN ('content_hash', 'phash', 'hash_processed_at')
+            AND column_name IN ('content_hash', 'phash', 'hash_processed_at', 'thumbnail_processed_at')
         """)
         existing = {row['column_name'] for row in cur.fetchall()}
         
@@ -147,6 +191,10 @@ def ensure_columns_exist(conn):
             logger.info("Adding column: hash_processed_at")
             cur.execute("ALTER TABLE screenshots ADD COLUMN hash_processed_at TIMESTAMP WITH TIME ZONE")
         
+        if 'thumbnail_processed_at' not in existing:
+            logger.info("Adding column: thumbnail_processed_at")
+            cur.execute("ALTER TABLE screenshots ADD COLUMN thumbnail_processed_at TIMESTAMP WITH TIME ZONE")
+        
         # Индекс для быстрого поиска по phash
         cur.execute("""
             CREATE INDEX IF NOT EXISTS idx_screenshots_phash 
@@ -159,12 +207,15 @@ def ensure_columns_exist(conn):
 
 
 def get_unprocessed_screenshots(conn, limit: int) -> list[dict]:
-    """Получить скриншоты без хеша"""
+    """Получить скриншоты без хеша (и без превью, если включён бэкфилл)"""
+    condition = "phash IS NULL"
+    if THUMBNAIL_BACKFILL:
+        condition = "(phash IS NULL OR thumbnail_processed_at IS NULL)"
     with conn.cursor() as cur:
-        cur.execute("""
-            SELECT id, image_path 
+        cur.execute(f"""
+            SELECT id, image_path, content_hash 
             FROM screenshots 
-            WHERE phash IS NULL 
+            WHERE {condition}
             AND image_path IS NOT NULL
             ORDER BY id DESC 
             LIMIT %s
@@ -172,16 +223,51 @@ def get_unprocessed_screenshots(conn, limit: int) -> list[dict]:
         return cur.fetchall()
 
 
-def update_screenshot_hashes(conn, screenshot_id: int, content_hash: str, phash_int: int):
-    """Обновить хеши для скриншота"""
+def copy_from_duplicate(conn, screenshot_id: int, content_hash: str) -> bool:
+    """
+    Скопировать pHash и превью с уже обработанного скриншота той же машины
+    с тем же content_hash (API при загрузке ссылается на существующий объект S3).
+    
+    Returns:
+        True, если такой скриншот нашёлся
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            UPDATE screenshots AS s
+            SET phash = d.phash,
+                hash_processed_at = NOW(),
+                thumbnail_path = d.thumbnail_path,
+                thumbnail_processed_at = NOW()
+            FROM (
+                SELECT phash, thumbnail_path 
+                FROM screenshots 
+                WHERE content_hash = %s 
+                AND machine_id = (SELECT machine_id FROM screenshots WHERE id = %s)
+                AND phash IS NOT NULL AND phash <> -1 
+                AND thumbnail_processed_at IS NOT NULL 
+                AND id <> %s
+                LIMIT 1
+            ) AS d
+            WHERE s.id = %s
+        """, (content_hash, screenshot_id, screenshot_id, screenshot_id))
+        copied = cur.rowcount > 0
+    conn.commit()
+    return copied
+
+
+def update_screenshot_hashes(conn, screenshot_id: int, content_hash: str, phash_int: int,
+                             thumbnail_url: str | None = None):
+    """Обновить хеши (и превью, если оно есть) для скриншота"""
     with conn.cursor() as cur:
         cur.execute("""
             UPDATE screenshots 
             SET content_hash = %s, 
                 phash = %s, 
-                hash_processed_at = NOW()
+                hash_processed_at = NOW(),
+                thumbnail_path = COALESCE(%s, thumbnail_path),
+                thumbnail_processed_at = NOW()
             WHERE id = %s
-        """, (content_hash, phash_int, screenshot_id))
+        """, (content_hash, phash_int, thumbnail_url, screenshot_id))
     conn.commit()
 
 
@@ -191,16 +277,20 @@ def mark_as_failed(conn, screenshot_id: int):
         cur.execute("""
             UPDATE screenshots 
             SET phash = -1, 
-                hash_processed_at = NOW()
+                hash_processed_at = NOW(),
+                thumbnail_processed_at = NOW()
             WHERE id = %s
         """, (screenshot_id,))
     conn.commit()
 
 
-def process_batch(conn, s3_client) -> int:
+def process_batch(conn, s3_client, pool: ProcessPoolExecutor) -> int:
     """
     Обработать пачку скриншотов.
     
+    Скачивание идёт в этом процессе, декодирование — в пуле,
+    поэтому следующий файл качается, пока предыдущий обрабатывается.
+    
     Returns:
         Количество обработанных скриншотов
     """
@@ -210,29 +300,44 @@ def process_batch(conn, s3_client) -> int:
         return 0
     
     processed = 0
+    futures = []
     
     for screenshot in screenshots:
-        screenshot_id = screenshot['id']
-        image_url = screenshot['image_path']
+        # Тот же файл уже обработан — ничего не качаем
+        if screenshot['content_hash'] and copy_from_duplicate(conn, screenshot['id'], screenshot['content_hash']):
+            processed += 1
+            continue
         
         # Скачиваем
-        image_data = download_image(s3_client, image_url)
+        image_data = download_image(s3_client, screenshot['image_path'])
         
         if image_data is None:
-            mark_as_failed(conn, screenshot_id)
+            mark_as_failed(conn, screenshot['id'])
             continue
         
-        # Вычисляем хеши
-        result = compute_hashes(image_data)
+        # Хеши и превью — в пуле процессов
+        futures.append((screenshot, pool.submit(process_image, image_data)))
+    
+    for screenshot, future in futures:
+        screenshot_id = screenshot['id']
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Image processing failed for {screenshot_id}: {e}")
+            result = None
         
         if result is None:
             mark_as_failed(conn, screenshot_id)
             continue
         
-        content_hash, phash_int = result
+        content_hash, phash_int, thumbnail = result
+        
+        thumbnail_url = None
+        if thumbnail is not None:
+            thumbnail_url = upload_thumbnail(s3_client, screenshot['image_path'], thumbnail)
         
         # Сохраняем
-        update_screenshot_hashes(conn, screenshot_id, content_hash, phash_int)
+        update_screenshot_hashes(conn, screenshot_id, content_hash, phash_int, thumbnail_url)
         processed += 1
     
     return processed
@@ -261,6 +366,7 @@ def main():
     logger.info(f"Batch size: {BATCH_SIZE}")
     logger.info(f"Sleep interval: {SLEEP_INTERVAL}s")
     logger.info(f"pHash size: {PHASH_SIZE}x{PHASH_SIZE}")
+    logger.info(f"Thumbnails: {THUMBNAIL_MAX_SIZE}px WebP, {THUMBNAIL_WORKERS} processes, backfill={THUMBNAIL_BACKFILL}")
     logger.info("=" * 50)
     
     # Проверяем S3 credentials
@@ -271,6 +377,7 @@ def main():
     # Подключаемся к БД
     conn = get_db_connection()
     s3_client = get_s3_client()
+    pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
     
     # Добавляем колонки если нужно
     ensure_columns_exist(conn)
@@ -282,7 +389,7 @@ def main():
     # Основной цикл
     while True:
         try:
-            processed = process_batch(conn, s3_client)
+            processed = process_batch(conn, s3_client, pool)
             
             if processed > 0:
                 stats = get_stats(conn)
@@ -309,6 +416,7 @@ def main():
             logger.error(f"Unexpected error: {e}")
             time.sleep(10)
     
+    pool.shutdown(cancel_futures=True)
     conn.close()
     logger.info("Worker stopped")
 